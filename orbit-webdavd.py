@@ -1,26 +1,346 @@
+import fnmatch, importlib, json, os, re, secrets, select, signal, socket, subprocess, sys, tarfile, tempfile, threading, time, zipfile, zlib
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, HTTPServer
-from webdavdlib import Lock, SystemdHandler, WriteBuffer, get_template, remove_prefix
+from urllib.parse import urlparse, unquote, quote
+from webdavdlib import Lock, SystemdHandler, WriteBuffer, CompressingWriter, Templates, remove_prefix, negotiate_encoding, is_compressible, compress, xml_element, sd_notify
+from webdavdlib.cache import LRUCache
+from webdavdlib.authenticator import AuthenticatorUnavailable
+from webdavdlib.filesystems import FilesystemTimeout, FilesystemBusy, QuotaExceeded, QUOTAPROP
+from webdavdlib.journal import InvalidSyncToken
+from webdavdlib.inotify import InotifyWatcher
+from webdavdlib.search import InvalidQuery
+from webdavdlib.archive import ARCHIVES, Extractor, LimitedReader
+from webdavdlib.shaping import ThrottledReader, ThrottledWriter
+from webdavdlib.uploads import UploadStore, UploadBusy
 from webdavdlib.requests import *
+
+
+def config_journal():
+    return None
+
+
+def config_search():
+    return None
+
+
+def config_reject():
+    return []
+
+
+def config_capture():
+    return None
+
+
+def config_uploads():
+    return UploadStore()
+
+
+def config_download_limit():
+    return None
+
+
+def config_upload_limit():
+    return None
+
+
 from configuration import *
 
 VERSION = "v0.4"
 
+# Properties rendered by the server itself instead of the filesystem
+LOCKPROP = ["D:lockdiscovery", "D:supportedlock"]
+
+# Collections listed (or resources looked up) per filesystem session, a session holds the global lock of mounts
+# switching the identity process wide, so long walks are split to not block other users
+SESSION_BATCH = 32
+
+# Files being uploaded are written next to their target under this prefix and renamed once complete. They are
+# left out of listings, the journal and the search index and can not be requested.
+UPLOAD_PREFIX = ".orbit-upload-"
+
+
+def is_upload_file(path):
+    return os.path.basename(path.rstrip("/")).startswith(UPLOAD_PREFIX)
+
+# Properties left out for Excel, it refuses to save files otherwise
+EXCELPROP = ["D:lastmodified", "D:lastaccessed", "Z:Win32LastModifiedTime", "Z:Win32LastAccessTime"]
+
 
 class WebDAVServer(ThreadingHTTPServer):
     log = logging.getLogger("WebDAVServer")
-    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
-        ThreadingHTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
-        self.fs = config_filesystems()
 
-        self.authenticator = config_authenticator()
+    # Connections arriving while the server restarts wait in the backlog
+    request_queue_size = 128
 
-        self.templates = {
-            "lock" : get_template("webdavdlib/templates/lock.template.jinja2"),
-            "propfind" : get_template("webdavdlib/templates/propfind.template.jinja2"),
-            "directory" : get_template("webdavdlib/templates/directory.template.jinja2")
-        }
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True, listen_fd=None):
+        if listen_fd is None:
+            ThreadingHTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        else:
+            # Listening socket handed over by the process restarting, see restart()
+            ThreadingHTTPServer.__init__(self, server_address, RequestHandlerClass, False)
+            self.socket.close()
+            self.socket = socket.socket(fileno=listen_fd)
+            self.server_address = self.socket.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
+
+        # Filesystems and authenticator are replaced by reload(), requests use the ones from get_config(). Replaced
+        # ones are closed once the last request using them returned them with release_config().
+        self.mutex = threading.Lock()
+        self.fs = config_filesystems()
+        self.authenticator = config_authenticator()
+        self.users = {}
+        self.retired = []
+
+        self.templates = Templates({
+            "lock" : "webdavdlib/templates/lock.template.jinja2",
+            "propfind" : "webdavdlib/templates/propfind.template.jinja2",
+            "directory" : "webdavdlib/templates/directory.template.jinja2",
+            "proppatch" : "webdavdlib/templates/proppatch.template.jinja2",
+            "status" : "webdavdlib/templates/status.template.jinja2"
+        })
         self.locks = {}
 
+        # Request threads are daemon threads, which server_close() does not wait for. They are counted instead,
+        # so a server handing over can finish them.
+        self.active = 0
+        self.finished = threading.Condition()
+
+        self.restarting = threading.Lock()
+        self.resumed = threading.Event()
+        self.handed_over = False
+        self.restart_timeout = 60
+
+        # Names answered with 404 right away (e.g. desktop.ini, ._* files), see config_reject()
+        patterns = list(config_reject()) + [UPLOAD_PREFIX + "*"]
+        self.reject = re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+
+        # Records sanitised requests for webdavdlib.replay, see config_capture()
+        self.capture = config_capture()
+
+        # Rendered HTML directory listings keyed by user, path, page and etag of the collection
+        self.listings = LRUCache(64)
+        self.listing_page_size = 1000
+
+        # Responses smaller than the threshold are sent uncompressed, compress_content enables compression of GET bodies
+        self.compression_threshold = 1024
+        self.compression_level = 6
+        self.compress_content = True
+
+        # PUT bodies are written in chunks of this size instead of being held in memory
+        self.upload_chunksize = 1048576
+
+        # Data of resumable uploads (UploadStore), None disables them, see config_uploads()
+        self.uploads = config_uploads()
+
+        # Per user bandwidth of streamed GET and PUT bodies (BandwidthLimiter), None is unlimited
+        self.download_limit = config_download_limit()
+        self.upload_limit = config_upload_limit()
+
+        # Change journal for sync-collection reports and index for SEARCH, both learn about local changes
+        # outside the daemon with inotify
+        self.journal = config_journal()
+        self.search = config_search()
+        self.search_limit = 1000
+        self.watchers = {}
+        self.watching = threading.Lock()
+        if self.search is not None:
+            self.search.start(self.fs)
+        if self.journal is not None or self.search is not None:
+            # Adding the watches walks all local trees, connections are accepted meanwhile
+            threading.Thread(target=self.watch, args=(self.fs,), name="InotifyWatcher", daemon=True).start()
+
+    def watch(self, fs):
+        # One watcher per local root, so roots still served after a reload are not walked again
+        with self.watching:
+            roots = set(fs.get_local_roots().items())
+            for root in list(self.watchers):
+                if root not in roots:
+                    self.watchers.pop(root).stop()
+
+            for path, realpath in roots:
+                if (path, realpath) in self.watchers:
+                    continue
+                try:
+                    watcher = InotifyWatcher({path: realpath}, self.notify_change, self.resync)
+                except OSError:
+                    self.log.exception("Can not watch %s, changes outside of the daemon are not noticed" % realpath)
+                    continue
+                watcher.start()
+                self.watchers[(path, realpath)] = watcher
+
+    def get_config(self):
+        with self.mutex:
+            config = (self.fs, self.authenticator)
+            self.users[config] = self.users.get(config, 0) + 1
+            return config
+
+    def release_config(self, config):
+        with self.mutex:
+            self.users[config] -= 1
+            if self.users[config]:
+                return
+            del self.users[config]
+            if config not in self.retired:
+                return
+            self.retired.remove(config)
+        self.close_config(config)
+
+    def close_config(self, config):
+        fs, authenticator = config
+        try:
+            # Configurations may hand out the same objects again
+            if fs is not self.fs:
+                fs.close()
+            if authenticator is not self.authenticator:
+                authenticator.close()
+        except Exception:
+            self.log.exception("Failed to close the replaced filesystems or authenticator")
+
+    def reload(self):
+        """
+        Evaluates config_filesystems() and config_authenticator() of the changed configuration again. Requests already
+        running finish with the filesystems they started with, locks are kept.
+        """
+        self.log.info("Reloading the configuration")
+        try:
+            configuration = importlib.reload(sys.modules["configuration"])
+            fs = configuration.config_filesystems()
+            authenticator = configuration.config_authenticator()
+        except Exception:
+            self.log.exception("Reloading the configuration failed, the current one is kept")
+            return
+
+        with self.mutex:
+            old = (self.fs, self.authenticator)
+            self.fs = fs
+            self.authenticator = authenticator
+            self.listings = LRUCache(64)
+
+            # Requests still running with the old configuration close it when they are done
+            idle = old not in self.users
+            if not idle:
+                self.retired.append(old)
+        if idle:
+            self.close_config(old)
+
+        if self.search is not None:
+            self.search.fs = fs
+            self.search.rebuild()
+        if self.journal is not None or self.search is not None:
+            self.watch(fs)
+        self.log.info("Configuration reloaded")
+
+    def save_state(self):
+        fd, filename = tempfile.mkstemp(prefix="orbit-webdavd-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump([lock.__dict__ for lock in list(self.locks.values())], f)
+        return filename
+
+    def load_state(self, filename):
+        with open(filename) as f:
+            for state in json.load(f):
+                lock = Lock.__new__(Lock)
+                lock.__dict__.update(state)
+                self.locks[lock.uid] = lock
+        os.unlink(filename)
+        self.log.info("Took over %d locks" % len(self.locks))
+
+    def restart(self):
+        """
+        Hands the listening socket and the locks over to a new process running the current code, then finishes the
+        requests in progress. Connections arriving meanwhile wait in the backlog. The server keeps running when the
+        new process does not come up.
+        """
+        if not self.restarting.acquire(blocking=False):
+            return
+
+        self.log.info("Restarting")
+        self.shutdown()
+        try:
+            self.hand_over()
+            self.handed_over = True
+        except Exception:
+            self.log.exception("Restart failed, continuing")
+            self.restarting.release()
+        self.resumed.set()
+
+    def hand_over(self):
+        state = self.save_state()
+        read, write = os.pipe()
+        fd = self.socket.fileno()
+        env = dict(os.environ, ORBIT_WEBDAVD_FD=str(fd), ORBIT_WEBDAVD_READY=str(write), ORBIT_WEBDAVD_STATE=state)
+        try:
+            process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=(fd, write))
+        except:
+            os.unlink(state)
+            raise
+        finally:
+            os.close(write)
+
+        # The new process writes to the pipe once it is ready, the pipe is closed without data if it died
+        try:
+            ready = select.select([read], [], [], self.restart_timeout)[0] and os.read(read, 1)
+        finally:
+            os.close(read)
+
+        if not ready:
+            process.kill()
+            if os.path.exists(state):
+                os.unlink(state)
+            raise RuntimeError("The new process did not get ready")
+        self.log.info("Handed over to process %d" % process.pid)
+
+    def serve(self):
+        while True:
+            self.serve_forever()
+
+            # Stopped by restart(), which resumes serving if the hand over failed
+            self.resumed.wait()
+            self.resumed.clear()
+            if self.handed_over:
+                break
+
+        self.log.info("Finishing the requests in progress")
+        self.server_close()
+        with self.finished:
+            while self.active:
+                self.finished.wait()
+
+    def process_request(self, request, client_address):
+        with self.finished:
+            self.active += 1
+        try:
+            ThreadingHTTPServer.process_request(self, request, client_address)
+        except:
+            self.request_finished()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadingHTTPServer.process_request_thread(self, request, client_address)
+        finally:
+            self.request_finished()
+
+    def request_finished(self):
+        with self.finished:
+            self.active -= 1
+            self.finished.notify_all()
+
+    def notify_change(self, path, deleted=False, owner=None):
+        if is_upload_file(path):
+            return
+        if self.journal is not None:
+            self.journal.record(path, deleted, owner)
+        if self.search is not None:
+            self.search.notify(path, deleted, owner)
+
+    def resync(self):
+        # Changes were lost, clients have to sync again from scratch and the index is rebuilt
+        if self.journal is not None:
+            self.journal.reset()
+        if self.search is not None:
+            self.search.rebuild()
+
     def get_lock(self, uid):
         if uid in self.locks:
             return self.locks[uid]
@@ -53,13 +373,33 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         self.server_version = "orbit-webdavd/%s" % (VERSION,)
 
         self.user = None
+        self.status = None
+        self.response_length = None
 
         BaseHTTPRequestHandler.__init__(self, request, client_address, server)
 
+    def send_response(self, code, message=None):
+        self.status = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "content-length":
+            self.response_length = value
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
     def require_auth(self, request):
-        if request.username and request.password and self.server.authenticator.authenticate(request.username, request.password):
-            self.user = request.username
-            return False
+        try:
+            if request.username and request.password and self.authenticator.authenticate(request.username, request.password):
+                self.user = request.username
+                return False
+        except AuthenticatorUnavailable:
+            self.log.debug("Authentication backend unavailable, sending 503")
+            self.send_response(503, "Service Unavailable")
+            self.send_header("Retry-After", "5")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.close_connection = True
+            return True
 
         self.log.debug("Unauthenticated, sending 401")
         self.send_response(401, 'Authorization Required')
@@ -70,21 +410,103 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         return True
 
     def handle_one_request(self):
+        if self.server.capture is None:
+            self.process_one_request()
+            return
+
+        self.command = None
+        self.status = None
+        self.response_length = None
+        start = time.monotonic()
+        try:
+            self.process_one_request()
+        finally:
+            # Nothing is recorded for connections closed before a request arrived or requests failing to parse
+            if self.command and getattr(self, "headers", None) is not None:
+                size = int(self.response_length) if self.response_length is not None else None
+                self.server.capture.record(self.command, self.path, self.headers, self.client_address[0], self.user,
+                                           self.status, size, start, time.monotonic() - start)
+
+    def process_one_request(self):
+        # The filesystems and authenticator of the request, reload() does not change them midway
+        config = self.server.get_config()
+        self.fs, self.authenticator = config
         try:
             BaseHTTPRequestHandler.handle_one_request(self)
+        except FilesystemTimeout:
+            self.log.warning("504 Gateway Timeout")
+            self.send_response(504, "Gateway Timeout")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.close_connection = True
+        except FilesystemBusy:
+            self.log.warning("503 Service Unavailable")
+            self.send_response(503, "Service Unavailable")
+            self.send_header("Retry-After", "10")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.close_connection = True
+        except QuotaExceeded:
+            self.log.info("507 Insufficient Storage")
+            self.send_response(507, "Insufficient Storage")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.close_connection = True
         except:
             self.log.exception("500 Server Error")
             self.send_response(500, "Server Error")
             self.end_headers()
+        finally:
+            self.server.release_config(config)
+
+    def limited_wfile(self):
+        if self.server.download_limit is not None:
+            bucket = self.server.download_limit.get_bucket(self.user)
+            if bucket is not None:
+                return ThrottledWriter(self.wfile, bucket)
+        return self.wfile
+
+    def limited_rfile(self):
+        if self.server.upload_limit is not None:
+            bucket = self.server.upload_limit.get_bucket(self.user)
+            if bucket is not None:
+                return ThrottledReader(self.rfile, bucket)
+        return self.rfile
+
+    def reject_probe(self):
+        """
+        Answers lookups of names matching the configured reject patterns with 404 before the request is parsed
+        and authenticated.
+        """
+        if self.server.reject is None:
+            return False
+
+        name = unquote(urlparse(self.path).path).rstrip("/").rpartition("/")[2]
+        if not self.server.reject.match(name):
+            return False
+
+        self.log.debug("404 Not Found (rejected probe %s)" % name)
+        self.send_response(404, "Not Found")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.close_connection = True
+        return True
 
     def do_HEAD(self):
+        if self.reject_probe():
+            return
+
         request = HEADRequest(self)
         if self.require_auth(request):
             return
 
         self.log.info(request)
 
-        filedata = self.server.fs.get_content(self.user, request.path)
+        if request.upload is not None:
+            self.head_upload(request)
+            return
+
+        filedata = self.fs.get_content(self.user, request.path)
         b = WriteBuffer(self.wfile)
         b.write(filedata)
 
@@ -94,6 +516,9 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
+        if self.reject_probe():
+            return
+
         request = GETRequest(self)
         if self.require_auth(request):
             return
@@ -101,52 +526,13 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         self.log.info(request)
 
         try:
-            props = self.server.fs.get_props(self.user, request.path, ["D:iscollection"])
-            if props["D:iscollection"]:
-
-                children = self.server.fs.get_children(self.user, request.path)
-
-                data = []
-                for c in children:
-                    cdata = {}
-                    cdata["path"] = c
-                    cdata["name"] = remove_prefix(c, request.path)
-                    cdata["directory"] = self.server.fs.get_props(self.user, c, ["D:iscollection"])["D:iscollection"]
-                    cdata["hidden"] = self.server.fs.get_props(self.user, c, ["D:ishidden"])["D:ishidden"]
-                    data.append(cdata)
-
-                if request.path != "/":
-                    data.append({
-                        "path" : os.path.split(request.path)[0],
-                        "name" : "..",
-                        "hidden" : False,
-                        "directory": True
-                    })
-
-                sort = sorted(data, key=lambda k: (not k["directory"], k["path"].lower()))
-
-                b = WriteBuffer(self.wfile)
-                b.write(self.server.templates["directory"].render(path=request.path, children=sort))
-                
-                self.log.debug("200 OK")
-                self.send_response(200, "OK")
-                self.send_header("Content-Length", str(b.getSize()))
-                self.send_header("Content-Type", "text/html; charset=utf-8")
-                self.end_headers()
-                b.flush()
+            props = self.fs.get_props(self.user, request.path, ["D:iscollection", "D:getetag"])
+            if props["D:iscollection"] and "archive" in request.query:
+                self.send_archive(request, request.query["archive"][0])
+            elif props["D:iscollection"]:
+                self.send_listing(request, props["D:getetag"])
             else:
-                filedata = self.server.fs.get_content(self.user, request.path)
-                ctype = props = self.server.fs.get_props(self.user, request.path, ["D:getcontenttype"])["D:getcontenttype"]
-
-                b = WriteBuffer(self.wfile)
-                b.write(filedata)
-
-                self.log.debug("200 OK")
-                self.send_response(200, "OK")
-                self.send_header("Content-Length", str(b.getSize()))
-                self.send_header("Content-Type", ctype + "; charset=utf-8")
-                self.end_headers()
-                b.flush()
+                self.send_content(request)
         except FileNotFoundError:
             self.log.debug("404 Not Found")
             self.send_response(404, "Not Found")
@@ -156,6 +542,198 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             self.send_response(403, "Forbidden")
             self.end_headers()
 
+    def build_listing(self, request, page):
+        children = self.get_children_props(request.path, ["D:iscollection", "D:ishidden"])
+
+        data = []
+        for c, cprops in children.items():
+            cdata = {}
+            cdata["path"] = c
+            cdata["name"] = remove_prefix(c, request.path)
+            cdata["directory"] = cprops["D:iscollection"]
+            cdata["hidden"] = cprops["D:ishidden"]
+            data.append(cdata)
+
+        if request.path != "/":
+            data.append({
+                "path" : os.path.split(request.path)[0],
+                "name" : "..",
+                "hidden" : False,
+                "directory": True
+            })
+
+        sort = sorted(data, key=lambda k: (not k["directory"], k["path"].lower()))
+
+        pagesize = self.server.listing_page_size
+        pages = max(1, (len(sort) + pagesize - 1) // pagesize)
+        page = min(page, pages - 1)
+
+        html = self.server.templates["directory"].render(path=request.path, children=sort[page * pagesize:(page + 1) * pagesize], page=page, pages=pages)
+        return {"identity": html.encode("utf-8")}
+
+    def send_listing(self, request, etag):
+        try:
+            page = max(0, int(request.query.get("page", ["0"])[0]))
+        except ValueError:
+            page = 0
+
+        # The etag of a collection changes with its modification time
+        key = (self.user, request.path, page, etag)
+        listing = self.server.listings.get(key)
+        if listing is None:
+            listing = self.build_listing(request, page)
+            self.server.listings.set(key, listing)
+
+        encoding = "identity"
+        if len(listing["identity"]) >= self.server.compression_threshold:
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+            if encoding not in listing:
+                listing[encoding] = compress(listing["identity"], encoding, self.server.compression_level)
+
+        self.log.debug("200 OK")
+        self.send_response(200, "OK")
+        self.send_header("Content-Length", str(len(listing[encoding])))
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(listing[encoding])
+        self.wfile.flush()
+
+    def send_archive(self, request, kind):
+        if kind not in ARCHIVES:
+            self.send_empty(400, "Bad Request")
+            return
+
+        write, ctype = ARCHIVES[kind]
+        name = request.path.rstrip("/").rpartition("/")[2] or "archive"
+
+        # The archive is built while it is sent, its length is only known when the connection is closed
+        self.log.debug("200 OK (%s archive)" % kind)
+        self.send_response(200, "OK")
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Disposition", "attachment; filename*=UTF-8''%s.%s" % (quote(name), kind))
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            write(self.fs, self.user, request.path, name, self.limited_wfile())
+        except Exception:
+            self.log.exception("Archive of %s aborted" % request.path)
+
+    def send_content(self, request):
+        props = self.fs.get_props(self.user, request.path, ["D:getcontenttype", "D:getcontentlength"])
+        ctype = props["D:getcontenttype"]
+        size = props["D:getcontentlength"]
+
+        encoding = "identity"
+        compressible = self.server.compress_content and is_compressible(ctype)
+        if compressible and size >= self.server.compression_threshold:
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+
+        # Fetch the first chunk before sending headers so errors can still be reported
+        chunks = iter(self.fs.iter_content(self.user, request.path))
+        first = next(chunks, b"")
+
+        self.log.debug("200 OK")
+        self.send_response(200, "OK")
+        self.send_header("Content-Type", ctype + "; charset=utf-8")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+
+        if encoding == "identity":
+            w = self.limited_wfile()
+            self.send_header("Content-Length", str(size))
+        else:
+            # The compressed size is unknown up front, the body ends when the connection is closed
+            w = CompressingWriter(self.limited_wfile(), encoding, self.server.compression_level)
+            self.send_header("Content-Encoding", encoding)
+            self.close_connection = True
+        self.end_headers()
+
+        w.write(first)
+        for chunk in chunks:
+            w.write(chunk)
+        w.flush()
+
+    def get_children_props(self, path, props):
+        children = self.fs.get_children_props(self.user, path, props)
+        return dict((child, childprops) for child, childprops in children.items() if not is_upload_file(child))
+
+    def notify_change(self, path, deleted=False):
+        # Changes in trees of a single user (HomeFilesystem) are not reported to the others
+        self.server.notify_change(path, deleted, self.fs.get_owner(self.user, path))
+
+    def send_body(self, code, message, body, ctype, headers={}):
+        """
+        Sends a complete response body. The body is compressed if it is large enough and the client accepts it.
+        """
+        encoding = "identity"
+        if len(body) >= self.server.compression_threshold:
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+            if encoding != "identity":
+                body = compress(body, encoding, self.server.compression_level)
+
+        self.send_response(code, message)
+        self.send_header("Content-Type", ctype)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        if encoding != "identity":
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def read_body(self, request):
+        """
+        Yields the request body in chunks of upload_chunksize. Raises ConnectionError if the client sends less.
+        """
+        rfile = self.limited_rfile()
+        received = 0
+        while received < request.length:
+            data = rfile.read(min(self.server.upload_chunksize, request.length - received))
+            if not data:
+                raise ConnectionError("Client sent %d of %d bytes" % (received, request.length))
+            received += len(data)
+            yield data
+
+    def write_chunks(self, path, chunks, start):
+        """
+        Writes the chunks into path beginning at offset start, -1 replaces the whole content.
+        """
+        written = 0
+        for data in chunks:
+            self.fs.set_content(self.user, path, data, start if written == 0 else max(start, 0) + written)
+            written += len(data)
+        if written == 0 and start == -1:
+            self.fs.set_content(self.user, path, b"")
+
+    def store_file(self, path, chunks, exists):
+        """
+        Writes the chunks into a hidden file next to path and renames it over path once complete, so a failing
+        upload leaves the previous content intact.
+        """
+        temp = "%s/%s%s" % (path.rstrip("/").rpartition("/")[0], UPLOAD_PREFIX, secrets.token_hex(16))
+        try:
+            self.write_chunks(temp, chunks, -1)
+            if exists:
+                self.fs.copy_dead_props(self.user, path, temp)
+            self.replace(temp, path)
+        except:
+            self.discard(temp)
+            raise
+
+    def send_empty(self, code, message, headers={}):
+        self.log.debug("%d %s" % (code, message))
+        self.send_response(code, message)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
     def do_PUT(self):
         request = PUTRequest(self)
         if self.require_auth(request):
@@ -163,90 +741,383 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         
         self.log.info(request)
 
+        if not request.valid:
+            self.send_empty(400, "Bad Request")
+            self.close_connection = True
+            return
+
+        if request.upload is not None:
+            self.put_upload(request)
+            return
+
+        size = 0
         exists = True
         try:
-            self.server.fs.get_props(self.user, request.path)
+            props = self.fs.get_props(self.user, request.path, ["D:iscollection", "D:getcontentlength"])
+            if props["D:iscollection"]:
+                self.send_empty(405, "Method Not Allowed")
+                self.close_connection = True
+                return
+            size = props["D:getcontentlength"]
         except FileNotFoundError:
             exists = False
 
+        # The replaced content is kept until the new one is complete
+        growth = request.length if request.range is None else request.range[0] + request.length - size
+        if self.over_quota(request.path, growth):
+            return
+
         try:
-            result = self.server.fs.set_content(self.user, request.path, request.data)
+            # Content-Range writes only the given bytes into the existing content
+            if request.range is None:
+                self.store_file(request.path, self.read_body(request), exists)
+            else:
+                self.write_chunks(request.path, self.read_body(request), request.range[0])
+            self.notify_change(request.path)
 
             if exists:
-                self.log.debug("204 No-Content")
-                self.send_response(204, "No-Content")
-                self.send_header('Content-length', '0')
-                self.end_headers()
+                self.send_empty(204, "No-Content")
             else:
-                self.log.debug("201 Created")
-                self.send_response(201, "Created")
-                self.send_header('Content-length', '0')
-                self.end_headers()
+                self.send_empty(201, "Created")
+        except ConnectionError as e:
+            self.log.warning("Upload of %s aborted: %s" % (request.path, e))
+            self.close_connection = True
+        except FileNotFoundError:
+            self.send_empty(409, "Conflict")
+            self.close_connection = True
         except PermissionError:
-            self.log.debug("403 Forbidden")
-            self.send_response(403, "Forbidden")
-            self.end_headers()
+            self.send_empty(403, "Forbidden")
+            self.close_connection = True
+
+    def over_quota(self, path, growth):
+        """
+        Answers with 507 if growing the content of path by growth bytes would exceed the quota. Checked before the
+        body is read, so clients do not send data that would be rejected.
+        """
+        quota = self.fs.get_quota(self.user, path)
+        if quota is None or growth <= quota[1]:
+            return False
+
+        self.send_empty(507, "Insufficient Storage")
+        self.close_connection = True
+        return True
+
+    def do_POST(self):
+        request = POSTRequest(self)
+        if self.require_auth(request):
+            return
+
+        self.log.info(request)
+
+        if request.extract is not None:
+            self.extract_archive(request)
+            return
+
+        # Besides archive uploads POST only starts resumable uploads (POST /path/file?upload)
+        if request.upload != "":
+            self.send_empty(405, "Method Not Allowed")
+            return
+
+        if self.server.uploads is None:
+            self.send_empty(405, "Method Not Allowed")
+            return
+
+        try:
+            # The session lives outside of the namespace, only the collection of the target has to exist yet
+            parent = request.path.rstrip("/").rpartition("/")[0] or "/"
+            if not self.fs.get_props(self.user, parent, ["D:iscollection"])["D:iscollection"]:
+                raise FileNotFoundError()
+            try:
+                if self.fs.get_props(self.user, request.path, ["D:iscollection"])["D:iscollection"]:
+                    self.send_empty(405, "Method Not Allowed")
+                    return
+            except FileNotFoundError:
+                pass
+
+            upload = self.server.uploads.create(self.user, request.path)
+            self.send_empty(201, "Created", {"Location": "%s?upload=%s" % (quote(request.path), upload), "Upload-Offset": "0"})
+        except FileNotFoundError:
+            self.send_empty(409, "Conflict")
+        except PermissionError:
+            self.send_empty(403, "Forbidden")
+
+    def extract_archive(self, request):
+        """
+        Extracts a tar (optionally compressed) or zip archive sent as body of POST /collection?extract=tar|zip into the
+        collection. Every member is stored through the filesystem as the user, the result of each one is reported.
+        """
+        if request.extract not in ("tar", "zip"):
+            self.send_empty(400, "Bad Request")
+            self.close_connection = True
+            return
+
+        try:
+            if not self.fs.get_props(self.user, request.path, ["D:iscollection"])["D:iscollection"]:
+                raise NotADirectoryError()
+        except (FileNotFoundError, NotADirectoryError):
+            self.send_empty(409, "Conflict")
+            self.close_connection = True
+            return
+        except PermissionError:
+            self.send_empty(403, "Forbidden")
+            self.close_connection = True
+            return
+
+        extractor = Extractor(self.fs, self.user, request.path, self.server.upload_chunksize, self.notify_change)
+        stream = LimitedReader(self.limited_rfile(), request.length)
+        try:
+            if request.extract == "tar":
+                extractor.extract_tar(stream)
+            else:
+                extractor.extract_zip(stream)
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, zlib.error) as e:
+            self.log.warning("Archive upload to %s broken after %d members: %s" % (request.path, len(extractor.results), e))
+            if not extractor.results:
+                self.send_empty(400, "Bad Request")
+                self.close_connection = True
+                return
+            extractor.results.append((request.path, "400 Bad Request"))
+
+        results = [(path.lstrip("/"), status) for path, status in extractor.results]
+        body = self.server.templates["status"].render(results=results).encode("utf-8")
+        self.log.debug("207 Multi-Status (%d members)" % len(results))
+        self.send_body(207, "Multi-Status", body, "text/xml", {"Charset": "utf-8"})
+
+    def put_upload(self, request):
+        """
+        Appends the body to an upload session. Each PUT has to continue at the current offset of the session, the
+        target is replaced with the assembled file once a Content-Range reaches the total length.
+        """
+        uploads = self.server.uploads
+        try:
+            if uploads is None:
+                raise FileNotFoundError()
+            uploads.get_offset(request.upload, self.user, request.path)
+
+            with uploads.open(request.upload) as f:
+                offset = f.tell()
+                first = 0 if request.range is None else request.range[0]
+                if first != offset:
+                    self.send_empty(409, "Conflict", {"Upload-Offset": str(offset)})
+                    self.close_connection = True
+                    return
+                if self.over_quota(request.path, offset + request.length):
+                    return
+
+                # Bytes received before a disconnect are kept, the client resumes at the offset HEAD reports
+                for data in self.read_body(request):
+                    f.write(data)
+                offset += request.length
+
+                if request.range is None or request.range[2] is None or offset < request.range[2]:
+                    self.send_empty(204, "No-Content", {"Upload-Offset": str(offset)})
+                    return
+
+                exists = True
+                try:
+                    if self.fs.get_props(self.user, request.path, ["D:iscollection"])["D:iscollection"]:
+                        self.send_empty(405, "Method Not Allowed")
+                        return
+                except FileNotFoundError:
+                    exists = False
+
+                f.flush()
+                with open(uploads.data_path(request.upload), "rb") as data:
+                    self.store_file(request.path, iter(lambda: data.read(self.server.upload_chunksize), b""), exists)
+                uploads.remove(request.upload)
+            self.notify_change(request.path)
+
+            if exists:
+                self.send_empty(204, "No-Content", {"Upload-Offset": str(offset)})
+            else:
+                self.send_empty(201, "Created", {"Upload-Offset": str(offset)})
+        except UploadBusy:
+            self.send_empty(409, "Conflict")
+            self.close_connection = True
+        except ConnectionError as e:
+            self.log.warning("Upload to %s aborted: %s" % (request.path, e))
+            self.close_connection = True
+        except FileNotFoundError:
+            self.send_empty(404, "Not Found")
+            self.close_connection = True
+        except PermissionError:
+            self.send_empty(403, "Forbidden")
+            self.close_connection = True
+
+    def discard(self, path):
+        try:
+            self.fs.delete(self.user, path)
+        except (FileNotFoundError, PermissionError):
+            pass
+
+    def replace(self, source, path):
+        """
+        Moves the file source over path. Filesystems refusing to move onto an existing destination get it deleted
+        first, like in transfer().
+        """
+        try:
+            self.fs.move(self.user, source, path)
+        except FileExistsError:
+            self.fs.delete(self.user, path)
+            self.fs.move(self.user, source, path)
+
+    def head_upload(self, request):
+        try:
+            if self.server.uploads is None:
+                raise FileNotFoundError()
+            offset = self.server.uploads.get_offset(request.upload, self.user, request.path)
+            self.send_empty(204, "No-Content", {"Upload-Offset": str(offset)})
+        except FileNotFoundError:
+            self.send_empty(404, "Not Found")
+
+    def delete_upload(self, request):
+        uploads = self.server.uploads
+        try:
+            if uploads is None:
+                raise FileNotFoundError()
+            uploads.get_offset(request.upload, self.user, request.path)
+            with uploads.open(request.upload):
+                uploads.remove(request.upload)
+            self.send_empty(204, "No-Content")
+        except UploadBusy:
+            self.send_empty(409, "Conflict")
+        except FileNotFoundError:
+            self.send_empty(404, "Not Found")
 
     def do_OPTIONS(self):
         self.log.info("[%s] OPTIONS Request on %s" % (self.user, self.path))
 
         self.send_response(200, self.server_version)
-        self.send_header("Allow", "GET, HEAD, POST, PUT, DELETE, OPTIONS, PROPFIND, PROPPATCH, MKCOL, LOCK, UNLOCK, MOVE, COPY")
+        self.send_header("Allow", "GET, HEAD, POST, PUT, DELETE, OPTIONS, PROPFIND, PROPPATCH, MKCOL, LOCK, UNLOCK, MOVE, COPY, REPORT, SEARCH")
         self.send_header("Content-Length", "0")
         self.send_header("X-Server-Copyright", self.server_version)
         self.send_header("DAV", "1, 2")  # OSX Finder need Ver 2, if Ver 1 -- read only
         self.send_header("MS-Author-Via", "DAV")
+        if self.server.search is not None:
+            self.send_header("DASL", "<DAV:basicsearch>")
         self.send_header('WWW-Authenticate', 'Basic realm="WebDav Auth"')
         self.end_headers()
         
 
+    def select_props(self, propmode, props, include, isexcel=False):
+        if propmode == "prop":
+            requested = props
+        else:
+            requested = STDPROP + LOCKPROP + include
+
+        if isexcel:
+            requested = [prop for prop in requested if prop not in EXCELPROP]
+
+        return requested
+
+    def build_resdata(self, resources, requested, propmode, path):
+        """
+        Builds the template data for a Multi-Status response out of (path, live properties) tuples.
+        """
+        fsprops = [prop for prop in requested if prop in STDPROP]
+        quotaprops = [prop for prop in requested if prop in QUOTAPROP] if propmode == "prop" else []
+        deadprops = [prop for prop in requested if prop not in STDPROP and prop not in LOCKPROP and prop not in QUOTAPROP]
+        lockdiscovery = "D:lockdiscovery" in requested and propmode != "propname"
+        supportedlock = "D:supportedlock" in requested and propmode != "propname"
+
+        # Dead properties of all resources are fetched in one batch
+        dead = {}
+        if deadprops or propmode != "prop":
+            dead = self.fs.get_dead_props(self.user, [resource for resource, props in resources])
+
+        resdata = {}
+        for i in range(0, len(resources), SESSION_BATCH):
+            with self.fs.session(self.user, path):
+                for resource, props in resources[i:i + SESSION_BATCH]:
+                    workingres = resource.lstrip("/")
+                    resdead = dead.get(resource, {})
+                    if propmode == "propname":
+                        found = dict((prop, True) for prop in fsprops + LOCKPROP)
+                        deadfound = [xml_element(prop) for prop in resdead]
+                        missing = []
+                    elif propmode == "allprop":
+                        found = dict((prop, props[prop]) for prop in fsprops if prop in props)
+                        deadfound = [xml_element(prop, value) for prop, value in resdead.items()]
+                        missing = [xml_element(prop) for prop in deadprops if prop not in resdead]
+                    else:
+                        found = dict((prop, props[prop]) for prop in fsprops if prop in props)
+                        deadfound = [xml_element(prop, resdead[prop]) for prop in deadprops if prop in resdead]
+                        missing = [xml_element(prop) for prop in deadprops if prop not in resdead]
+
+                    if quotaprops:
+                        quota = self.fs.get_quota(self.user, resource)
+                        if quota is None:
+                            missing = missing + [xml_element(prop) for prop in quotaprops]
+                        else:
+                            values = {"D:quota-used-bytes": quota[0], "D:quota-available-bytes": quota[1]}
+                            found.update((prop, values[prop]) for prop in quotaprops)
+
+                    lock = None
+                    if lockdiscovery and self.server.locks:
+                        lock = self.server.get_lock(self.fs.get_uid(self.user, resource))
+
+                    resdata[workingres] = {
+                        "found": found,
+                        "dead": deadfound,
+                        "missing": missing + [xml_element(prop) for prop in fsprops if prop not in props],
+                        "status": props.get("D:status", "200 OK"),
+                        "lock": lock,
+                        "lockdiscovery": lockdiscovery,
+                        "supportedlock": supportedlock
+                    }
+
+        return resdata
+
     def do_PROPFIND(self):
+        if self.reject_probe():
+            return
+
         request = PROPFINDRequest(self)
         if self.require_auth(request):
             return
 
         self.log.info(request)
-        
-        data = request.data
-        depth = request.depth
-        
-        try:
-            resqueue = [request.path]
-            resdata = {}
-
-            depthqueue = [request.path]
-            while depth > 0:
-                cpqueue = depthqueue.copy()
-                for res in cpqueue:
-                    workingres = res
-                    for sub in self.server.fs.get_children(self.user, workingres):
-                        resqueue.append(sub)
-                        depthqueue.append(sub)
-                depth = depth-1
 
+        if not request.valid:
+            self.log.debug("400 Bad Request")
+            self.send_response(400, "Bad Request")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
 
-            for resource in resqueue:
-                workingres = resource.lstrip("/")
-                #print(workingres)
-                resdata[workingres] = self.server.fs.get_props(self.user, resource)
-                if request.isexcel:
-                    del resdata[workingres]["D:lastmodified"]
-                    del resdata[workingres]["D:lastaccessed"]
-                    del resdata[workingres]["Z:Win32LastModifiedTime"]
-                    del resdata[workingres]["Z:Win32LastAccessTime"]
+        requested = self.select_props(request.propmode, request.props, request.include, request.isexcel)
 
-                resdata[workingres]["lock"] = self.server.get_lock(self.server.fs.get_uid(self.user, resource))
+        # Only live properties of the filesystem are computed, everything else is looked up as dead property
+        fetch = [prop for prop in requested if prop in STDPROP]
+        if request.depth > 0 and "D:iscollection" not in fetch:
+            fetch = fetch + ["D:iscollection"]
 
-            w = WriteBuffer(self.wfile)
-            w.write(self.server.templates["propfind"].render(resdata=resdata))
+        try:
+            resources = []
+
+            props = self.fs.get_props(self.user, request.path, fetch)
+            resources.append((request.path, props))
+
+            # The fan-out keeps the identity of the user for a batch of collections instead of switching per resource
+            depth = request.depth
+            depthqueue = [request.path] if request.depth > 0 and props["D:iscollection"] else []
+            while depth > 0 and depthqueue:
+                nextqueue = []
+                for i in range(0, len(depthqueue), SESSION_BATCH):
+                    with self.fs.session(self.user, request.path):
+                        for res in depthqueue[i:i + SESSION_BATCH]:
+                            for sub, subprops in self.get_children_props(res, fetch).items():
+                                resources.append((sub, subprops))
+                                if subprops["D:iscollection"]:
+                                    nextqueue.append(sub)
+                depthqueue = nextqueue
+                depth = depth-1
+
+            resdata = self.build_resdata(resources, requested, request.propmode, request.path)
+            body = self.server.templates["propfind"].render(resdata=resdata).encode("utf-8")
 
             self.log.debug("207 Multi-Status")
-            self.send_response(207, "Multi-Status")  # Multi-Status
-            self.send_header("Content-Type", "text/xml")
-            self.send_header("Charset", "utf-8")
-            self.send_header("Content-Length", str(w.getSize()))
-            self.end_headers()
-            w.flush()
+            self.send_body(207, "Multi-Status", body, "text/xml", {"Charset": "utf-8"})
             
         except FileNotFoundError:
             self.log.debug("404 Not Found")
@@ -257,38 +1128,187 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             self.send_response(403, "Forbidden")
             self.end_headers()
 
+    def do_REPORT(self):
+        request = REPORTRequest(self)
+        if self.require_auth(request):
+            return
+
+        self.log.info(request)
+
+        if not request.valid:
+            self.log.debug("400 Bad Request")
+            self.send_response(400, "Bad Request")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if request.report != "sync-collection" or self.server.journal is None:
+            self.log.debug("403 Forbidden")
+            self.send_body(403, "Forbidden", b'<?xml version="1.0" encoding="utf-8" ?>\n<D:error xmlns:D="DAV:"><D:supported-report/></D:error>', "text/xml")
+            return
+
+        self.sync_collection(request)
+
+    def sync_collection(self, request):
+        requested = self.select_props("prop", request.props, [])
+        fetch = [prop for prop in requested if prop in STDPROP]
+        if "D:iscollection" not in fetch:
+            fetch = fetch + ["D:iscollection"]
+
+        try:
+            if not self.fs.get_props(self.user, request.path, ["D:iscollection"])["D:iscollection"]:
+                raise FileNotFoundError()
+
+            resources = []
+            deleted = []
+            if request.synctoken:
+                changes, token = self.server.journal.get_changes(request.path, request.synctoken, request.synclevel == "infinite", self.user)
+                changed = []
+                for path, isdeleted in changes:
+                    if isdeleted:
+                        deleted.append(path.lstrip("/"))
+                    else:
+                        changed.append(path)
+                # Only deletions recorded as such are reported, resources the user can not see are left out
+                for i in range(0, len(changed), SESSION_BATCH):
+                    with self.fs.session(self.user, request.path):
+                        for path in changed[i:i + SESSION_BATCH]:
+                            try:
+                                resources.append((path, self.fs.get_props(self.user, path, fetch)))
+                            except (FileNotFoundError, PermissionError):
+                                pass
+            else:
+                # Initial synchronization, report all members. The token is taken first so no change is missed.
+                token = self.server.journal.current_token()
+                queue = [request.path]
+                while queue:
+                    nextqueue = []
+                    for i in range(0, len(queue), SESSION_BATCH):
+                        with self.fs.session(self.user, request.path):
+                            for res in queue[i:i + SESSION_BATCH]:
+                                for sub, subprops in self.get_children_props(res, fetch).items():
+                                    resources.append((sub, subprops))
+                                    if subprops["D:iscollection"] and request.synclevel == "infinite":
+                                        nextqueue.append(sub)
+                    queue = nextqueue
+
+            resdata = self.build_resdata(resources, requested, "prop", request.path)
+            body = self.server.templates["propfind"].render(resdata=resdata, deleted=deleted, synctoken=token).encode("utf-8")
+
+            self.log.debug("207 Multi-Status")
+            self.send_body(207, "Multi-Status", body, "text/xml", {"Charset": "utf-8"})
+        except InvalidSyncToken:
+            self.log.debug("403 Forbidden (invalid sync token)")
+            self.send_body(403, "Forbidden", b'<?xml version="1.0" encoding="utf-8" ?>\n<D:error xmlns:D="DAV:"><D:valid-sync-token/></D:error>', "text/xml")
+        except FileNotFoundError:
+            self.log.debug("404 Not Found")
+            self.send_response(404, "Not Found")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        except PermissionError:
+            self.log.debug("403 Forbidden")
+            self.send_response(403, "Forbidden")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def do_SEARCH(self):
+        request = SEARCHRequest(self)
+        if self.require_auth(request):
+            return
+
+        self.log.info(request)
+
+        if self.server.search is None:
+            self.log.debug("501 Not Implemented")
+            self.send_response(501, "Not Implemented")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            if not request.valid:
+                raise InvalidQuery("Malformed search request")
+
+            limit = self.server.search_limit
+            if request.limit is not None:
+                limit = min(limit, request.limit)
+            pagesize = max(limit, SESSION_BATCH)
+            paths = self.server.search.search(request.scope, request.scopedepth, request.where, request.orderby, pagesize, self.user)
+        except InvalidQuery as e:
+            self.log.debug("400 Bad Request (%s)" % e)
+            self.send_response(400, "Bad Request")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        requested = self.select_props(request.propmode, request.props, [])
+        fetch = [prop for prop in requested if prop in STDPROP]
+
+        # Hits are looked up as the user, this drops stale entries and everything the user may not access. Further
+        # pages of hits are fetched until the limit is reached or no hits are left.
+        resources = []
+        offset = 0
+        while True:
+            for i in range(0, len(paths), SESSION_BATCH):
+                with self.fs.session(self.user, request.scope):
+                    for path in paths[i:i + SESSION_BATCH]:
+                        if len(resources) >= limit:
+                            break
+                        try:
+                            resources.append((path, self.fs.get_props(self.user, path, fetch)))
+                        except (FileNotFoundError, PermissionError):
+                            pass
+            if len(resources) >= limit or len(paths) < pagesize:
+                break
+            offset += pagesize
+            paths = self.server.search.search(request.scope, request.scopedepth, request.where, request.orderby, pagesize, self.user, offset)
+
+        resdata = self.build_resdata(resources, requested, request.propmode, request.scope)
+        body = self.server.templates["propfind"].render(resdata=resdata).encode("utf-8")
+
+        self.log.debug("207 Multi-Status (%d results)" % len(resources))
+        self.send_body(207, "Multi-Status", body, "text/xml", {"Charset": "utf-8"})
+
     def do_DELETE(self):
         request = DELETERequest(self)
         if self.require_auth(request):
             return
 
         self.log.info(request)
+
+        if request.upload is not None:
+            self.delete_upload(request)
+            return
         
-        uid = self.server.fs.get_uid(self.user, request.path)
-        lock = server.get_lock(uid)
+        uid = self.fs.get_uid(self.user, request.path)
+        lock = self.server.get_lock(uid)
 
-        if lock != None:
-            try:
-                locktoken = request.locktoken
+        if lock != None and lock.token != request.locktoken:
+            # TODO search right status code
+            self.log.debug("423 Locked")
+            self.send_response(423, "Locked")
+            self.end_headers()
+            return
 
-                if lock.token == locktoken:
-                    self.server.fs.delete(self.user, request.path)
-                    server.clear_lock(uid)
-                else:
-                    # TODO search right status code
-                    self.log.debug("423 Locked")
-                    self.send_response(423, "Locked")
-                    self.end_headers()
-                    return
-            except:
-                self.log.debug("No locktoken")
-                self.log.debug("423 Locked")
-                self.send_response(423, "Locked")
-                self.end_headers()
-                return
-        else:
-            self.server.fs.delete(self.user, request.path)
+        try:
+            self.fs.delete(self.user, request.path)
+        except FileNotFoundError:
+            self.log.debug("404 Not Found")
+            self.send_response(404, "Not Found")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+            return
+        except PermissionError:
+            self.log.debug("403 Forbidden")
+            self.send_response(403, "Forbidden")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+            return
+
+        if lock != None:
+            self.server.clear_lock(uid)
 
+        self.notify_change(request.path, deleted=True)
         self.log.debug("204 OK")
         self.send_response(204, "OK")
         self.end_headers()
@@ -301,11 +1321,16 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         self.log.info(request)
         
         try:
-            self.server.fs.create(self.user, request.path, dir=True)
+            self.fs.create(self.user, request.path, dir=True)
+            self.notify_change(request.path)
 
             self.log.debug("201 Created")
             self.send_response(201, "Created")
             self.end_headers()
+        except FileNotFoundError:
+            self.log.debug("409 Conflict")
+            self.send_response(409, "Conflict")
+            self.end_headers()
         except PermissionError:
             self.log.debug("403 Forbidden")
             self.send_response(403, "Forbidden")
@@ -317,28 +1342,130 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             return
 
         self.log.info(request)
-        
-        #self.do_PROPFIND()
 
+        if not request.valid:
+            self.log.debug("400 Bad Request")
+            self.send_response(400, "Bad Request")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        try:
+            self.fs.get_props(self.user, request.path, ["D:iscollection"])
+
+            setprops = {}
+            removeprops = []
+            protected = []
+            names = []
+            for action, name, value in request.operations:
+                names.append(name)
+                if name.startswith("Z:Win32"):
+                    # Windows sets these after every upload, they are acknowledged but the live values are kept
+                    continue
+                elif name in STDPROP or name in LOCKPROP or name in QUOTAPROP:
+                    protected.append(name)
+                elif action == "set":
+                    setprops[name] = value
+                    if name in removeprops:
+                        removeprops.remove(name)
+                else:
+                    setprops.pop(name, None)
+                    removeprops.append(name)
+
+            # Instructions are applied atomically (RFC 4918 9.2)
+            propstats = {}
+            if protected:
+                propstats["403 Forbidden"] = [xml_element(name) for name in protected]
+                propstats["424 Failed Dependency"] = [xml_element(name) for name in names if name not in protected]
+            else:
+                try:
+                    if setprops or removeprops:
+                        self.fs.set_dead_props(self.user, request.path, setprops, removeprops)
+                        self.notify_change(request.path)
+                    propstats["200 OK"] = [xml_element(name) for name in names]
+                except NotImplementedError:
+                    propstats["403 Forbidden"] = [xml_element(name) for name in names]
 
-    def copy_element(self, user, source, dest):
-        #print("Copy element", source, dest)
-        if self.server.fs.get_props(self.user, source, ["D:iscollection"])["D:iscollection"]:
-            self.server.fs.create(self.user, dest)
+            propstats = dict((status, elements) for status, elements in propstats.items() if elements)
+            body = self.server.templates["proppatch"].render(resource=request.path.lstrip("/"), propstats=propstats).encode("utf-8")
 
-            children = self.server.fs.get_children(user, source)
-            base = source
-            for c in children:
-                c_source = "/" + c
-                c_destination = dest + c
-                self.copy_element(user, c_source, c_destination)
-        else:
+            self.log.debug("207 Multi-Status")
+            self.send_body(207, "Multi-Status", body, "text/xml", {"Charset": "utf-8"})
+        except FileNotFoundError:
+            self.log.debug("404 Not Found")
+            self.send_response(404, "Not Found")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        except PermissionError:
+            self.log.debug("403 Forbidden")
+            self.send_response(403, "Forbidden")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    def transfer(self, request, move):
+        if request.destination is None:
+            self.log.debug("400 Bad Request")
+            self.send_response(400, "Bad Request")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+            return
+
+        # A resource can not be moved or copied onto or into itself, the destination would be deleted first
+        source = os.path.normpath(request.path).rstrip("/")
+        destination = os.path.normpath(request.destination).rstrip("/")
+        if destination == source or destination.startswith(source + "/"):
+            self.log.debug("403 Forbidden")
+            self.send_response(403, "Forbidden")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+            return
+
+        try:
+            # The destination is only deleted once the source is known to exist
+            self.fs.get_props(self.user, request.path, ["D:iscollection"])
+
+            exists = True
             try:
-                self.server.fs.get_props(self.user, dest, ["D:iscollection"])["D:iscollection"]
+                self.fs.get_props(self.user, request.destination, ["D:iscollection"])
             except FileNotFoundError:
-                self.server.fs.set_content(self.user, dest, self.server.fs.get_content(self.user, source))
+                exists = False
 
+            if exists:
+                # Overwrite defaults to T when the header is missing (RFC 4918 10.6)
+                if request.headers.get("Overwrite") == "F":
+                    self.log.debug("412 Precondition Failed")
+                    self.send_response(412, "Precondition Failed")
+                    self.send_header('Content-length', '0')
+                    self.end_headers()
+                    return
+                self.fs.delete(self.user, request.destination)
+                self.notify_change(request.destination, deleted=True)
+
+            if move:
+                self.fs.move(self.user, request.path, request.destination)
+                self.notify_change(request.path, deleted=True)
+            else:
+                self.fs.copy(self.user, request.path, request.destination)
+            self.notify_change(request.destination)
 
+            if exists:
+                self.log.debug("204 No-Content")
+                self.send_response(204, "No-Content")
+            else:
+                self.log.debug("201 Created")
+                self.send_response(201, "Created")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+        except FileNotFoundError:
+            self.log.debug("404 Not Found")
+            self.send_response(404, "Not Found")
+            self.send_header('Content-length', '0')
+            self.end_headers()
+        except PermissionError:
+            self.log.debug("403 Forbidden")
+            self.send_response(403, "Forbidden")
+            self.send_header('Content-length', '0')
+            self.end_headers()
 
     def do_MOVE(self):
         request = MOVERequest(self)
@@ -346,14 +1473,8 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             return
 
         self.log.info(request)
-        
-        self.copy_element(self.user, request.path, request.destination)
-        self.server.fs.delete(self.user, request.path)
 
-        self.log.debug("204 No-Content")
-        self.send_response(204, "No-Content")
-        self.send_header('Content-length', '0')
-        self.end_headers()
+        self.transfer(request, move=True)
 
     def do_COPY(self):
         request = COPYRequest(self)
@@ -361,28 +1482,21 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             return
 
         self.log.info(request)
-        
-        self.copy_element(self.user, request.path, request.destination)
 
-        self.log.debug("204 No-Content")
-        self.send_response(204, "No-Content")
-        self.send_header('Content-length', '0')
-        self.end_headers()
-        
+        self.transfer(request, move=False)
 
     def do_LOCK(self):
         request = LOCKRequest(self)
         if self.require_auth(request):
             return
 
-        data = request.data
         self.log.info(request)
         
 
         try:
-            self.server.fs.get_props(self.user, request.path)
+            self.fs.get_props(self.user, request.path)
         except FileNotFoundError:
-            uid = self.server.fs.get_uid(self.user, request.path)
+            uid = self.fs.get_uid(self.user, request.path)
             lock = Lock(uid, request.lockowner, "exclusive", "infinity", "Second-300")
             self.server.set_lock(uid, lock)
             w = WriteBuffer(self.wfile)
@@ -399,8 +1513,8 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
             w.flush()
             return            
 
-        uid = self.server.fs.get_uid(self.user, request.path)
-        lock = server.get_lock(uid)
+        uid = self.fs.get_uid(self.user, request.path)
+        lock = self.server.get_lock(uid)
         if lock == None:
             lock = Lock(uid, request.lockowner, "exclusive", "infinity", "Second-300")
             self.server.set_lock(uid, lock)
@@ -428,17 +1542,16 @@ class WebDAVRequestHandler(BaseHTTPRequestHandler):
         if self.require_auth(request):
             return
 
-        data = request.data
         self.log.info(request)
         
         locktoken = request.locktoken
 
-        uid = self.server.fs.get_uid(self.user, request.path)
+        uid = self.fs.get_uid(self.user, request.path)
 
-        if not server.get_lock(uid) is None:
-            lock = server.get_lock(uid)
+        if not self.server.get_lock(uid) is None:
+            lock = self.server.get_lock(uid)
             if lock.token == locktoken:
-                server.clear_lock(uid)
+                self.server.clear_lock(uid)
 
                 self.log.debug("200 OK")
                 self.send_response(200, "OK")
@@ -461,5 +1574,21 @@ if __name__ == "__main__":
     root_logger.setLevel(config_loglevel())
     root_logger.addHandler(SystemdHandler())
 
-    server = WebDAVServer(("", config_port()), WebDAVRequestHandler)
-    server.serve_forever()
+    # Set by a process handing over to this one, see WebDAVServer.restart()
+    inherited = os.environ.pop("ORBIT_WEBDAVD_FD", None)
+    state = os.environ.pop("ORBIT_WEBDAVD_STATE", None)
+    ready = os.environ.pop("ORBIT_WEBDAVD_READY", None)
+
+    server = WebDAVServer(("", config_port()), WebDAVRequestHandler, listen_fd=int(inherited) if inherited else None)
+    if state:
+        server.load_state(state)
+
+    # SIGHUP reloads the configuration, SIGUSR2 restarts with the current code
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=server.reload, name="Reload").start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=server.restart, name="Restart").start())
+
+    if ready:
+        os.write(int(ready), b"1")
+        os.close(int(ready))
+    sd_notify("READY=1\nMAINPID=%d" % os.getpid())
+    server.serve()
@@ -1,5 +1,4 @@
-import random, logging, sys, io, time
-from jinja2 import Template
+import random, logging, sys, io, os, socket, threading, time, zlib
 
 class Lock(object):
     def __init__(self, uid, owner, mode, depth, timeout):
@@ -39,6 +38,23 @@ class SystemdHandler(logging.Handler):
         except Exception:
             self.handleError(record)
 
+def sd_notify(message):
+    """
+    Sends message to the service manager (sd_notify protocol), nothing happens when not started by systemd.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+        try:
+            s.sendto(message.encode("utf-8"), address)
+        except OSError:
+            pass
+
+
 class WriteBuffer:
     def __init__(self, w):
         self.w = w
@@ -56,6 +72,101 @@ class WriteBuffer:
     def getSize(self):
         return len(self.buf.getvalue())
 
+def accepts_encoding(header, encoding):
+    """
+    Checks whether an Accept-Encoding header value allows the given content coding.
+    """
+    if not header:
+        return False
+
+    for entry in header.split(","):
+        parts = entry.strip().split(";")
+        if parts[0].strip().lower() not in (encoding, "*"):
+            continue
+
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+
+    return False
+
+# Content codings supported for responses with their zlib window bits
+ENCODINGS = {
+    "gzip": 31,
+    "deflate": 15
+}
+
+COMPRESSIBLE_TYPES = ("text/", "application/xml", "application/json", "application/javascript", "application/xhtml+xml", "image/svg+xml")
+
+
+def negotiate_encoding(header):
+    for encoding in ENCODINGS:
+        if accepts_encoding(header, encoding):
+            return encoding
+
+    return "identity"
+
+
+def is_compressible(ctype):
+    return bool(ctype) and ctype.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressingWriter:
+    """
+    Compresses everything written to it on the fly and passes the compressed data to w.
+    """
+    def __init__(self, w, encoding, level=6):
+        self.w = w
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+        self.size = 0
+
+    def write(self, s):
+        if isinstance(s, str):
+            s = s.encode("utf-8")
+
+        data = self.compressor.compress(s)
+        if data:
+            self.w.write(data)
+            self.size += len(data)
+
+    def flush(self):
+        data = self.compressor.flush()
+        self.w.write(data)
+        self.size += len(data)
+        self.w.flush()
+
+    def getSize(self):
+        return self.size
+
+
+def xml_element(name, value=None):
+    """
+    Returns an XML element for a property name with value (an XML string) as content, or an empty element if value
+    is None. Names in Clark notation ({namespace}name) declare their namespace.
+    """
+    if name.startswith("{"):
+        namespace, _, local = name[1:].partition("}")
+        tag = "X:" + local
+        declaration = ' xmlns:X="%s"' % namespace.replace("&", "&amp;").replace('"', "&quot;").replace("<", "&lt;")
+    else:
+        tag = name
+        declaration = ""
+
+    if value is None:
+        return "<%s%s/>" % (tag, declaration)
+    return "<%s%s>%s</%s>" % (tag, declaration, value, tag)
+
+
 def unixdate2iso8601(d):
     tz = time.timezone / 3600 # can it be fractional?
     tz = '%+03d' % tz
@@ -65,11 +176,33 @@ def unixdate2httpdate(d):
     return time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(d))
 
 def get_template(filename):
+    # jinja2 takes longer to import than everything else, it is only loaded once the first template is needed
+    from jinja2 import Template
+
     with open(filename) as file_:
         template = Template(file_.read(), trim_blocks=True, lstrip_blocks=True)
 
     return template
 
+
+class Templates(object):
+    """
+    Templates by name, each one is read and compiled when it is first used.
+    """
+    def __init__(self, filenames):
+        self.filenames = dict((name, os.path.abspath(filename)) for name, filename in filenames.items())
+        self.templates = {}
+        self.mutex = threading.Lock()
+
+    def __getitem__(self, name):
+        template = self.templates.get(name)
+        if template is None:
+            with self.mutex:
+                if name not in self.templates:
+                    self.templates[name] = get_template(self.filenames[name])
+                template = self.templates[name]
+        return template
+
 # Join two (or more) paths.
 def path_join(patha, pathb):
     patha = patha.rstrip("/")
@@ -77,6 +210,11 @@ def path_join(patha, pathb):
     return patha + "/" + pathb
 
 
+# Split a path into its non-empty segments.
+def split_path(path):
+    return [segment for segment in path.split("/") if segment]
+
+
 def remove_prefix(text, prefix):
     if text.startswith(prefix):
         return text[len(prefix):]
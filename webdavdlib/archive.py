@@ -0,0 +1,292 @@
+import email.utils, logging, shutil, tarfile, tempfile, time, zipfile
+from webdavdlib.filesystems import QuotaExceeded
+
+ARCHIVEPROP = ["D:iscollection", "D:getcontentlength", "D:getlastmodified", "D:getcontenttype"]
+
+# Content types which are compressed already, ZIP archives store them without deflating them again
+COMPRESSED_TYPES = ("image/jpeg", "image/png", "image/gif", "image/webp", "video/", "audio/", "application/zip", "application/gzip",
+                    "application/x-gzip", "application/x-bzip2", "application/x-xz", "application/x-7z-compressed", "application/x-rar-compressed",
+                    "application/vnd.openxmlformats-officedocument.", "application/vnd.oasis.opendocument.", "application/pdf")
+
+log = logging.getLogger("Archive")
+
+
+def walk(fs, user, root):
+    """
+    Yields (path, props) of all resources below root. Only the collections still to be visited are kept in memory.
+    """
+    pending = [root]
+    while pending:
+        path = pending.pop()
+        try:
+            children = fs.get_children_props(user, path, ARCHIVEPROP)
+        except (FileNotFoundError, PermissionError):
+            log.warning("Skipping %s, it can not be listed" % path)
+            continue
+
+        for child in sorted(children.keys(), reverse=True):
+            if children[child]["D:iscollection"]:
+                pending.append(child)
+
+        for child in sorted(children.keys()):
+            yield child, children[child]
+
+
+def get_mtime(props):
+    parsed = email.utils.parsedate_tz(props.get("D:getlastmodified") or "")
+    if parsed is None:
+        return time.time()
+    return email.utils.mktime_tz(parsed)
+
+
+def open_content(fs, user, path):
+    # The file is opened before its header is written, so unreadable files can be left out of the archive
+    try:
+        return fs.iter_content(user, path)
+    except (FileNotFoundError, PermissionError, IsADirectoryError):
+        log.warning("Skipping %s, it can not be read" % path)
+        return None
+
+
+class BufferedStream(object):
+    """
+    Collects the many small writes of zipfile and tarfile before they are passed to the unseekable stream w.
+    """
+    def __init__(self, w, size=65536):
+        self.w = w
+        self.size = size
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buf.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buf:
+            self.w.write(b"".join(self.buf))
+            self.buf = []
+            self.buffered = 0
+        self.w.flush()
+
+
+class ChunkReader(object):
+    """
+    File-like object reading from an iterator of byte chunks (see Filesystem.iter_content).
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buf = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+
+        if size < 0:
+            data, self.buf = self.buf, b""
+        else:
+            data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+def write_zip(fs, user, root, name, w):
+    """
+    Writes a ZIP archive of the collection root to the unseekable stream w. Entries are placed in a folder called name.
+    Sizes and checksums follow each entry in data descriptors, entries and archives beyond 4 GiB use ZIP64.
+    """
+    stream = BufferedStream(w)
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+        for path, props in walk(fs, user, root):
+            arcname = name + path[len(root.rstrip("/")):]
+            date = time.localtime(max(get_mtime(props), 315532800))[:6]
+
+            if props["D:iscollection"]:
+                info = zipfile.ZipInfo(arcname + "/", date)
+                info.external_attr = (0o40755 << 16) | 0x10
+                archive.writestr(info, b"")
+                continue
+
+            chunks = open_content(fs, user, path)
+            if chunks is None:
+                continue
+
+            info = zipfile.ZipInfo(arcname, date)
+            info.external_attr = 0o100644 << 16
+            ctype = props.get("D:getcontenttype") or ""
+            info.compress_type = zipfile.ZIP_STORED if ctype.startswith(COMPRESSED_TYPES) else zipfile.ZIP_DEFLATED
+
+            with archive.open(info, "w", force_zip64=props["D:getcontentlength"] >= zipfile.ZIP64_LIMIT) as f:
+                for chunk in chunks:
+                    f.write(chunk)
+    stream.flush()
+
+
+def write_tar(fs, user, root, name, w):
+    """
+    Writes a tar archive (pax format, no size or name limits) of the collection root to the unseekable stream w.
+    """
+    stream = BufferedStream(w)
+    with tarfile.open(fileobj=stream, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+        for path, props in walk(fs, user, root):
+            info = tarfile.TarInfo(name + path[len(root.rstrip("/")):])
+            info.mtime = get_mtime(props)
+
+            if props["D:iscollection"]:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                archive.addfile(info)
+                continue
+
+            chunks = open_content(fs, user, path)
+            if chunks is None:
+                continue
+
+            # The size has to be known in advance, a file growing meanwhile is cut at the listed size
+            info.mode = 0o644
+            info.size = props["D:getcontentlength"]
+            archive.addfile(info, ChunkReader(chunks))
+    stream.flush()
+
+
+def safe_name(name):
+    """
+    Normalizes the name of an archive member to a relative path. Returns None for names leaving the collection.
+    """
+    parts = []
+    for part in name.replace("\\", "/").split("/"):
+        if part in ("", "."):
+            continue
+        if part == "..":
+            return None
+        parts.append(part)
+    return "/".join(parts) or None
+
+
+class LimitedReader(object):
+    """
+    Reads at most length bytes from stream, the remaining data of the connection is never touched.
+    """
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class Extractor(object):
+    """
+    Stores the members of an uploaded archive below the collection root through the Filesystem API, so permissions
+    and path checks of the filesystem apply to every member.
+    """
+    def __init__(self, fs, user, root, chunksize=1048576, notify=None):
+        self.fs = fs
+        self.user = user
+        self.root = root.rstrip("/")
+        self.chunksize = chunksize
+        self.notify = notify
+        self.results = []
+        self.directories = set([self.root])
+
+    def target(self, name):
+        name = safe_name(name)
+        if name is None:
+            return None
+        return self.root + "/" + name
+
+    def make_dirs(self, path):
+        if path in self.directories:
+            return
+
+        try:
+            if not self.fs.get_props(self.user, path, ["D:iscollection"])["D:iscollection"]:
+                raise NotADirectoryError()
+        except FileNotFoundError:
+            self.make_dirs(path.rpartition("/")[0])
+            self.fs.create(self.user, path, dir=True)
+            self.results.append((path, "201 Created"))
+            if self.notify is not None:
+                self.notify(path)
+        self.directories.add(path)
+
+    def add(self, name, isdir, reader=None):
+        path = self.target(name)
+        if path is None:
+            self.results.append((self.root + "/" + name.lstrip("/"), "403 Forbidden"))
+            return
+
+        try:
+            if isdir:
+                self.make_dirs(path)
+                return
+
+            self.make_dirs(path.rpartition("/")[0])
+            exists = True
+            try:
+                self.fs.get_props(self.user, path, ["D:iscollection"])
+            except FileNotFoundError:
+                exists = False
+
+            offset = -1
+            while True:
+                data = reader.read(self.chunksize)
+                if not data:
+                    break
+                self.fs.set_content(self.user, path, data, offset)
+                offset = max(offset, 0) + len(data)
+            if offset == -1:
+                self.fs.set_content(self.user, path, b"")
+
+            self.results.append((path, "204 No Content" if exists else "201 Created"))
+            if self.notify is not None:
+                self.notify(path)
+        except PermissionError:
+            self.results.append((path, "403 Forbidden"))
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError, FileExistsError):
+            self.results.append((path, "409 Conflict"))
+        except QuotaExceeded:
+            self.results.append((path, "507 Insufficient Storage"))
+
+    def extract_tar(self, stream):
+        # Members are read in order from the stream, nothing is buffered besides the current chunk
+        with tarfile.open(fileobj=stream, mode="r|*") as archive:
+            for member in archive:
+                if member.isdir():
+                    self.add(member.name, True)
+                elif member.isfile():
+                    self.add(member.name, False, archive.extractfile(member))
+                else:
+                    # Links and special files could point outside of the collection
+                    self.results.append((self.root + "/" + member.name.lstrip("/"), "403 Forbidden"))
+
+    def extract_zip(self, stream, spool=16 * 1024 * 1024):
+        # The member list of a ZIP archive is at its end, so the upload is spooled to a temporary file first
+        with tempfile.SpooledTemporaryFile(spool) as f:
+            shutil.copyfileobj(stream, f, self.chunksize)
+            f.seek(0)
+
+            with zipfile.ZipFile(f) as archive:
+                for info in archive.infolist():
+                    if info.is_dir():
+                        self.add(info.filename, True)
+                    elif (info.external_attr >> 16) & 0o170000 == 0o120000:
+                        self.results.append((self.root + "/" + info.filename.lstrip("/"), "403 Forbidden"))
+                    else:
+                        with archive.open(info) as member:
+                            self.add(info.filename, False, member)
+
+
+ARCHIVES = {
+    "zip": (write_zip, "application/zip"),
+    "tar": (write_tar, "application/x-tar")
+}
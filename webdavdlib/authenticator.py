@@ -1,8 +1,19 @@
+import importlib.util, logging, multiprocessing, threading
+from queue import Queue, Empty
+
+
+class AuthenticatorUnavailable(Exception):
+    pass
+
+
 
 class Authenticator(object):
     def authenticate(self, username, password):
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
 class DebugAuthenticator(Authenticator):
     def authenticate(self, username, password):
         if username == password:
@@ -23,10 +34,92 @@ class StaticAuthenticator(Authenticator):
 
         return True
 
-class PAMAuthenticator(Authenticator):
-    def __init__(self):
-        import pam
-        self.p = pam.pam()
+def pam_worker(conn, service):
+    import pam
+    p = pam.pam()
+    while True:
+        try:
+            username, password = conn.recv()
+        except EOFError:
+            return
+        conn.send(bool(p.authenticate(username, password, service=service)))
+
+
+class ProcessAuthenticator(Authenticator):
+    """
+    Runs worker(conn, *args) in a pool of helper processes, each receiving (username, password) tuples from conn and
+    answering with the outcome. Helpers not answering within timeout are killed and replaced. When all helpers are
+    busy and queue requests are waiting already, AuthenticatorUnavailable is raised right away.
+    """
+    log = logging.getLogger("ProcessAuthenticator")
+
+    def __init__(self, worker, args=(), workers=2, queue=8, timeout=10):
+        self.worker = worker
+        self.args = args
+        self.timeout = timeout
+
+        # Helpers are forked from a clean server process, not from the threaded daemon
+        self.context = multiprocessing.get_context("forkserver")
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.idle = Queue()
+        for i in range(workers):
+            self.idle.put(self.spawn())
+
+    def spawn(self):
+        conn, child = self.context.Pipe()
+        process = self.context.Process(target=self.worker, args=(child,) + tuple(self.args), daemon=True)
+        process.start()
+        child.close()
+        return process, conn
 
     def authenticate(self, username, password):
-        return self.p.authenticate(username, password, service="system-auth")
+        if not self.slots.acquire(blocking=False):
+            self.log.warning("Authentication backend saturated")
+            raise AuthenticatorUnavailable()
+
+        try:
+            try:
+                process, conn = self.idle.get(timeout=self.timeout)
+            except Empty:
+                self.log.warning("No authentication helper available within %s seconds" % self.timeout)
+                raise AuthenticatorUnavailable()
+
+            try:
+                conn.send((username, password))
+                if conn.poll(self.timeout):
+                    result = conn.recv()
+                    self.idle.put((process, conn))
+                    return result
+                self.log.warning("Authentication of %s did not finish within %s seconds" % (username, self.timeout))
+            except (EOFError, OSError):
+                self.log.warning("Authentication helper %d died" % process.pid)
+
+            process.kill()
+            process.join()
+            conn.close()
+            self.idle.put(self.spawn())
+            raise AuthenticatorUnavailable()
+        finally:
+            self.slots.release()
+
+    def close(self):
+        # Helpers return once their pipe is closed
+        while True:
+            try:
+                process, conn = self.idle.get_nowait()
+            except Empty:
+                break
+            conn.close()
+            process.join(self.timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+class PAMAuthenticator(ProcessAuthenticator):
+    def __init__(self, service="system-auth", workers=2, queue=8, timeout=10):
+        # The pam module is not thread safe and blocks for as long as the backend (LDAP, Kerberos) takes,
+        # conversations run in helper processes instead. It is only imported there.
+        if importlib.util.find_spec("pam") is None:
+            raise ImportError("PAMAuthenticator requires the pam module")
+        ProcessAuthenticator.__init__(self, pam_worker, (service,), workers, queue, timeout)
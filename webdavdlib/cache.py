@@ -0,0 +1,129 @@
+import collections, logging, threading, time
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping bounded by the number of entries. The least recently used entry is evicted when
+    the cache is full. Entries optionally expire after ttl seconds.
+    """
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.mutex = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.mutex:
+            try:
+                expires, value = self.entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        with self.mutex:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.mutex:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            return entry[1]
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ContentCache(object):
+    """
+    Thread-safe cache of file contents bounded by the total number of bytes. Entries are keyed by the resolved
+    path and only returned while (inode, size, mtime) of a fresh stat still match. The cache does not check
+    permissions, callers have to make sure the requesting user may read the file before using a cached entry.
+    """
+    log = logging.getLogger("ContentCache")
+
+    def __init__(self, maxbytes=64 * 1024 * 1024, maxfilesize=256 * 1024):
+        self.maxbytes = maxbytes
+        self.maxfilesize = maxfilesize
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.mutex = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, st):
+        return st.st_size <= self.maxfilesize
+
+    def get(self, path, st):
+        with self.mutex:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != (st.st_ino, st.st_size, st.st_mtime_ns):
+                self.misses += 1
+                if (self.hits + self.misses) % 10000 == 0:
+                    self.log.debug(self.stats())
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return entry[1]
+
+    def set(self, path, st, data):
+        if len(data) > self.maxfilesize or len(data) != st.st_size:
+            return
+
+        with self.mutex:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self.entries[path] = ((st.st_ino, st.st_size, st.st_mtime_ns), data)
+            self.size += len(data)
+            while self.size > self.maxbytes:
+                key, (validator, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def pop(self, path):
+        with self.mutex:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,125 @@
+import hashlib, hmac, json, logging, os, re, threading, time
+from urllib.parse import urlsplit, unquote, parse_qs
+
+# Headers recorded with their value, all others are recorded by name only (Authorization, Cookie, If, Lock-Token, ...)
+SAFE_HEADERS = set(["depth", "overwrite", "content-length", "content-range", "content-type", "range", "accept-encoding",
+                    "translate", "brief", "user-agent", "connection"])
+
+# Query parameters recorded with their value, the values of all others are replaced like names
+SAFE_QUERY = ("archive", "extract", "page")
+
+# Names clients probe for on their own, they are recorded as they are because they tell the clients apart
+KNOWN_NAMES = ("desktop.ini", "thumbs.db", ".ds_store", "autorun.inf", "folder.jpg", "folder.gif", ".hidden", ".localized",
+               ".directory", ".trash", ".trashes", ".spotlight-v100", ".metadata_never_index", ".ql_disablethumbnails")
+
+# Prefixes of lock and metadata files (AppleDouble, Office, LibreOffice), kept in front of the replaced name
+PREFIXES = ("._", "~$", ".~lock.", ".")
+
+EXTENSION = re.compile(r"\.([A-Za-z0-9]{1,8})$")
+
+
+class TrafficRecorder(object):
+    """
+    Appends the requests handled by the daemon as JSON lines to filename, for webdavdlib.replay. Names, users and
+    clients are replaced by hashes keyed with a random key that is never stored, so requests for the same resource
+    still refer to the same name. Prefixes and extensions of names are kept. Credentials, other header values and
+    bodies are never recorded, only their presence and size.
+    """
+    log = logging.getLogger("TrafficRecorder")
+
+    def __init__(self, filename):
+        self.key = os.urandom(32)
+        self.mutex = threading.Lock()
+        self.started = time.monotonic()
+
+        # Opened once, request threads may run with the identity of the user later on
+        self.file = open(filename, "a", buffering=1)
+        self.log.info("Capturing requests to %s" % filename)
+
+    def token(self, value):
+        return hmac.new(self.key, value.encode("utf-8", "surrogateescape"), hashlib.sha256).hexdigest()[:12]
+
+    def shape_name(self, name):
+        if not name or name == "*" or name.lower() in KNOWN_NAMES:
+            return name
+
+        prefix = ""
+        for candidate in PREFIXES:
+            if name.startswith(candidate) and len(name) > len(candidate):
+                prefix = candidate
+                break
+
+        match = EXTENSION.search(name[len(prefix):])
+        extension = match.group(0) if match is not None else ""
+        return "%sn%s%s" % (prefix, self.token(name), extension)
+
+    def shape_path(self, path):
+        return "/".join(self.shape_name(segment) for segment in path.split("/"))
+
+    def shape_query(self, query):
+        shaped = {}
+        for key, values in parse_qs(query, keep_blank_values=True).items():
+            value = values[0]
+            if key not in SAFE_QUERY and value:
+                value = self.token(value)
+            shaped[key if key in SAFE_QUERY else self.shape_name(key)] = value
+        return shaped
+
+    def shape_headers(self, headers):
+        shaped = {}
+        for name, value in headers.items():
+            if name.lower() == "destination":
+                shaped[name] = self.shape_path(unquote(urlsplit(value).path))
+            elif name.lower() in SAFE_HEADERS:
+                shaped[name] = value
+            else:
+                shaped[name] = None
+        return shaped
+
+    def record(self, method, path, headers, client, user, status, size, start, duration):
+        """
+        Records a handled request.
+
+        :param method: request method
+        :param path: request target as sent by the client (quoted, with query)
+        :param headers: request headers
+        :param client: address of the client
+        :param user: authenticated user or None
+        :param status: status code sent or None when the connection was closed without a response
+        :param size: Content-Length of the response or None
+        :param start: time.monotonic() when the request was received
+        :param duration: seconds spent handling the request
+        """
+        url = urlsplit(path)
+        entry = {
+            "time": round(start - self.started, 6),
+            "duration": round(duration, 6),
+            "client": self.token(client),
+            "user": self.token(user) if user is not None else None,
+            "method": method,
+            "path": self.shape_path(unquote(url.path)),
+            "query": self.shape_query(url.query),
+            "headers": self.shape_headers(headers),
+            "status": status,
+            "size": size
+        }
+        line = json.dumps(entry, separators=(",", ":"))
+
+        with self.mutex:
+            try:
+                self.file.write(line + "\n")
+            except OSError:
+                self.log.exception("Failed to record request")
+
+
+def load(filename):
+    """
+    Reads the requests recorded by a TrafficRecorder, ordered by the time they were received.
+    """
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+    entries.sort(key=lambda entry: entry["time"])
+    return entries
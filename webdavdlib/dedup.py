@@ -0,0 +1,331 @@
+import hashlib, logging, os, sqlite3, tempfile
+from webdavdlib.filesystems import Filesystem, STDPROP, lock
+from webdavdlib.properties import Transaction
+
+
+class ContentStore(object):
+    """
+    Content addressed store of fixed size chunks with reference counting. Files are lists of chunk hashes keyed by
+    the uid of the resource (see Filesystem.get_uid), a chunk stored by several files is kept once.
+
+    The store is accessed with the identity of the daemon. All operations take the global filesystem lock, so no
+    operator has switched the identity meanwhile. The directory should only be accessible by the daemon.
+    """
+    log = logging.getLogger("ContentStore")
+
+    def __init__(self, directory, chunksize=1048576):
+        self.directory = directory
+        self.chunksize = chunksize
+        os.makedirs(os.path.join(directory, "objects"), mode=0o700, exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(directory, "store.sqlite"), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (uid TEXT PRIMARY KEY, size INTEGER NOT NULL, hash TEXT NOT NULL, chunks TEXT NOT NULL)")
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def get(self, uids):
+        """
+        Get the manifests of several files.
+
+        :return: dict of uid -> (size, content hash, list of chunk hashes), files not in the store are left out
+        """
+        files = {}
+        uids = list(uids)
+        lock.acquire()
+        try:
+            for i in range(0, len(uids), 500):
+                batch = uids[i:i + 500]
+                for uid, size, digest, chunks in self.db.execute("SELECT uid, size, hash, chunks FROM files WHERE uid IN (%s)" % ",".join("?" * len(batch)), batch):
+                    files[uid] = (size, digest, chunks.split())
+        finally:
+            lock.release()
+        return files
+
+    def put(self, data):
+        # Identical chunks are detected here, only the reference count of a known chunk is increased
+        digest = hashlib.sha256(data).hexdigest()
+        if self.db.execute("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", (digest,)).rowcount:
+            return digest
+
+        path = self.object_path(digest)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(temp, path)
+
+        self.db.execute("INSERT INTO chunks (hash, size, refs) VALUES (?, ?, 1)", (digest, len(data)))
+        return digest
+
+    def release(self, digests):
+        """
+        Drops one reference to each of digests. Returns the chunks no longer referenced, their objects are removed
+        with unlink() once the transaction is committed.
+        """
+        self.db.executemany("UPDATE chunks SET refs = refs - 1 WHERE hash = ?", [(digest,) for digest in digests])
+        unused = []
+        for digest in set(digests):
+            row = self.db.execute("SELECT refs FROM chunks WHERE hash = ?", (digest,)).fetchone()
+            if row is not None and row[0] <= 0:
+                self.db.execute("DELETE FROM chunks WHERE hash = ?", (digest,))
+                unused.append(digest)
+        return unused
+
+    def unlink(self, digests):
+        for digest in digests:
+            try:
+                os.unlink(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def read_chunk(self, digest):
+        lock.acquire()
+        try:
+            with open(self.object_path(digest), "rb") as f:
+                return f.read()
+        finally:
+            lock.release()
+
+    def read(self, manifest, start=-1, end=-1):
+        return b"".join(self.iter(manifest, start, end))
+
+    def iter(self, manifest, start=-1, end=-1, chunksize=None):
+        size, _, chunks = manifest
+        start = max(start, 0)
+        end = size if end == -1 else min(end, size)
+
+        index = start // self.chunksize
+        pos = index * self.chunksize
+        while pos < end:
+            data = self.read_chunk(chunks[index])
+            part = data[max(start - pos, 0):end - pos]
+            for i in range(0, len(part), chunksize or len(part)):
+                yield part[i:i + (chunksize or len(part))]
+            pos += len(data)
+            index += 1
+
+    def write(self, uid, content, start=-1):
+        """
+        Writes content into the file uid beginning at offset start, -1 replaces the whole content. Writes aligned to
+        the chunk size (like the chunks of a streamed PUT body) are hashed and stored without reading anything back.
+        """
+        content = bytes(content)
+        lock.acquire()
+        try:
+            with Transaction(self.db):
+                size, chunks = 0, []
+                row = self.db.execute("SELECT size, chunks FROM files WHERE uid = ?", (uid,)).fetchone()
+                if row is not None:
+                    size, chunks = row[0], row[1].split()
+
+                if start == -1:
+                    first, last, lo, buf = 0, len(chunks), 0, content
+                    size = len(content)
+                else:
+                    # The chunks from the old end (gaps are filled with zeros) or from start on are rewritten
+                    end = start + len(content)
+                    lo = min(start, size) // self.chunksize * self.chunksize
+                    first = lo // self.chunksize
+                    last = min(len(chunks), (end + self.chunksize - 1) // self.chunksize)
+                    buf = bytearray()
+                    for digest in chunks[first:last]:
+                        with open(self.object_path(digest), "rb") as f:
+                            buf += f.read()
+                    if len(buf) < start - lo:
+                        buf.extend(bytes(start - lo - len(buf)))
+                    buf[start - lo:end - lo] = content
+                    size = max(size, end)
+
+                # New chunks are stored before the replaced ones are released, so unchanged chunks are kept
+                new = [self.put(bytes(buf[i:i + self.chunksize])) for i in range(0, len(buf), self.chunksize)]
+                old = chunks[first:last]
+                chunks[first:last] = new
+                unused = self.release(old)
+
+                digest = hashlib.sha256(("%d %s" % (size, " ".join(chunks))).encode("ascii")).hexdigest()
+                self.db.execute("INSERT OR REPLACE INTO files (uid, size, hash, chunks) VALUES (?, ?, ?, ?)", (uid, size, digest, " ".join(chunks)))
+            self.unlink(unused)
+        finally:
+            lock.release()
+
+    def select(self, uid):
+        return self.db.execute("SELECT uid, size, hash, chunks FROM files WHERE uid = ? OR substr(uid, 1, ?) = ?", (uid, len(uid) + 1, uid + "/")).fetchall()
+
+    def _delete(self, uid):
+        rows = self.select(uid)
+        self.db.execute("DELETE FROM files WHERE uid = ? OR substr(uid, 1, ?) = ?", (uid, len(uid) + 1, uid + "/"))
+        return self.release([digest for row in rows for digest in row[3].split()])
+
+    def delete(self, uid):
+        """
+        Deletes the file uid and all files below it.
+        """
+        lock.acquire()
+        try:
+            with Transaction(self.db):
+                unused = self._delete(uid)
+            self.unlink(unused)
+        finally:
+            lock.release()
+
+    def copy(self, source, dest):
+        """
+        Copies the file source and all files below it to dest. Only references are added, no content is copied.
+        """
+        lock.acquire()
+        try:
+            with Transaction(self.db):
+                # References are added first, chunks shared with a replaced destination are kept
+                rows = self.select(source)
+                self.db.executemany("UPDATE chunks SET refs = refs + 1 WHERE hash = ?", [(digest,) for row in rows for digest in row[3].split()])
+                unused = self._delete(dest)
+                self.db.executemany("INSERT INTO files (uid, size, hash, chunks) VALUES (?, ?, ?, ?)",
+                                    [(dest + uid[len(source):], size, digest, chunks) for uid, size, digest, chunks in rows])
+            self.unlink(unused)
+        finally:
+            lock.release()
+
+    def move(self, source, dest):
+        lock.acquire()
+        try:
+            with Transaction(self.db):
+                unused = self._delete(dest)
+                self.db.execute("UPDATE files SET uid = ? || substr(uid, ?) WHERE uid = ? OR substr(uid, 1, ?) = ?",
+                                (dest, len(source) + 1, source, len(source) + 1, source + "/"))
+            self.unlink(unused)
+        finally:
+            lock.release()
+
+    def stats(self):
+        lock.acquire()
+        try:
+            files, logical = self.db.execute("SELECT count(*), coalesce(sum(size), 0) FROM files").fetchone()
+            chunks, stored = self.db.execute("SELECT count(*), coalesce(sum(size), 0) FROM chunks").fetchone()
+        finally:
+            lock.release()
+        return {"files": files, "logical_bytes": logical, "chunks": chunks, "stored_bytes": stored}
+
+
+class DedupFilesystem(Filesystem):
+    """
+    Stores the content of files written through it in a ContentStore. The wrapped filesystem (e.g. a HomeFilesystem)
+    still holds names, collections and permissions, its files are empty placeholders checked as the user before the
+    store is accessed. Files written before the store was added are served from the wrapped filesystem until they
+    are written again.
+
+    COPY only adds references to the chunks, ETags are the hash of the content.
+    """
+    log = logging.getLogger("DedupFilesystem")
+
+    def __init__(self, fs, store):
+        self.fs = fs
+        self.store = store
+
+    def get_manifest(self, user, path):
+        uid = self.fs.get_uid(user, path)
+        return self.store.get([uid]).get(uid)
+
+    def apply_manifest(self, propdata, manifest):
+        if manifest is None:
+            return propdata
+        if "D:getcontentlength" in propdata:
+            propdata["D:getcontentlength"] = manifest[0]
+        if "D:getetag" in propdata:
+            propdata["D:getetag"] = "\"%s\"" % manifest[1]
+        return propdata
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        propdata = self.fs.get_props(user, path, props, orig_path)
+        return self.apply_manifest(propdata, self.get_manifest(user, path))
+
+    def get_children(self, user, path):
+        return self.fs.get_children(user, path)
+
+    def get_children_props(self, user, path, props=STDPROP):
+        children = self.fs.get_children_props(user, path, props)
+
+        # uids of the children are derived from the uid of the collection, the manifests are one query
+        base = self.fs.get_uid(user, path).rstrip("/")
+        uids = dict((child, base + "/" + child.rstrip("/").rpartition("/")[2]) for child in children)
+        manifests = self.store.get(uids.values())
+        for child, propdata in children.items():
+            self.apply_manifest(propdata, manifests.get(uids[child]))
+        return children
+
+    def get_content(self, user, path, start=-1, end=-1):
+        # Reading nothing checks the permissions of the user
+        self.fs.get_content(user, path, 0, 0)
+        manifest = self.get_manifest(user, path)
+        if manifest is None:
+            return self.fs.get_content(user, path, start, end)
+        return self.store.read(manifest, start, end)
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        self.fs.get_content(user, path, 0, 0)
+        manifest = self.get_manifest(user, path)
+        if manifest is None:
+            return self.fs.iter_content(user, path, start, end, chunksize)
+        return self.store.iter(manifest, start, end, chunksize)
+
+    def set_content(self, user, path, content, start=-1):
+        uid = self.fs.get_uid(user, path)
+        manifest = self.store.get([uid]).get(uid)
+
+        # Partial writes to files from before the store need their old content first, the empty write checks the
+        # permissions of the user before
+        if manifest is None and start != -1:
+            self.fs.set_content(user, path, b"", 0)
+            offset = 0
+            for data in self.fs.iter_content(user, path, chunksize=self.store.chunksize):
+                self.store.write(uid, data, offset)
+                offset += len(data)
+
+        # Creates or truncates the placeholder as the user, which also checks the permissions
+        self.fs.set_content(user, path, b"")
+        self.store.write(uid, content, start)
+
+    def create(self, user, path, dir=True):
+        return self.fs.create(user, path, dir)
+
+    def delete(self, user, path):
+        uid = self.fs.get_uid(user, path)
+        self.fs.delete(user, path)
+        self.store.delete(uid)
+
+    def copy(self, user, source, dest):
+        self.fs.copy(user, source, dest)
+        self.store.copy(self.fs.get_uid(user, source), self.fs.get_uid(user, dest))
+
+    def move(self, user, source, dest):
+        uid = self.fs.get_uid(user, source)
+        self.fs.move(user, source, dest)
+        self.store.move(uid, self.fs.get_uid(user, dest))
+
+    def get_uid(self, user, path):
+        return self.fs.get_uid(user, path)
+
+    def get_local_roots(self):
+        # Changes done outside of the daemon only touch the placeholders
+        return self.fs.get_local_roots()
+
+    def get_quota(self, user, path):
+        return self.fs.get_quota(user, path)
+
+    def get_owner(self, user, path):
+        return self.fs.get_owner(user, path)
+
+    def close(self):
+        # The store may be shared with other filesystems
+        self.fs.close()
+
+    def session(self, user, path="/"):
+        return self.fs.session(user, path)
+
+    def get_dead_props(self, user, paths):
+        return self.fs.get_dead_props(user, paths)
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        return self.fs.set_dead_props(user, path, setprops, removeprops)
@@ -1,12 +1,36 @@
-import hashlib, mimetypes, shutil, logging, urllib.parse
-from webdavdlib import unixdate2httpdate, path_join, remove_prefix
+import hashlib, mimetypes, shutil, logging, urllib.parse, contextlib, stat, json, collections
+from webdavdlib import unixdate2httpdate, path_join, remove_prefix, split_path
 from webdavdlib.operator import *
-import threading
+import threading, time, concurrent.futures
+from webdavdlib.cache import LRUCache
+from webdavdlib.properties import xattr_get, xattr_set, PropertiesNotSupported
+from webdavdlib.shaping import UserPolicy
 
-lock = threading.Lock();
+
+class NoLock(object):
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class FilesystemTimeout(Exception):
+    pass
+
+
+class FilesystemBusy(Exception):
+    pass
+
+
+class QuotaExceeded(Exception):
+    pass
 
 STDPROP = ["D:name", "D:getcontenttype", "D:getcontentlength", "D:creationdate", "D:lastaccessed", "D:lastmodified", "D:getlastmodified", "D:resourcetype", "D:iscollection", "D:ishidden", "D:getetag", "D:displayname", "Z:Win32CreationTime", "Z:Win32LastAccessTime", "Z:Win32LastModifiedTime", "Z:Win32FileAttributes"]
 
+# Live properties of RFC 4331, only returned when requested by name
+QUOTAPROP = ["D:quota-available-bytes", "D:quota-used-bytes"]
+
 
 class Filesystem(object):
     def get_props(self, user, path, props=STDPROP, orig_path=None):
@@ -32,6 +56,28 @@ class Filesystem(object):
         """
         raise NotImplementedError()
 
+    def get_children_props(self, user, path, props=STDPROP):
+        """
+        Get properties of all children of a resource described by path in one go. Only suitible for
+        collection resources. Filesystems should override this if they can enumerate children and their
+        properties cheaper than one get_props call per child.
+
+        Returns a dict mapping child paths to their properties. Children vanishing during the enumeration are skipped.
+
+        :param path: path to the resource
+        :param props: list of properties requested (list of strings)
+        :return: dict of child path -> properties
+        """
+        children = {}
+        with self.session(user, path):
+            for child in self.get_children(user, path):
+                try:
+                    children[child] = self.get_props(user, child, props)
+                except FileNotFoundError:
+                    pass
+
+        return children
+
     def get_content(self, user, path, start=-1, end=-1):
         """
         Get the content of a resource described by path. Only suitible for non-collection resources.
@@ -89,38 +135,259 @@ class Filesystem(object):
         """
         raise NotImplementedError()
 
+    def get_local_roots(self):
+        """
+        Get the local directories exposed by this filesystem, used to watch them for changes done outside of the daemon.
+
+        :return: dict of path (as seen by clients) -> local directory
+        """
+        return {}
+
+    def get_quota(self, user, path):
+        """
+        Get the quota (RFC 4331) applying to the resource described by path.
+
+        :param path: path to the resource
+        :return: tuple (used bytes, available bytes) or None if the filesystem does not limit the usage
+        """
+        return None
+
+    def close(self):
+        """
+        Stops the threads and releases the connections of the filesystem. Called when a reloaded configuration
+        replaced the filesystem and the requests still using it finished.
+        """
+        pass
+
+    def get_owner(self, user, path):
+        """
+        Get the user a change of user to the resource described by path is visible to. Filesystems showing every
+        user a tree of its own (HomeFilesystem) return user, so the change journal does not report the change to others.
+
+        :param path: path to the resource
+        :return: user name or None if all users see the same resource
+        """
+        return None
+
+    # Optional PropertyStore used by the default dead property implementation, keyed by get_uid
+    propstore = None
+
+    def get_dead_props(self, user, paths):
+        """
+        Get the dead properties (set by PROPPATCH) of several resources at once.
+
+        :param paths: list of paths to the resources
+        :return: dict of path -> dict of property name -> value (XML string)
+        """
+        if self.propstore is None:
+            return dict((path, {}) for path in paths)
+
+        uids = dict((path, self.get_uid(user, path)) for path in paths)
+        props = self.propstore.get(list(uids.values()))
+        return dict((path, props.get(uid, {})) for path, uid in uids.items())
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        """
+        Sets and removes dead properties of a resource. Raises NotImplementedError if the filesystem can not store them.
+
+        :param path: path to the resource
+        :param setprops: dict of property name -> value (XML string)
+        :param removeprops: list of property names
+        """
+        if self.propstore is None:
+            raise NotImplementedError()
+
+        self.get_props(user, path, ["D:iscollection"])
+        self.propstore.set(self.get_uid(user, path), setprops, removeprops)
+
+    def copy_dead_props(self, user, source, dest):
+        try:
+            props = self.get_dead_props(user, [source])[source]
+            if props:
+                self.set_dead_props(user, dest, props, [])
+        except NotImplementedError:
+            pass
+
+    @contextlib.contextmanager
+    def session(self, user, path="/"):
+        """
+        Context manager grouping several consecutive operations of user on resources below path. Filesystems
+        can use it to keep locks and the operator identity across the operations instead of switching per call.
+
+        :param path: path below which the operations take place
+        """
+        yield self
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        """
+        Get the content of a resource described by path as an iterator of byte chunks. Only suitible for
+        non-collection resources. Used to stream resources without holding them in memory.
+
+        :param path: path to the resource
+        :param start: (optional) start byte (included)
+        :param end: (optional) end byte (excluded)
+        :param chunksize: (optional) maximum size of a chunk
+        :return: iterator over bytes like objects
+        """
+        pos = max(start, 0)
+        while end == -1 or pos < end:
+            size = chunksize
+            if end != -1:
+                size = min(chunksize, end - pos)
+
+            data = self.get_content(user, path, pos, pos + size)
+            if data:
+                yield data
+            if len(data) < size:
+                break
+            pos += len(data)
+
+    def copy(self, user, source, dest):
+        """
+        Copies the resource described by source (including all children) to dest. The destination must not exist.
+        Filesystems should override this with a native implementation, the default streams the content.
+
+        :param source: path to the resource
+        :param dest: path of the copy
+        """
+        if self.get_props(user, source, ["D:iscollection"])["D:iscollection"]:
+            self.create(user, dest, dir=True)
+            for child in self.get_children(user, source):
+                self.copy(user, child, path_join(dest, os.path.basename(child.rstrip("/"))))
+        else:
+            transfer_content(self, user, source, self, dest)
+
+        self.copy_dead_props(user, source, dest)
+
+    def move(self, user, source, dest):
+        """
+        Moves the resource described by source (including all children) to dest. The destination must not exist.
+
+        :param source: path to the resource
+        :param dest: new path of the resource
+        """
+        self.copy(user, source, dest)
+        self.delete(user, source)
+
+
+def transfer_content(source_fs, user, source, dest_fs, dest, chunksize=1048576):
+    """
+    Streams the content of a non-collection resource from one filesystem to another chunk by chunk.
+    """
+    offset = 0
+    for chunk in source_fs.iter_content(user, source, chunksize=chunksize):
+        dest_fs.set_content(user, dest, chunk, -1 if offset == 0 else offset)
+        offset += len(chunk)
+
+    if offset == 0:
+        dest_fs.set_content(user, dest, b"")
+
 
 class DirectoryFilesystem(Filesystem):
     log = logging.getLogger("DirectoryFilesystem")
 
-    def __init__(self, basepath, additional_dirs=[], operator=NoneOperator()):
+    def __init__(self, basepath, additional_dirs=[], operator=NoneOperator(), propstore=None, content_cache=None, negative_ttl=2, negative_size=4096, resolved_ttl=2, resolved_size=4096):
         self.basepath = basepath
         self.additional_dirs = additional_dirs
         self.operator = operator
 
+        # Canonical directories resolved paths have to be in, checked by looking up the ancestors of a path
+        self.roots = set(os.path.realpath(d) for d in [basepath] + list(additional_dirs))
+
+        # Resolved parent directories (path as seen by clients -> real path). Dropped when the daemon moves or deletes
+        # something, symlinks changed outside of the daemon are noticed after resolved_ttl.
+        self.resolved = LRUCache(resolved_size, resolved_ttl)
+
+        # Operators switching process wide state have to be serialized with all other filesystems
+        self.lock = lock if getattr(operator, "process_wide", True) else NoLock()
+
+        # Dead properties are stored in extended attributes, propstore is the fallback where they are not supported
+        self.propstore = propstore
+        self.xattrs = True
+
+        # Optional ContentCache for small files, it can be shared by several filesystems
+        self.content_cache = content_cache
+
+        # Paths recently found missing. Clients probe for desktop.ini, .DS_Store and the like in every folder, these
+        # are answered without the lock and identity switch. Changes outside the daemon are noticed after negative_ttl.
+        self.missing = None
+        if negative_ttl:
+            self.missing = LRUCache(negative_size, negative_ttl)
+
+    def forget_missing(self, path=None):
+        if self.missing is not None:
+            if path is None:
+                self.missing.clear()
+            else:
+                self.missing.pop(path)
+
+    def begin(self, user):
+        # Takes the lock and the identity of the user, the lock is released again when the switch fails
+        self.lock.acquire()
+        try:
+            self.operator.begin(user)
+        except:
+            self.lock.release()
+            raise
+
+    def end(self, user):
+        try:
+            self.operator.end(user)
+        finally:
+            self.lock.release()
+
+    def get_local_roots(self):
+        return {"/": self.basepath}
+
+    def contained(self, realpath):
+        while realpath not in self.roots:
+            parent = os.path.dirname(realpath)
+            if parent == realpath:
+                return False
+            realpath = parent
+        return True
+
+    def escapes(self, link):
+        # Dangling links are resolved as far as possible, so they can not be used to create files elsewhere
+        return not self.contained(os.path.realpath(link))
+
     def convert_local_to_real(self, path):
-        realpath = path_join(self.basepath, path)
+        segments = [segment for segment in split_path(path) if segment != "."]
+        if ".." in segments:
+            raise PermissionError()
 
-        allowed = False
-        if realpath.startswith(self.basepath):
-            allowed = True
-        for add_path in self.additional_dirs:
-            if realpath.startswith(add_path):
-                allowed = True
+        realpath = path_join(self.basepath, "/".join(segments))
+        if not segments:
+            return realpath
+
+        # Symlinks in the parent directories are resolved once per directory, operations on the returned path
+        # still work on the link itself (e.g. DELETE of a symlink removes the link)
+        parent = "/".join(segments[:-1])
+        resolved = self.resolved.get(parent)
+        if resolved is None:
+            resolved = os.path.realpath(path_join(self.basepath, parent), strict=True)
+            if not self.contained(resolved):
+                raise PermissionError()
+            self.resolved.set(parent, resolved)
 
-        if not allowed:
-            #self.log.error("Access to ", realpath, " restricted because not under ", self.basepath)
+        if os.path.islink(realpath) and self.escapes(realpath):
             raise PermissionError()
 
         return realpath
 
     def get_content(self, user, path, start=-1, end=-1):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
         try:
             path = self.convert_local_to_real(path)
             #self.log.debug("get_content(%s)" % path)
 
+            if self.content_cache is not None:
+                data, cacheable = self._get_cached(path)
+                if data is None and cacheable and start == -1 and end == -1:
+                    data = self._read_cacheable(path)
+                if data is not None:
+                    return data[max(start, 0):None if end == -1 else end]
+
             try:
                 with open(path, "rb") as f:
                     if start != -1:
@@ -133,15 +400,79 @@ class DirectoryFilesystem(Filesystem):
             except PermissionError:
                 raise PermissionError()
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.end(user)
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        self.begin(user)
+        try:
+            path = self.convert_local_to_real(path)
+            #self.log.debug("iter_content(%s)" % path)
+
+            if self.content_cache is not None:
+                data, cacheable = self._get_cached(path)
+                if data is None and cacheable and start in (-1, 0) and end == -1:
+                    data = self._read_cacheable(path)
+                if data is not None:
+                    return self._split_chunks(data[max(start, 0):None if end == -1 else end], chunksize)
+
+            # Permissions are checked when opening, reading happens without the lock
+            f = open(path, "rb")
+        finally:
+            self.end(user)
+
+        return self._read_chunks(f, start, end, chunksize)
+
+    def _get_cached(self, path):
+        # Called with the identity of the user. Entries are shared between users, so a hit is only
+        # returned when the user would also be allowed to open the file.
+        st = os.stat(path)
+        if not stat.S_ISREG(st.st_mode) or not self.content_cache.cacheable(st):
+            return None, False
+
+        data = self.content_cache.get(path, st)
+        if data is not None and not os.access(path, os.R_OK, effective_ids=True):
+            raise PermissionError()
+        return data, True
+
+    def _read_cacheable(self, path):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode) or not self.content_cache.cacheable(st):
+                return None
+            data = f.read()
+
+        self.content_cache.set(path, st, data)
+        return data
+
+    def _split_chunks(self, data, chunksize):
+        for i in range(0, len(data), chunksize):
+            yield data[i:i + chunksize]
+
+    def _read_chunks(self, f, start, end, chunksize):
+        with f:
+            if start != -1:
+                f.seek(start)
+
+            remaining = None
+            if end != -1:
+                remaining = end - max(start, 0)
+
+            while remaining is None or remaining > 0:
+                data = f.read(chunksize if remaining is None else min(chunksize, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
 
     def set_content(self, user, path, content, start=-1):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
         try:
+            davpath = path
             path = self.convert_local_to_real(path)
             #self.log.debug("set_content(%s)" % path)
+            if self.content_cache is not None:
+                self.content_cache.pop(path)
             mode = "wb"
             if os.path.exists(path):
                 mode = "r+b"
@@ -152,36 +483,42 @@ class DirectoryFilesystem(Filesystem):
                         f.seek(start)
 
                     f.write(content)
+
+                    if start == -1:
+                        f.truncate()
             except PermissionError:
                 raise PermissionError()
         finally:
-            self.operator.end(user)
-            lock.release()
+            # Done while still holding the lock, so a concurrent get_props can not cache the path again
+            self.forget_missing(davpath)
+            self.end(user)
 
     def delete(self, user, path):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
 
         try:
             path = self.convert_local_to_real(path)
             #self.log.debug("delete(%s)" % path)
 
             try:
-                if os.path.isfile(path):
+                if os.path.isfile(path) or os.path.islink(path):
                     os.unlink(path)
                 else:
                     shutil.rmtree(path, ignore_errors=True)
             except PermissionError:
                 raise PermissionError
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.resolved.clear()
+            self.end(user)
+
+        if self.propstore is not None:
+            self.propstore.delete(os.path.abspath(path))
 
     def create(self, user, path, dir=True):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
 
         try:
+            davpath = path
             path = self.convert_local_to_real(path)
             #self.log.debug("create(%s)" % path)
 
@@ -193,45 +530,74 @@ class DirectoryFilesystem(Filesystem):
             except PermissionError:
                 raise PermissionError
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.forget_missing(davpath)
+            self.end(user)
 
     def get_props(self, user, path, props=STDPROP, orig_path=None):
-        lock.acquire()
-        self.operator.begin(user)
+        # Whether a path exists does not depend on the user
+        if self.missing is not None and path in self.missing:
+            raise FileNotFoundError()
+
+        self.begin(user)
         if not orig_path:
             orig_path = path
 
         try:
+            davpath = path
             path = self.convert_local_to_real(path)
             #self.log.debug("get_props(%s)" % path)
 
-            if not os.path.exists(path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                if self.missing is not None:
+                    self.missing.set(davpath, True)
                 raise FileNotFoundError()
 
-            propdata = {"D:status": "200 OK"}
+            return self._get_props(path, props, orig_path, st)
+        finally:
+            self.end(user)
 
-            try:
-                for prop in props:
-                    propdata[prop] = self._get_prop(path, prop, orig_path)
-                    #self.log.debug("\tProperty %s: %s" % (prop, propdata[prop]))
+    def get_children_props(self, user, path, props=STDPROP):
+        self.begin(user)
 
-                return propdata
-            except PermissionError:
-                raise PermissionError
+        try:
+            rpath = self.convert_local_to_real(path)
+            #self.log.debug("get_children_props(%s)" % path)
+
+            children = {}
+            if os.path.isdir(rpath):
+                with os.scandir(rpath) as entries:
+                    for entry in entries:
+                        if entry.is_symlink() and self.escapes(entry.path):
+                            continue
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        cpath = path_join(path, entry.name)
+                        children[cpath] = self._get_props(entry.path, props, cpath, st)
+            return children
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.end(user)
+
+    def _get_props(self, path, props, orig_path, st):
+        propdata = {"D:status": "200 OK"}
+        for prop in props:
+            propdata[prop] = self._get_prop(path, prop, orig_path, st)
+            #self.log.debug("\tProperty %s: %s" % (prop, propdata[prop]))
+
+        return propdata
 
-    def _get_prop(self, path, prop, orig_path):
+    def _get_prop(self, path, prop, orig_path, st):
         if prop == "D:creationdate" or prop == "Z:Win32CreationTime":
-            return unixdate2httpdate(os.path.getctime(path))
+            return unixdate2httpdate(st.st_ctime)
 
         elif prop == "D:lastmodified" or prop == "Z:Win32LastModifiedTime" or prop == "D:getlastmodified":
-            return unixdate2httpdate(os.path.getmtime(path))
+            return unixdate2httpdate(st.st_mtime)
 
         elif prop == "D:lastaccessed" or prop == "Z:Win32LastAccessTime":
-            return unixdate2httpdate(os.path.getatime(path))
+            return unixdate2httpdate(st.st_atime)
 
         elif prop == "Z:Win32FileAttributes":
             return "00000000"
@@ -243,14 +609,14 @@ class DirectoryFilesystem(Filesystem):
                 return False
 
         elif prop == "D:getcontentlength":
-            return os.path.getsize(path)
+            return st.st_size
 
         elif prop == "D:getcontenttype":
             ty = mimetypes.guess_type(path)[0]
             if ty != None:
                 return ty
             else:
-                if os.path.isdir(path):
+                if stat.S_ISDIR(st.st_mode):
                     return False
                 else:
                     return "application/octet-stream"
@@ -260,24 +626,24 @@ class DirectoryFilesystem(Filesystem):
             return urllib.parse.quote(os.path.basename(orig_path.rstrip("/")), safe="/~.$")
 
         elif prop == "D:resourcetype":
-            if os.path.isfile(path):
+            if stat.S_ISREG(st.st_mode):
                 return ""
-            if os.path.isdir(path):
+            if stat.S_ISDIR(st.st_mode):
                 return "<D:collection/>"
 
         elif prop == "D:iscollection":
-            if os.path.isdir(path):
+            if stat.S_ISDIR(st.st_mode):
                 return True
             else:
                 return False
 
         elif prop == "D:getetag":
+            # The access time is left out, reading a resource must not change its etag
             etag = hashlib.sha256()
-            etag.update(bytes(str(os.path.getsize(path)), "utf-8"))
-            etag.update(bytes(str(os.path.getmtime(path)), "utf-8"))
-            etag.update(bytes(str(os.path.getctime(path)), "utf-8"))
-            etag.update(bytes(str(os.path.getatime(path)), "utf-8"))
-            etag.update(bytes(str(os.stat(path).st_ino), "utf-8"))
+            etag.update(bytes(str(st.st_size), "utf-8"))
+            etag.update(bytes(str(st.st_mtime), "utf-8"))
+            etag.update(bytes(str(st.st_ctime), "utf-8"))
+            etag.update(bytes(str(st.st_ino), "utf-8"))
             etag.update(bytes(path, "utf-8"))
             return "\"%s\"" % etag.hexdigest()
 
@@ -286,8 +652,7 @@ class DirectoryFilesystem(Filesystem):
             return False
 
     def get_children(self, user, path):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
 
         try:
             rpath = self.convert_local_to_real(path)
@@ -296,20 +661,21 @@ class DirectoryFilesystem(Filesystem):
             try:
                 if os.path.isdir(rpath):
                     l = []
-                    for sub in os.listdir(rpath):
-                        l.append(path_join(path, remove_prefix(sub, self.basepath)))
+                    with os.scandir(rpath) as entries:
+                        for entry in entries:
+                            if entry.is_symlink() and self.escapes(entry.path):
+                                continue
+                            l.append(path_join(path, entry.name))
                     return l
                 else:
                     return []
             except PermissionError:
                 raise PermissionError()
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.end(user)
 
     def get_uid(self, user, path):
-        lock.acquire()
-        self.operator.begin(user)
+        self.begin(user)
 
         try:
             path = self.convert_local_to_real(path)
@@ -318,21 +684,161 @@ class DirectoryFilesystem(Filesystem):
             return os.path.abspath(path)
 
         finally:
-            self.operator.end(user)
-            lock.release()
+            self.end(user)
+
+    @contextlib.contextmanager
+    def session(self, user, path="/"):
+        self.begin(user)
+        try:
+            yield self
+        finally:
+            self.end(user)
+
+    def copy(self, user, source, dest):
+        self.begin(user)
+
+        try:
+            source = self.convert_local_to_real(source)
+            dest = self.convert_local_to_real(dest)
+            #self.log.debug("copy(%s, %s)" % (source, dest))
+
+            if os.path.isdir(source):
+                shutil.copytree(source, dest, symlinks=True)
+            else:
+                shutil.copy2(source, dest)
+        finally:
+            self.forget_missing()
+            self.end(user)
+
+        # Extended attributes are copied along with the files
+        if self.propstore is not None:
+            self.propstore.copy(os.path.abspath(source), os.path.abspath(dest))
+
+    def move(self, user, source, dest):
+        self.begin(user)
+
+        try:
+            source = self.convert_local_to_real(source)
+            dest = self.convert_local_to_real(dest)
+            #self.log.debug("move(%s, %s)" % (source, dest))
+
+            shutil.move(source, dest)
+        finally:
+            self.resolved.clear()
+            self.forget_missing()
+            self.end(user)
+
+        if self.propstore is not None:
+            self.propstore.move(os.path.abspath(source), os.path.abspath(dest))
+
+    def get_dead_props(self, user, paths):
+        props = {}
+        fallback = {}
+
+        self.begin(user)
+        try:
+            for path in paths:
+                realpath = self.convert_local_to_real(path)
+                props[path] = {}
+                if self.xattrs:
+                    try:
+                        props[path] = xattr_get(realpath)
+                        continue
+                    except PropertiesNotSupported:
+                        self.log.info("Extended attributes not supported for %s" % realpath)
+                        self.xattrs = False
+                    except FileNotFoundError:
+                        continue
+                fallback[path] = os.path.abspath(realpath)
+        finally:
+            self.end(user)
+
+        # The property store is accessed with the identity of the daemon
+        if fallback and self.propstore is not None:
+            stored = self.propstore.get(list(fallback.values()))
+            for path, uid in fallback.items():
+                props[path] = stored[uid]
+
+        return props
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        self.begin(user)
+        try:
+            path = self.convert_local_to_real(path)
+            if not os.path.exists(path):
+                raise FileNotFoundError()
+
+            if self.xattrs:
+                try:
+                    return xattr_set(path, setprops, removeprops)
+                except PropertiesNotSupported:
+                    self.log.info("Extended attributes not supported for %s" % path)
+                    self.xattrs = False
+
+            if self.propstore is None:
+                raise NotImplementedError()
+            if not os.access(path, os.W_OK, effective_ids=True):
+                raise PermissionError()
+        finally:
+            self.end(user)
+
+        self.propstore.set(os.path.abspath(path), setprops, removeprops)
 
 class HomeFilesystem(Filesystem):
-    def __init__(self, basepath, additional_dirs=[], operator=None, prefix=None):
+    log = logging.getLogger("HomeFilesystem")
+
+    def __init__(self, basepath, additional_dirs=[], operator=None, prefix=None, cache_size=256, cache_ttl=300, passwd="/etc/passwd", check_interval=5, propstore=None, content_cache=None, negative_ttl=2, resolved_ttl=2):
         self.basepath = basepath
         self.additional_dirs = additional_dirs
         self.operator = operator
         self.prefix = prefix
+        self.propstore = propstore
+        self.content_cache = content_cache
+        self.negative_ttl = negative_ttl
+        self.resolved_ttl = resolved_ttl
+
+        # Resolved home filesystems per user. Entries expire after cache_ttl seconds so that changes in
+        # network user databases (LDAP, NIS) are noticed, local changes are detected through the mtime of passwd.
+        self.filesystems = LRUCache(cache_size, cache_ttl)
+        self.passwd = passwd
+        self.passwd_mtime = self.get_passwd_mtime()
+        self.check_interval = check_interval
+        self.next_check = time.monotonic() + check_interval
+
+    def get_passwd_mtime(self):
+        try:
+            return os.stat(self.passwd).st_mtime_ns
+        except OSError:
+            return None
+
+    def check_passwd(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_interval
+
+        mtime = self.get_passwd_mtime()
+        if mtime != self.passwd_mtime:
+            self.log.info("%s changed, dropping cached home directories" % self.passwd)
+            self.passwd_mtime = mtime
+            self.invalidate()
+
+    def invalidate(self):
+        self.filesystems.clear()
+        self.operator.invalidate()
 
     def get_filesystem(self, user):
-        if self.prefix != None:
-            return DirectoryFilesystem(path_join(self.prefix, self.operator.get_home(user)), self.additional_dirs, self.operator)
-        else:
-            return DirectoryFilesystem(self.operator.get_home(user), self.additional_dirs, self.operator)
+        self.check_passwd()
+
+        fs = self.filesystems.get(user)
+        if fs is None:
+            if self.prefix != None:
+                fs = DirectoryFilesystem(path_join(self.prefix, self.operator.get_home(user)), self.additional_dirs, self.operator, self.propstore, self.content_cache, self.negative_ttl, resolved_ttl=self.resolved_ttl)
+            else:
+                fs = DirectoryFilesystem(self.operator.get_home(user), self.additional_dirs, self.operator, self.propstore, self.content_cache, self.negative_ttl, resolved_ttl=self.resolved_ttl)
+            self.filesystems.set(user, fs)
+
+        return fs
 
     def get_props(self, user, path, props=STDPROP, orig_path=None):
         return self.get_filesystem(user).get_props(user, path, props)
@@ -340,6 +846,9 @@ class HomeFilesystem(Filesystem):
     def get_children(self, user, path):
         return self.get_filesystem(user).get_children(user, path)
 
+    def get_children_props(self, user, path, props=STDPROP):
+        return self.get_filesystem(user).get_children_props(user, path, props)
+
     def get_content(self, user, path, start=-1, end=-1):
         return self.get_filesystem(user).get_content(user, path, start, end)
 
@@ -355,96 +864,1481 @@ class HomeFilesystem(Filesystem):
     def get_uid(self, user, path):
         return self.get_filesystem(user).get_uid(user, path)
 
+    def get_quota(self, user, path):
+        return self.get_filesystem(user).get_quota(user, path)
 
-class MySQLFilesystem(Filesystem):
-    pass
+    def get_owner(self, user, path):
+        return user
 
+    def session(self, user, path="/"):
+        return self.get_filesystem(user).session(user, path)
 
-class RedisFilesystem(Filesystem):
-    pass
+    def get_dead_props(self, user, paths):
+        return self.get_filesystem(user).get_dead_props(user, paths)
 
+    def set_dead_props(self, user, path, setprops, removeprops):
+        return self.get_filesystem(user).set_dead_props(user, path, setprops, removeprops)
 
-class SystemFilesystem(Filesystem):
-    pass
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        return self.get_filesystem(user).iter_content(user, path, start, end, chunksize)
 
+    def copy(self, user, source, dest):
+        return self.get_filesystem(user).copy(user, source, dest)
 
-class MultiplexFilesystem(Filesystem):
-    log = logging.getLogger("MultiplexFilesystem")
-    def __init__(self, filesystems):
-        self.filesystems = filesystems
+    def move(self, user, source, dest):
+        return self.get_filesystem(user).move(user, source, dest)
 
-    def get_props(self, user, path, props=STDPROP):
-        if path == "/":
-            # Root path, need to construct virtual folder
-            return {"D:status" : "200 OK",
-                    "D:name" : "/",
-                    "D:creationdate" : unixdate2httpdate(0),
-                    "D:lastaccessed" : unixdate2httpdate(0),
-                    "D:lastmodified" : unixdate2httpdate(0),
-                    "D:getlastmodified": unixdate2httpdate(0),
-                    "D:getcontentlength": 4096,
-                    "D:resourcetype" : "<D:collection/>",
-                    "D:iscollection" : True}
-        else:
-            vfs = "/" + path.split("/")[1]
-            if vfs in self.filesystems:
-                return self.filesystems[vfs].get_props(user, "/" + remove_prefix(path, vfs), props, path)
+
+class MySQLFilesystem(Filesystem):
+    """
+    Stores resources in an SQL database. Collections and files are rows of a namespace table indexed by
+    (parent, name), content is stored in fixed size chunks, so ranged reads only fetch the chunks needed and a
+    MOVE is a single row update. All users see the same tree.
+
+    connect is called without arguments to open a DB-API connection, e.g. functools.partial(MySQLdb.connect, ...).
+    dialect is "mysql" or "sqlite" (for development and tests, connect with check_same_thread=False).
+    """
+    log = logging.getLogger("MySQLFilesystem")
+
+    COLUMNS = "id, parent, name, iscollection, size, ctime, mtime, version"
+
+    SCHEMA = {
+        "mysql": [
+            "CREATE TABLE IF NOT EXISTS nodes (id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, parent BIGINT NOT NULL, "
+            "name VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, iscollection TINYINT NOT NULL, size BIGINT NOT NULL, "
+            "ctime DOUBLE NOT NULL, mtime DOUBLE NOT NULL, version BIGINT NOT NULL, UNIQUE KEY nodes_parent (parent, name)) ENGINE=InnoDB",
+            "CREATE TABLE IF NOT EXISTS chunks (node BIGINT NOT NULL, idx INT NOT NULL, data MEDIUMBLOB NOT NULL, PRIMARY KEY (node, idx)) ENGINE=InnoDB"
+        ],
+        "sqlite": [
+            "CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY AUTOINCREMENT, parent INTEGER NOT NULL, name TEXT NOT NULL, "
+            "iscollection INTEGER NOT NULL, size INTEGER NOT NULL, ctime REAL NOT NULL, mtime REAL NOT NULL, version INTEGER NOT NULL, UNIQUE (parent, name))",
+            "CREATE TABLE IF NOT EXISTS chunks (node INTEGER NOT NULL, idx INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY (node, idx))"
+        ]
+    }
+
+    # Chunks fetched per query while streaming
+    BATCH = 16
+
+    def __init__(self, connect, dialect="mysql", chunksize=65536, pool_size=8, propstore=None):
+        self.connect = connect
+        self.dialect = dialect
+        self.chunksize = chunksize
+        self.pool_size = pool_size
+        self.propstore = propstore
+        self.idle = []
+        self.mutex = threading.Lock()
+
+        with self.cursor() as c:
+            for statement in self.SCHEMA[dialect]:
+                c.execute(statement)
+
+            # The root collection is the only node with parent 0
+            self.execute(c, "SELECT id FROM nodes WHERE parent = 0 AND name = ''")
+            row = c.fetchone()
+            if row is None:
+                now = time.time()
+                self.execute(c, "INSERT INTO nodes (parent, name, iscollection, size, ctime, mtime, version) VALUES (0, '', 1, 0, ?, ?, 1)", (now, now))
+                self.root = c.lastrowid
             else:
+                self.root = row[0]
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """
+        Yields a cursor of a pooled connection. The transaction is committed when the block succeeds and rolled back
+        otherwise, so no connection keeps an old snapshot while it is idle.
+        """
+        with self.mutex:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self.connect()
+
+        try:
+            c = conn.cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+            conn.commit()
+        except:
+            try:
+                conn.rollback()
+            except Exception:
+                # The connection is broken, it is not returned to the pool
+                conn.close()
+                raise
+            self.release(conn)
+            raise
+        self.release(conn)
+
+    def release(self, conn):
+        with self.mutex:
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.mutex:
+            idle, self.idle, self.pool_size = self.idle, [], 0
+        for conn in idle:
+            conn.close()
+
+    def execute(self, c, sql, params=()):
+        # Statements are written with qmark parameters, MySQL drivers use the format paramstyle
+        if self.dialect == "mysql":
+            sql = sql.replace("?", "%s")
+        c.execute(sql, params)
+
+    def executemany(self, c, sql, rows):
+        if self.dialect == "mysql":
+            sql = sql.replace("?", "%s")
+        c.executemany(sql, rows)
+
+    def lookup(self, c, path):
+        """
+        Returns the row of the node at path, one indexed query per path segment.
+        """
+        self.execute(c, "SELECT %s FROM nodes WHERE id = ?" % self.COLUMNS, (self.root,))
+        node = c.fetchone()
+        for name in split_path(path):
+            if not node[3]:
                 raise FileNotFoundError()
+            self.execute(c, "SELECT %s FROM nodes WHERE parent = ? AND name = ?" % self.COLUMNS, (node[0], name))
+            node = c.fetchone()
+            if node is None:
+                raise FileNotFoundError()
+        return node
+
+    def lookup_parent(self, c, path):
+        """
+        Returns the row of the collection containing path and the name of path within it.
+        """
+        segments = split_path(path)
+        if not segments:
+            raise PermissionError()
+
+        parent = self.lookup(c, "/".join(segments[:-1]))
+        if not parent[3]:
+            raise NotADirectoryError()
+        return parent, segments[-1]
+
+    def touch(self, c, node):
+        self.execute(c, "UPDATE nodes SET mtime = ?, version = version + 1 WHERE id = ?", (time.time(), node))
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+        return self._get_props(node, props, orig_path or path)
 
     def get_children(self, user, path):
-        if path == "/":
-            children = []
-            for cpath, fs in self.filesystems.items():
-                children.append(cpath)
-            return children
-        else:
-            vfs = "/" + path.split("/")[1]
-            if vfs in self.filesystems:
-                children = []
-                vfschildren = self.filesystems[vfs].get_children(user, "/" + remove_prefix(path, vfs))
-                #self.log.debug("\tMultiplex children from %s" % (str(vfschildren)))
-                for cpath in vfschildren:
-                    children.append(path_join(vfs, cpath))
-                #self.log.debug("\tMultiplex children to %s" % (str(children)))
-                return children
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+            self.execute(c, "SELECT name FROM nodes WHERE parent = ?", (node[0],))
+            return [path_join(path, row[0]) for row in c.fetchall()]
+
+    def get_children_props(self, user, path, props=STDPROP):
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+            self.execute(c, "SELECT %s FROM nodes WHERE parent = ?" % self.COLUMNS, (node[0],))
+            rows = c.fetchall()
+
+        children = {}
+        for row in rows:
+            cpath = path_join(path, row[2])
+            children[cpath] = self._get_props(row, props, cpath)
+        return children
+
+    def _get_props(self, node, props, orig_path):
+        propdata = {"D:status": "200 OK"}
+        for prop in props:
+            propdata[prop] = self._get_prop(node, prop, orig_path)
+        return propdata
+
+    def _get_prop(self, node, prop, orig_path):
+        nodeid, parent, name, iscollection, size, ctime, mtime, version = node
+
+        if prop == "D:creationdate" or prop == "Z:Win32CreationTime":
+            return unixdate2httpdate(ctime)
+
+        elif prop in ("D:lastmodified", "Z:Win32LastModifiedTime", "D:getlastmodified", "D:lastaccessed", "Z:Win32LastAccessTime"):
+            return unixdate2httpdate(mtime)
+
+        elif prop == "Z:Win32FileAttributes":
+            return "00000000"
+
+        elif prop == "D:ishidden":
+            if name.startswith(".") or name.startswith("~"):
+                return "1"
             else:
-                return []
+                return False
+
+        elif prop == "D:getcontentlength":
+            return size
+
+        elif prop == "D:getcontenttype":
+            if iscollection:
+                return False
+            return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        elif prop == "D:name" or prop == "D:displayname":
+            return urllib.parse.quote(os.path.basename(orig_path.rstrip("/")), safe="/~.$")
+
+        elif prop == "D:resourcetype":
+            return "<D:collection/>" if iscollection else ""
+
+        elif prop == "D:iscollection":
+            return bool(iscollection)
+
+        elif prop == "D:getetag":
+            # The version is increased on every change of the node, the id tells recreated nodes apart
+            return "\"%x-%x\"" % (nodeid, version)
+
+        else:
+            return False
+
+    def read_chunks(self, c, node, first, last):
+        self.execute(c, "SELECT data FROM chunks WHERE node = ? AND idx >= ? AND idx <= ? ORDER BY idx", (node, first, last))
+        return b"".join(bytes(row[0]) for row in c.fetchall())
 
     def get_content(self, user, path, start=-1, end=-1):
-        vfs = "/" + path.split("/")[1]
-        if vfs in self.filesystems:
-            return self.filesystems[vfs].get_content(user, "/" + remove_prefix(path, vfs), start, end)
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+            if node[3]:
+                raise IsADirectoryError()
+
+            start = max(start, 0)
+            end = node[4] if end == -1 else min(end, node[4])
+            if start >= end:
+                return b""
+
+            first = start // self.chunksize
+            data = self.read_chunks(c, node[0], first, (end - 1) // self.chunksize)
+            offset = first * self.chunksize
+            return data[start - offset:end - offset]
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+        if node[3]:
+            raise IsADirectoryError()
+        return self._iter_chunks(node[0], max(start, 0), node[4] if end == -1 else min(end, node[4]), chunksize)
+
+    def _iter_chunks(self, node, start, end, chunksize):
+        # Every batch is fetched in its own transaction, no connection is held while the client reads
+        pos = start
+        while pos < end:
+            first = pos // self.chunksize
+            last = min(first + self.BATCH, (end - 1) // self.chunksize + 1) - 1
+            with self.cursor() as c:
+                data = self.read_chunks(c, node, first, last)
+            data = data[pos - first * self.chunksize:end - first * self.chunksize]
+            if not data:
+                break
+
+            for i in range(0, len(data), chunksize):
+                yield data[i:i + chunksize]
+            pos += len(data)
+
+    def set_content(self, user, path, content, start=-1):
+        content = bytes(content)
+        with self.cursor() as c:
+            try:
+                node = self.lookup(c, path)
+            except FileNotFoundError:
+                node = self._create(c, path, False)
+            if node[3]:
+                raise IsADirectoryError()
+
+            nodeid, size = node[0], node[4]
+            if start == -1:
+                self.execute(c, "DELETE FROM chunks WHERE node = ?", (nodeid,))
+                lo, buf, size = 0, content, len(content)
+            else:
+                # The chunks from the old end (gaps are filled with zeros) or from start on are rewritten
+                end = start + len(content)
+                lo = min(start, size) // self.chunksize * self.chunksize
+                buf = bytearray(self.read_chunks(c, nodeid, lo // self.chunksize, max(end - 1, lo) // self.chunksize))
+                if len(buf) < start - lo:
+                    buf.extend(bytes(start - lo - len(buf)))
+                buf[start - lo:end - lo] = content
+                size = max(size, end)
+
+            rows = [(nodeid, (lo + i) // self.chunksize, bytes(buf[i:i + self.chunksize])) for i in range(0, len(buf), self.chunksize)]
+            if rows:
+                self.executemany(c, "REPLACE INTO chunks (node, idx, data) VALUES (?, ?, ?)", rows)
+            self.execute(c, "UPDATE nodes SET size = ?, mtime = ?, version = version + 1 WHERE id = ?", (size, time.time(), nodeid))
+
+    def _create(self, c, path, dir):
+        parent, name = self.lookup_parent(c, path)
+        now = time.time()
+        try:
+            self.execute(c, "INSERT INTO nodes (parent, name, iscollection, size, ctime, mtime, version) VALUES (?, ?, ?, 0, ?, ?, 1)",
+                         (parent[0], name, int(dir), now, now))
+        except c.connection.IntegrityError:
+            raise FileExistsError()
+        self.touch(c, parent[0])
+        return (c.lastrowid, parent[0], name, int(dir), 0, now, now, 1)
+
+    def create(self, user, path, dir=True):
+        with self.cursor() as c:
+            try:
+                node = self.lookup(c, path)
+            except FileNotFoundError:
+                self._create(c, path, dir)
+                return
+
+            if dir or node[3]:
+                raise FileExistsError()
+
+    def descendants(self, c, node):
+        """
+        Returns the ids of node and all nodes below it, one query per level.
+        """
+        ids = [node]
+        level = [node]
+        while level:
+            self.execute(c, "SELECT id FROM nodes WHERE parent IN (%s)" % ",".join("?" * len(level)), level)
+            level = [row[0] for row in c.fetchall()]
+            ids += level
+        return ids
+
+    def delete(self, user, path):
+        with self.cursor() as c:
+            node = self.lookup(c, path)
+            if node[0] == self.root:
+                raise PermissionError()
+
+            ids = self.descendants(c, node[0])
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                self.execute(c, "DELETE FROM chunks WHERE node IN (%s)" % ",".join("?" * len(batch)), batch)
+                self.execute(c, "DELETE FROM nodes WHERE id IN (%s)" % ",".join("?" * len(batch)), batch)
+            self.touch(c, node[1])
+
+        if self.propstore is not None:
+            self.propstore.delete(self.get_uid(user, path))
+
+    def copy(self, user, source, dest):
+        with self.cursor() as c:
+            node = self.lookup(c, source)
+            parent, name = self.lookup_parent(c, dest)
+            if node[0] in self.ancestors(c, parent):
+                raise PermissionError()
+            self._copy(c, node, parent[0], name)
+            self.touch(c, parent[0])
+
+        if self.propstore is not None:
+            self.propstore.copy(self.get_uid(user, source), self.get_uid(user, dest))
+
+    def _copy(self, c, node, parent, name):
+        # Content is copied within the database, it never passes through the daemon
+        now = time.time()
+        try:
+            self.execute(c, "INSERT INTO nodes (parent, name, iscollection, size, ctime, mtime, version) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                         (parent, name, node[3], node[4], now, node[6]))
+        except c.connection.IntegrityError:
+            raise FileExistsError()
+        nodeid = c.lastrowid
+
+        if not node[3]:
+            self.execute(c, "INSERT INTO chunks (node, idx, data) SELECT ?, idx, data FROM chunks WHERE node = ?", (nodeid, node[0]))
+            return
+
+        self.execute(c, "SELECT %s FROM nodes WHERE parent = ?" % self.COLUMNS, (node[0],))
+        for child in c.fetchall():
+            self._copy(c, child, nodeid, child[2])
+
+    def ancestors(self, c, node):
+        ids = []
+        while node is not None:
+            ids.append(node[0])
+            self.execute(c, "SELECT %s FROM nodes WHERE id = ?" % self.COLUMNS, (node[1],))
+            node = c.fetchone()
+        return ids
+
+    def move(self, user, source, dest):
+        with self.cursor() as c:
+            node = self.lookup(c, source)
+            if node[0] == self.root:
+                raise PermissionError()
+
+            parent, name = self.lookup_parent(c, dest)
+            if node[0] in self.ancestors(c, parent):
+                raise PermissionError()
+
+            try:
+                self.execute(c, "UPDATE nodes SET parent = ?, name = ? WHERE id = ?", (parent[0], name, node[0]))
+            except c.connection.IntegrityError:
+                raise FileExistsError()
+            self.touch(c, node[1])
+            self.touch(c, parent[0])
+
+        if self.propstore is not None:
+            self.propstore.move(self.get_uid(user, source), self.get_uid(user, dest))
+
+    def get_uid(self, user, path):
+        return "sql:/" + "/".join(split_path(path))
+
+
+class RedisFilesystem(Filesystem):
+    """
+    Keeps resources in Redis, meant for scratch shares. The metadata of all members of a collection is stored in one
+    hash (dir:<path>, member name -> JSON), so listing a collection with all properties is a single HGETALL. Content
+    is stored in chunk:<id>:<index> keys of chunksize bytes. With ttl files expire ttl seconds after their creation.
+
+    client is a redis.Redis instance (or any client with the same API), all keys start with prefix.
+    """
+    log = logging.getLogger("RedisFilesystem")
+
+    def __init__(self, client, prefix="webdav:", chunksize=65536, ttl=None, propstore=None):
+        self.client = client
+        self.prefix = prefix
+        self.chunksize = chunksize
+        self.ttl = ttl
+        self.propstore = propstore
+
+    def normalize(self, path):
+        return "/" + "/".join(split_path(path))
+
+    def split(self, path):
+        parent, _, name = self.normalize(path).rpartition("/")
+        return parent or "/", name
+
+    def dir_key(self, path):
+        return "%sdir:%s" % (self.prefix, path)
+
+    def chunk_key(self, nodeid, index):
+        return "%schunk:%d:%d" % (self.prefix, nodeid, index)
+
+    def decode(self, value):
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return json.loads(value)
+
+    def expired(self, meta):
+        return meta.get("expires") is not None and meta["expires"] < time.time()
+
+    def lookup(self, path):
+        """
+        Returns the metadata of path, one round trip to Redis.
+        """
+        parent, name = self.split(path)
+        if not name:
+            return {"id": 0, "collection": True, "size": 0, "ctime": 0, "mtime": 0, "version": 0}
+
+        meta = self.decode(self.client.hget(self.dir_key(parent), name))
+        if meta is None or self.expired(meta):
+            raise FileNotFoundError()
+        return meta
+
+    def lookup_parent(self, path):
+        parent, name = self.split(path)
+        if not name:
+            raise PermissionError()
+        if not self.lookup(parent)["collection"]:
+            raise NotADirectoryError()
+        return parent, name
+
+    def members(self, path):
+        """
+        Returns dict of name -> metadata of the members of the collection path. Expired members are removed.
+        """
+        members = {}
+        stale = []
+        for name, meta in self.client.hgetall(self.dir_key(path)).items():
+            if isinstance(name, bytes):
+                name = name.decode("utf-8")
+            meta = self.decode(meta)
+            if self.expired(meta):
+                stale.append(name)
+            else:
+                members[name] = meta
+
+        # The content of expired files is removed by Redis itself
+        if stale:
+            self.client.hdel(self.dir_key(path), *stale)
+        return members
+
+    def store(self, pipe, path, meta):
+        parent, name = self.split(path)
+        pipe.hset(self.dir_key(parent), name, json.dumps(meta))
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        return self._get_props(self.lookup(path), props, orig_path or path)
+
+    def get_children(self, user, path):
+        if not self.lookup(path)["collection"]:
+            return []
+        return [path_join(path, name) for name in self.members(self.normalize(path))]
+
+    def get_children_props(self, user, path, props=STDPROP):
+        children = {}
+        for name, meta in self.members(self.normalize(path)).items():
+            cpath = path_join(path, name)
+            children[cpath] = self._get_props(meta, props, cpath)
+        return children
+
+    def _get_props(self, meta, props, orig_path):
+        propdata = {"D:status": "200 OK"}
+        for prop in props:
+            propdata[prop] = self._get_prop(meta, prop, orig_path)
+        return propdata
+
+    def _get_prop(self, meta, prop, orig_path):
+        name = os.path.basename(orig_path.rstrip("/"))
+
+        if prop == "D:creationdate" or prop == "Z:Win32CreationTime":
+            return unixdate2httpdate(meta["ctime"])
+
+        elif prop in ("D:lastmodified", "Z:Win32LastModifiedTime", "D:getlastmodified", "D:lastaccessed", "Z:Win32LastAccessTime"):
+            return unixdate2httpdate(meta["mtime"])
+
+        elif prop == "Z:Win32FileAttributes":
+            return "00000000"
+
+        elif prop == "D:ishidden":
+            if name.startswith(".") or name.startswith("~"):
+                return "1"
+            else:
+                return False
+
+        elif prop == "D:getcontentlength":
+            return meta["size"]
+
+        elif prop == "D:getcontenttype":
+            if meta["collection"]:
+                return False
+            return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        elif prop == "D:name" or prop == "D:displayname":
+            return urllib.parse.quote(name, safe="/~.$")
+
+        elif prop == "D:resourcetype":
+            return "<D:collection/>" if meta["collection"] else ""
+
+        elif prop == "D:iscollection":
+            return meta["collection"]
+
+        elif prop == "D:getetag":
+            return "\"%x-%x\"" % (meta["id"], meta["version"])
+
         else:
+            return False
+
+    def read_chunks(self, meta, first, last):
+        # Missing chunks can only be the expired content of a file, which is treated as gone
+        chunks = self.client.mget([self.chunk_key(meta["id"], i) for i in range(first, last + 1)])
+        if None in chunks:
             raise FileNotFoundError()
+        return b"".join(chunks)
+
+    def get_content(self, user, path, start=-1, end=-1):
+        meta = self.lookup(path)
+        if meta["collection"]:
+            raise IsADirectoryError()
+
+        start = max(start, 0)
+        end = meta["size"] if end == -1 else min(end, meta["size"])
+        if start >= end:
+            return b""
+
+        first = start // self.chunksize
+        data = self.read_chunks(meta, first, (end - 1) // self.chunksize)
+        offset = first * self.chunksize
+        return data[start - offset:end - offset]
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        meta = self.lookup(path)
+        if meta["collection"]:
+            raise IsADirectoryError()
+        return self._iter_chunks(meta, max(start, 0), meta["size"] if end == -1 else min(end, meta["size"]), chunksize)
+
+    def _iter_chunks(self, meta, start, end, chunksize):
+        # Chunks are fetched in batches of 16 per round trip
+        pos = start
+        while pos < end:
+            first = pos // self.chunksize
+            last = min(first + 16, (end - 1) // self.chunksize + 1) - 1
+            data = self.read_chunks(meta, first, last)
+            data = data[pos - first * self.chunksize:end - first * self.chunksize]
+            if not data:
+                break
+
+            for i in range(0, len(data), chunksize):
+                yield data[i:i + chunksize]
+            pos += len(data)
+
+    def new_meta(self, collection):
+        now = time.time()
+        meta = {"id": self.client.incr(self.prefix + "nextid"), "collection": collection, "size": 0, "ctime": now, "mtime": now, "version": 1}
+        if self.ttl and not collection:
+            meta["expires"] = now + self.ttl
+        return meta
+
+    def remaining(self, meta):
+        # Chunks expire together with their file, Redis removes them without the daemon
+        if meta.get("expires") is None:
+            return None
+        return max(1, int(meta["expires"] - time.time()) + 1)
 
     def set_content(self, user, path, content, start=-1):
-        vfs = "/" + path.split("/")[1]
-        if vfs in self.filesystems:
-            return self.filesystems[vfs].set_content(user,  "/" + remove_prefix(path, vfs), content, start)
+        content = bytes(content)
+        try:
+            meta = self.lookup(path)
+        except FileNotFoundError:
+            self.lookup_parent(path)
+            meta = self.new_meta(False)
+        if meta["collection"]:
+            raise IsADirectoryError()
+
+        oldsize = meta["size"]
+        if start == -1:
+            lo, buf = 0, content
+            meta["size"] = len(content)
         else:
-            raise Exception()
+            # The chunks from the old end (gaps are filled with zeros) or from start on are rewritten
+            end = start + len(content)
+            lo = min(start, oldsize) // self.chunksize * self.chunksize
+            buf = bytearray()
+            if lo < oldsize:
+                buf += self.read_chunks(meta, lo // self.chunksize, min(max(end - 1, lo), oldsize - 1) // self.chunksize)
+            if len(buf) < start - lo:
+                buf.extend(bytes(start - lo - len(buf)))
+            buf[start - lo:end - lo] = content
+            meta["size"] = max(oldsize, end)
+
+        meta["mtime"] = time.time()
+        meta["version"] += 1
+
+        pipe = self.client.pipeline()
+        for i in range(0, len(buf), self.chunksize):
+            pipe.set(self.chunk_key(meta["id"], (lo + i) // self.chunksize), bytes(buf[i:i + self.chunksize]), ex=self.remaining(meta))
+        if start == -1:
+            count = (len(buf) + self.chunksize - 1) // self.chunksize
+            stale = [self.chunk_key(meta["id"], i) for i in range(count, (oldsize + self.chunksize - 1) // self.chunksize)]
+            if stale:
+                pipe.delete(*stale)
+        self.store(pipe, path, meta)
+        pipe.execute()
 
     def create(self, user, path, dir=True):
-        vfs = "/" + path.split("/")[1]
-        if vfs in self.filesystems:
-            return self.filesystems[vfs].create(user,  "/" + remove_prefix(path, vfs), dir)
+        parent, name = self.lookup_parent(path)
+        if not self.client.hsetnx(self.dir_key(parent), name, json.dumps(self.new_meta(dir))):
+            meta = self.lookup(path)
+            if dir or meta["collection"]:
+                raise FileExistsError()
+
+    def walk(self, path):
+        """
+        Returns the metadata of all resources below the collection path and the paths of all collections, one
+        round trip per level.
+        """
+        nodes = []
+        collections = [path]
+        level = [path]
+        while level:
+            pipe = self.client.pipeline()
+            for cpath in level:
+                pipe.hgetall(self.dir_key(cpath))
+            results = pipe.execute()
+
+            sublevel = []
+            for cpath, members in zip(level, results):
+                for name, meta in members.items():
+                    if isinstance(name, bytes):
+                        name = name.decode("utf-8")
+                    meta = self.decode(meta)
+                    nodes.append(meta)
+                    if meta["collection"]:
+                        sublevel.append(path_join(cpath, name))
+            collections += sublevel
+            level = sublevel
+        return nodes, collections
+
+    def chunk_keys(self, meta):
+        return [self.chunk_key(meta["id"], i) for i in range((meta["size"] + self.chunksize - 1) // self.chunksize)]
+
+    def delete(self, user, path):
+        path = self.normalize(path)
+        parent, name = self.split(path)
+        if not name:
+            raise PermissionError()
+
+        meta = self.lookup(path)
+        keys = []
+        if meta["collection"]:
+            nodes, collections = self.walk(path)
+            keys += [self.dir_key(cpath) for cpath in collections]
+            for node in nodes:
+                keys += self.chunk_keys(node)
         else:
-            raise Exception()
+            keys += self.chunk_keys(meta)
+
+        pipe = self.client.pipeline()
+        pipe.hdel(self.dir_key(parent), name)
+        for i in range(0, len(keys), 1000):
+            pipe.delete(*keys[i:i + 1000])
+        pipe.execute()
+
+        if self.propstore is not None:
+            self.propstore.delete(self.get_uid(user, path))
+
+    def move(self, user, source, dest):
+        source = self.normalize(source)
+        dest = self.normalize(dest)
+        if dest == source or dest.startswith(source + "/"):
+            raise PermissionError()
+
+        meta = self.lookup(source)
+        self.lookup_parent(dest)
+        if self.client.hexists(self.dir_key(self.split(dest)[0]), self.split(dest)[1]):
+            raise FileExistsError()
+
+        # Content is keyed by id and stays where it is, only the member hashes of collections are renamed
+        pipe = self.client.pipeline()
+        if meta["collection"]:
+            collections = self.walk(source)[1]
+            for cpath in collections:
+                pipe.exists(self.dir_key(cpath))
+            existing = [cpath for cpath, exists in zip(collections, pipe.execute()) if exists]
+            for cpath in existing:
+                pipe.rename(self.dir_key(cpath), self.dir_key(dest + cpath[len(source):]))
+        parent, name = self.split(source)
+        pipe.hdel(self.dir_key(parent), name)
+        self.store(pipe, dest, meta)
+        pipe.execute()
+
+        if self.propstore is not None:
+            self.propstore.move(self.get_uid(user, source), self.get_uid(user, dest))
+
+    def copy(self, user, source, dest):
+        source = self.normalize(source)
+        dest = self.normalize(dest)
+        if dest == source or dest.startswith(source + "/"):
+            raise PermissionError()
+
+        self.lookup_parent(dest)
+        self._copy(user, source, self.lookup(source), dest)
+
+        if self.propstore is not None:
+            self.propstore.copy(self.get_uid(user, source), self.get_uid(user, dest))
+
+    def _copy(self, user, source, meta, dest):
+        if not meta["collection"]:
+            self._copy_file(meta, dest)
+            return
+
+        self.create(user, dest, dir=True)
+        for name, child in self.members(source).items():
+            self._copy(user, path_join(source, name), child, path_join(dest, name))
+
+    def _copy_file(self, meta, dest):
+        copy = self.new_meta(False)
+        copy["size"] = meta["size"]
+        copy["mtime"] = meta["mtime"]
+
+        keys = self.chunk_keys(meta)
+        for i in range(0, len(keys), 16):
+            chunks = self.client.mget(keys[i:i + 16])
+            if None in chunks:
+                raise FileNotFoundError()
+            pipe = self.client.pipeline()
+            for j, data in enumerate(chunks):
+                pipe.set(self.chunk_key(copy["id"], i + j), data, ex=self.remaining(copy))
+            pipe.execute()
+
+        parent, name = self.split(dest)
+        if not self.client.hsetnx(self.dir_key(parent), name, json.dumps(copy)):
+            if keys:
+                self.client.delete(*self.chunk_keys(copy))
+            raise FileExistsError()
+
+    def get_uid(self, user, path):
+        return "redis:" + self.normalize(path)
+
+
+class SystemFilesystem(Filesystem):
+    pass
+
+
+class ExecutorFilesystem(Filesystem):
+    """
+    Runs all calls of the wrapped filesystem in its own bounded thread pool. A hanging filesystem (e.g. an unreachable
+    NFS server) then only occupies its own workers: calls not finished within timeout raise FilesystemTimeout and calls
+    arriving while workers and queue are exhausted raise FilesystemBusy.
+
+    Mounts whose operator switches process wide state (UnixOperator) still share the global filesystem lock. Calls
+    made while the calling thread holds it (within the session of such a mount) run on the calling thread.
+    """
+    log = logging.getLogger("ExecutorFilesystem")
+
+    def __init__(self, fs, workers=4, queue=16, timeout=30, transfer_timeout=None):
+        self.fs = fs
+        self.timeout = timeout
+        self.transfer_timeout = transfer_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="ExecutorFilesystem")
+        self.slots = threading.BoundedSemaphore(workers + queue)
+
+    def call(self, timeout, function, *args):
+        # A worker would wait for the lock held by the calling thread until the call times out
+        if lock.held():
+            return function(*args)
+
+        # The first argument of every call is the user
+        future = self.submit(function, *args)
+
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.log.warning("%s%s did not finish within %s seconds" % (function.__name__, args, timeout))
+            # A call still waiting for a worker is dropped, nobody waits for its result anymore
+            self.cancel(future, args[0])
+            raise FilesystemTimeout()
+
+    def cancel(self, future, user):
+        # The slot is released by the done callback
+        future.cancel()
+
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise FilesystemBusy()
+
+        try:
+            future = self.executor.submit(function, *args)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    @staticmethod
+    def next_chunk(user, chunks):
+        return next(chunks, None)
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        return self.call(self.timeout, self.fs.get_props, user, path, props, orig_path)
+
+    def get_children(self, user, path):
+        return self.call(self.timeout, self.fs.get_children, user, path)
+
+    def get_children_props(self, user, path, props=STDPROP):
+        return self.call(self.timeout, self.fs.get_children_props, user, path, props)
+
+    def get_content(self, user, path, start=-1, end=-1):
+        return self.call(self.timeout, self.fs.get_content, user, path, start, end)
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        chunks = self.call(self.timeout, self.fs.iter_content, user, path, start, end, chunksize)
+        return self._iter_chunks(user, chunks)
+
+    def _iter_chunks(self, user, chunks):
+        # Every read is a separate call, a read hanging mid-file times out like any other call
+        while True:
+            chunk = self.call(self.timeout, self.next_chunk, user, chunks)
+            if chunk is None:
+                return
+            yield chunk
+
+    def set_content(self, user, path, content, start=-1):
+        return self.call(self.timeout, self.fs.set_content, user, path, content, start)
+
+    def create(self, user, path, dir=True):
+        return self.call(self.timeout, self.fs.create, user, path, dir)
 
     def delete(self, user, path):
-        vfs = "/" + path.split("/")[1]
-        if vfs in self.filesystems:
-            return self.filesystems[vfs].delete(user,  "/" + remove_prefix(path, vfs))
+        return self.call(self.transfer_timeout, self.fs.delete, user, path)
+
+    def get_uid(self, user, path):
+        return self.call(self.timeout, self.fs.get_uid, user, path)
+
+    def get_dead_props(self, user, paths):
+        return self.call(self.timeout, self.fs.get_dead_props, user, paths)
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        return self.call(self.timeout, self.fs.set_dead_props, user, path, setprops, removeprops)
+
+    def copy(self, user, source, dest):
+        return self.call(self.transfer_timeout, self.fs.copy, user, source, dest)
+
+    def move(self, user, source, dest):
+        return self.call(self.transfer_timeout, self.fs.move, user, source, dest)
+
+    def get_local_roots(self):
+        return self.fs.get_local_roots()
+
+    def get_quota(self, user, path):
+        return self.call(self.timeout, self.fs.get_quota, user, path)
+
+    def get_owner(self, user, path):
+        return self.fs.get_owner(user, path)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.fs.close()
+
+    @contextlib.contextmanager
+    def session(self, user, path="/"):
+        # The wrapped session would hold the lock on the request thread while the calls run on the workers
+        yield self
+
+
+class FairFilesystem(ExecutorFilesystem):
+    """
+    ExecutorFilesystem serving the users in weighted fair order instead of first come, first served. Every user has
+    a queue of its own (holding up to queue calls), a free worker takes the next call of the user with the lowest
+    virtual finish time. A user's finish time advances by the time its calls take divided by its weight, so a user
+    streaming a large folder gets its share of the workers while the single calls of other users (PROPFIND) are
+    served next.
+
+    weights maps users and @groups to weights (see UserPolicy), other users get default_weight.
+    """
+    log = logging.getLogger("FairFilesystem")
+
+    def __init__(self, fs, workers=4, queue=16, timeout=30, transfer_timeout=None, weights={}, default_weight=1.0):
+        ExecutorFilesystem.__init__(self, fs, workers, queue, timeout, transfer_timeout)
+        self.workers = workers
+        self.queue = queue
+        self.weights = UserPolicy(weights, default_weight)
+
+        self.mutex = threading.Lock()
+        self.queues = {}
+        self.finish = {}
+        self.vtime = 0.0
+        self.running = 0
+
+        # Average duration per function, charged when a call is dispatched and settled once it finished
+        self.estimates = {}
+
+    def submit(self, function, *args):
+        user = args[0]
+        weight = self.weights.get(user)
+        future = concurrent.futures.Future()
+
+        with self.mutex:
+            if len(self.queues.get(user, ())) >= self.queue:
+                raise FilesystemBusy()
+            self.queues.setdefault(user, collections.deque()).append((future, function, args, weight))
+            self.dispatch()
+        return future
+
+    def cancel(self, future, user):
+        with self.mutex:
+            if not future.cancel():
+                return
+
+            queue = self.queues.get(user)
+            for entry in queue or ():
+                if entry[0] is future:
+                    queue.remove(entry)
+                    break
+            if not queue and user in self.queues:
+                del self.queues[user]
+
+    def dispatch(self):
+        # Called with the mutex held
+        while self.running < self.workers and self.queues:
+            user = min(self.queues, key=lambda user: self.finish.get(user, 0.0))
+            queue = self.queues[user]
+            future, function, args, weight = queue.popleft()
+            if not queue:
+                del self.queues[user]
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            # Users returning from idle start at the current virtual time instead of using up time they did not need
+            start = max(self.vtime, self.finish.get(user, 0.0))
+            cost = self.estimates.get(function.__name__, 0.001)
+            self.vtime = start
+            self.finish[user] = start + cost / weight
+            self.running += 1
+            self.executor.submit(self.execute, user, future, function, args, weight, cost)
+
+    def execute(self, user, future, function, args, weight, cost):
+        started = time.monotonic()
+        try:
+            result = function(*args)
+        except BaseException as e:
+            future.set_exception(e)
         else:
-            raise Exception()
+            future.set_result(result)
+        duration = time.monotonic() - started
+
+        with self.mutex:
+            self.running -= 1
+            self.finish[user] = self.finish.get(user, self.vtime) + (duration - cost) / weight
+            self.estimates[function.__name__] = 0.8 * self.estimates.get(function.__name__, duration) + 0.2 * duration
+            if user not in self.queues and self.finish[user] <= self.vtime:
+                del self.finish[user]
+            self.dispatch()
+
+
+class QuotaFilesystem(Filesystem):
+    """
+    Limits the bytes stored in the wrapped filesystem to limit (RFC 4331). With per_user the usage is accounted per
+    user (e.g. for a HomeFilesystem), otherwise for the whole filesystem.
+
+    The usage is counted by walking the tree when it is first needed (for a shared quota as scan_user) and updated
+    with every change done through the filesystem. Every interval seconds it is counted again in the background to
+    pick up changes done outside of the daemon. Changes growing the usage beyond the limit raise QuotaExceeded.
+    """
+    log = logging.getLogger("QuotaFilesystem")
+
+    SIZEPROP = ["D:iscollection", "D:getcontentlength"]
+
+    def __init__(self, fs, limit, per_user=False, interval=3600, scan_user="root"):
+        self.fs = fs
+        self.limit = limit
+        self.per_user = per_user
+        self.interval = interval
+        self.scan_user = scan_user
+        self.mutex = threading.Lock()
+
+        # Accounted key (user or None) -> used bytes, time of the last count and the changes done during a recount.
+        # Only one thread counts a key, others wait for the Event in counting.
+        self.usage = {}
+        self.counted = {}
+        self.drift = {}
+        self.counting = {}
+
+        # (user, path) -> size of files being written, the chunks of a streamed upload after the first one are
+        # accounted without looking up the size again. Only a write continuing exactly at that size uses it, every
+        # other one looks the size up, and it expires quickly to not miss changes done outside of the daemon.
+        self.sizes = LRUCache(1024, 5)
+
+        self.closed = threading.Event()
+        if interval:
+            threading.Thread(target=self.reconcile, name="QuotaFilesystem", daemon=True).start()
+
+    def get_key(self, user):
+        return user if self.per_user else None
+
+    def measure(self, user, path):
+        """
+        Returns the bytes used by path and all resources below it.
+        """
+        props = self.fs.get_props(user, path, self.SIZEPROP)
+        if not props["D:iscollection"]:
+            return props["D:getcontentlength"]
+
+        size = 0
+        pending = [path]
+        while pending:
+            try:
+                children = self.fs.get_children_props(user, pending.pop(), self.SIZEPROP)
+            except (FileNotFoundError, PermissionError):
+                continue
+            for child, childprops in children.items():
+                if childprops["D:iscollection"]:
+                    pending.append(child)
+                else:
+                    size += childprops["D:getcontentlength"]
+        return size
+
+    def count(self, key):
+        with self.mutex:
+            done = self.counting.get(key)
+            running = done is not None
+            if not running:
+                done = self.counting[key] = threading.Event()
+                self.drift[key] = 0
+
+        # Counted by another thread already, its result (or its failure) is taken over
+        if running:
+            done.wait()
+            return
+
+        try:
+            used = self.measure(key if self.per_user else self.scan_user, "/")
+            with self.mutex:
+                self.usage[key] = used + self.drift[key]
+                self.counted[key] = time.monotonic()
+                self.log.debug("Usage of %s counted: %d bytes" % (key, self.usage[key]))
+        finally:
+            with self.mutex:
+                del self.drift[key]
+                del self.counting[key]
+            done.set()
+
+    def reconcile(self):
+        while not self.closed.wait(min(self.interval, 60)):
+            with self.mutex:
+                due = [key for key, counted in self.counted.items() if counted + self.interval < time.monotonic()]
+            for key in due:
+                try:
+                    self.count(key)
+                except Exception:
+                    self.log.exception("Failed to count the usage of %s" % key)
+
+    def get_used(self, user):
+        key = self.get_key(user)
+        while True:
+            with self.mutex:
+                if key in self.usage:
+                    return self.usage[key]
+            # Repeated when the count of another thread failed, so the error is raised here as well
+            self.count(key)
+
+    def reserve(self, user, delta, check=True):
+        """
+        Adds delta bytes to the usage of user. Raises QuotaExceeded if that grows the usage beyond the limit.
+        """
+        self.get_used(user)
+        key = self.get_key(user)
+        with self.mutex:
+            if check and delta > 0 and self.usage[key] + delta > self.limit:
+                raise QuotaExceeded()
+            self.usage[key] += delta
+            if key in self.drift:
+                self.drift[key] += delta
+
+    def get_quota(self, user, path):
+        used = self.get_used(user)
+        return used, max(self.limit - used, 0)
+
+    def get_owner(self, user, path):
+        return self.fs.get_owner(user, path)
+
+    def close(self):
+        self.closed.set()
+        self.fs.close()
+
+    def set_content(self, user, path, content, start=-1):
+        old = self.sizes.pop((user, path))
+        if old is None or start != old:
+            try:
+                old = self.fs.get_props(user, path, ["D:getcontentlength"])["D:getcontentlength"]
+            except FileNotFoundError:
+                old = 0
+
+        new = len(content) if start == -1 else max(old, start + len(content))
+        self.reserve(user, new - old)
+        try:
+            result = self.fs.set_content(user, path, content, start)
+        except:
+            self.sizes.pop((user, path))
+            self.reserve(user, old - new, False)
+            raise
+        self.sizes.set((user, path), new)
+        return result
+
+    def delete(self, user, path):
+        size = self.measure(user, path)
+        self.sizes.clear()
+        self.fs.delete(user, path)
+        self.reserve(user, -size, False)
+
+    def copy(self, user, source, dest):
+        size = self.measure(user, source)
+        self.reserve(user, size)
+        try:
+            return self.fs.copy(user, source, dest)
+        except:
+            self.reserve(user, -size, False)
+            raise
+
+    def move(self, user, source, dest):
+        # Filesystems may replace an existing destination file
+        try:
+            replaced = self.measure(user, dest)
+        except FileNotFoundError:
+            replaced = 0
+
+        self.sizes.clear()
+        self.fs.move(user, source, dest)
+        if replaced:
+            self.reserve(user, -replaced, False)
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        return self.fs.get_props(user, path, props, orig_path)
+
+    def get_children(self, user, path):
+        return self.fs.get_children(user, path)
+
+    def get_children_props(self, user, path, props=STDPROP):
+        return self.fs.get_children_props(user, path, props)
+
+    def get_content(self, user, path, start=-1, end=-1):
+        return self.fs.get_content(user, path, start, end)
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        return self.fs.iter_content(user, path, start, end, chunksize)
+
+    def create(self, user, path, dir=True):
+        return self.fs.create(user, path, dir)
 
     def get_uid(self, user, path):
-        if path == "/":
-            return "root"
+        return self.fs.get_uid(user, path)
+
+    def get_local_roots(self):
+        return self.fs.get_local_roots()
+
+    def session(self, user, path="/"):
+        return self.fs.session(user, path)
+
+    def get_dead_props(self, user, paths):
+        return self.fs.get_dead_props(user, paths)
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        return self.fs.set_dead_props(user, path, setprops, removeprops)
+
+
+class MountPoint(object):
+    """
+    Node of the mount trie used by MultiplexFilesystem. Nodes without a filesystem are virtual directories
+    which only exist because a mount point is located below them.
+    """
+    def __init__(self, path, fs=None):
+        self.path = path
+        self.fs = fs
+        self.children = {}
+        self.props = {"D:status" : "200 OK",
+                      "D:name" : urllib.parse.quote(os.path.basename(path.rstrip("/")) or "/", safe="/~.$"),
+                      "D:displayname" : urllib.parse.quote(os.path.basename(path.rstrip("/")) or "/", safe="/~.$"),
+                      "D:getcontenttype" : False,
+                      "D:creationdate" : unixdate2httpdate(0),
+                      "D:lastaccessed" : unixdate2httpdate(0),
+                      "D:lastmodified" : unixdate2httpdate(0),
+                      "D:getlastmodified": unixdate2httpdate(0),
+                      "D:getcontentlength": 4096,
+                      "D:resourcetype" : "<D:collection/>",
+                      "D:iscollection" : True,
+                      "D:ishidden" : False,
+                      "D:getetag" : "\"%s\"" % hashlib.sha256(bytes(path, "utf-8")).hexdigest(),
+                      "Z:Win32CreationTime" : unixdate2httpdate(0),
+                      "Z:Win32LastAccessTime" : unixdate2httpdate(0),
+                      "Z:Win32LastModifiedTime" : unixdate2httpdate(0),
+                      "Z:Win32FileAttributes" : "00000010"}
+
+
+class MultiplexFilesystem(Filesystem):
+    log = logging.getLogger("MultiplexFilesystem")
+    def __init__(self, filesystems, workers=None, queue=16, timeout=30):
+        # With workers every mount gets its own ExecutorFilesystem, so a slow mount can not stall the others
+        if workers:
+            filesystems = dict((mount, fs if isinstance(fs, ExecutorFilesystem) else ExecutorFilesystem(fs, workers, queue, timeout))
+                               for mount, fs in filesystems.items())
+        self.filesystems = filesystems
+
+        self.root = MountPoint("/")
+        for mount, fs in filesystems.items():
+            node = self.root
+            for segment in split_path(mount):
+                if segment not in node.children:
+                    node.children[segment] = MountPoint(path_join(node.path, segment))
+                node = node.children[segment]
+            node.fs = fs
+
+    def resolve(self, path):
+        """
+        Finds the mount point responsible for path by longest prefix match.
+
+        Returns a tuple (node, subpath). subpath is None if path refers to a virtual directory.
+        """
+        segments = split_path(path)
+        node = self.root
+        mount, depth = None, 0
+        if node.fs is not None:
+            mount = node
+
+        for i, segment in enumerate(segments):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.fs is not None:
+                mount, depth = node, i + 1
         else:
-            vfs = "/" + path.split("/")[1]
-            if vfs in self.filesystems:
-                return self.filesystems[vfs].get_uid(user,  "/" + remove_prefix(path, vfs))
+            if node.fs is None and mount is None:
+                return node, None
+
+        if mount is None:
+            raise FileNotFoundError()
+
+        return mount, "/" + "/".join(segments[depth:])
+
+    def find_node(self, path):
+        node = self.root
+        for segment in split_path(path):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def get_props(self, user, path, props=STDPROP, orig_path=None):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            return mount.props.copy()
+
+        try:
+            return mount.fs.get_props(user, subpath, props, path)
+        except FileNotFoundError:
+            # Virtual directory leading to a nested mount point
+            node = self.find_node(path)
+            if node is None:
+                raise
+            return node.props.copy()
+
+    def get_children(self, user, path):
+        mount, subpath = self.resolve(path)
+        children = []
+        if subpath is not None:
+            for cpath in mount.fs.get_children(user, subpath):
+                children.append(path_join(mount.path, cpath))
+
+        # Mount points located directly below path
+        node = self.find_node(path)
+        if node is not None:
+            for child in node.children.values():
+                if child.path not in children:
+                    children.append(child.path)
+
+        return children
+
+    def get_children_props(self, user, path, props=STDPROP):
+        mount, subpath = self.resolve(path)
+        children = {}
+        if subpath is not None:
+            for cpath, cprops in mount.fs.get_children_props(user, subpath, props).items():
+                children[path_join(mount.path, cpath)] = cprops
+
+        node = self.find_node(path)
+        if node is not None:
+            for child in node.children.values():
+                if child.path not in children:
+                    children[child.path] = child.props.copy()
+
+        return children
+
+    def get_content(self, user, path, start=-1, end=-1):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            raise PermissionError()
+
+        return mount.fs.get_content(user, subpath, start, end)
+
+    def session(self, user, path="/"):
+        try:
+            mount, subpath = self.resolve(path)
+        except FileNotFoundError:
+            return Filesystem.session(self, user, path)
+
+        if subpath is None:
+            return Filesystem.session(self, user, path)
+
+        return mount.fs.session(user, subpath)
+
+    def iter_content(self, user, path, start=-1, end=-1, chunksize=65536):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            raise PermissionError()
+
+        return mount.fs.iter_content(user, subpath, start, end, chunksize)
+
+    def set_content(self, user, path, content, start=-1):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            raise PermissionError()
+
+        return mount.fs.set_content(user, subpath, content, start)
+
+    def create(self, user, path, dir=True):
+        mount, subpath = self.resolve(path)
+        if subpath is None or subpath == "/":
+            raise PermissionError()
+
+        return mount.fs.create(user, subpath, dir)
+
+    def delete(self, user, path):
+        mount, subpath = self.resolve(path)
+        if subpath is None or subpath == "/":
+            raise PermissionError()
+
+        return mount.fs.delete(user, subpath)
+
+    def get_uid(self, user, path):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            if mount is self.root:
+                return "root"
+            return mount.path
+
+        return mount.fs.get_uid(user, subpath)
+
+    def get_quota(self, user, path):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            return None
+
+        return mount.fs.get_quota(user, subpath)
+
+    def close(self):
+        for fs in self.filesystems.values():
+            fs.close()
+
+    def get_owner(self, user, path):
+        try:
+            mount, subpath = self.resolve(path)
+        except FileNotFoundError:
+            return None
+        if subpath is None:
+            return None
+
+        return mount.fs.get_owner(user, subpath)
+
+    def get_local_roots(self):
+        roots = {}
+        for mount, fs in self.filesystems.items():
+            for path, realpath in fs.get_local_roots().items():
+                roots[path_join(mount, path).rstrip("/") or "/"] = realpath
+        return roots
+
+    def get_dead_props(self, user, paths):
+        props = {}
+        mounts = {}
+        for path in paths:
+            mount, subpath = self.resolve(path)
+            if subpath is None:
+                props[path] = {}
             else:
-                raise Exception()
+                mounts.setdefault(mount, []).append((path, subpath))
+
+        # One batch per mount
+        for mount, entries in mounts.items():
+            mountprops = mount.fs.get_dead_props(user, [subpath for path, subpath in entries])
+            for path, subpath in entries:
+                props[path] = mountprops[subpath]
+
+        return props
+
+    def set_dead_props(self, user, path, setprops, removeprops):
+        mount, subpath = self.resolve(path)
+        if subpath is None:
+            raise PermissionError()
+
+        return mount.fs.set_dead_props(user, subpath, setprops, removeprops)
+
+    def copy(self, user, source, dest):
+        source_mount, source_subpath = self.resolve(source)
+        dest_mount, dest_subpath = self.resolve(dest)
+        if source_subpath is None or dest_subpath is None or dest_subpath == "/":
+            raise PermissionError()
+
+        if source_mount is dest_mount:
+            return source_mount.fs.copy(user, source_subpath, dest_subpath)
+
+        # Cross mount copy, stream through the multiplexer
+        return Filesystem.copy(self, user, source, dest)
+
+    def move(self, user, source, dest):
+        source_mount, source_subpath = self.resolve(source)
+        dest_mount, dest_subpath = self.resolve(dest)
+        if source_subpath is None or source_subpath == "/" or dest_subpath is None or dest_subpath == "/":
+            raise PermissionError()
+
+        if source_mount is dest_mount:
+            return source_mount.fs.move(user, source_subpath, dest_subpath)
+
+        return Filesystem.move(self, user, source, dest)
@@ -0,0 +1,122 @@
+import ctypes, ctypes.util, errno, logging, os, struct, threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher(object):
+    """
+    Watches local directory trees with inotify and reports changes done outside of the daemon.
+
+    callback(path, deleted) is called with the client visible path of every changed resource. overflow() is
+    called when the kernel dropped events and changes may have been missed.
+    """
+    log = logging.getLogger("InotifyWatcher")
+
+    def __init__(self, roots, callback, overflow=None):
+        self.roots = roots
+        self.callback = callback
+        self.overflow = overflow
+        self.watches = {}
+        self.exhausted = False
+        self.stopped = False
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        for davpath, realpath in roots.items():
+            self.add_tree(realpath, davpath)
+
+        self.thread = threading.Thread(target=self.run, name="InotifyWatcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        # Removing the watches queues IN_IGNORED events, which wake the thread up
+        self.stopped = True
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def add_watch(self, realpath, davpath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(realpath), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC and not self.exhausted:
+                self.exhausted = True
+                self.log.warning("Out of inotify watches (fs.inotify.max_user_watches), changes below %s are not noticed" % realpath)
+            return
+        self.watches[wd] = (realpath, davpath)
+
+    def add_tree(self, realpath, davpath, report=False):
+        self.add_watch(realpath, davpath)
+        for root, dirs, files in os.walk(realpath):
+            for name in dirs:
+                sub = os.path.join(root, name)
+                self.add_watch(sub, davpath.rstrip("/") + "/" + os.path.relpath(sub, realpath))
+
+            # Members of trees moved in from elsewhere appeared without events of their own
+            if report:
+                for name in dirs + files:
+                    self.callback(davpath.rstrip("/") + "/" + os.path.relpath(os.path.join(root, name), realpath), False)
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except InterruptedError:
+                continue
+
+            if self.stopped:
+                os.close(self.fd)
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+
+                try:
+                    self.handle(wd, mask, os.fsdecode(name))
+                except Exception:
+                    self.log.exception("Failed to handle inotify event")
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.log.warning("inotify queue overflow, changes may have been missed")
+            if self.overflow is not None:
+                self.overflow()
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        if wd not in self.watches or not name:
+            return
+
+        realpath, davpath = self.watches[wd]
+        path = davpath.rstrip("/") + "/" + name
+
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_tree(os.path.join(realpath, name), path, report=True)
+
+        self.callback(path, bool(mask & (IN_DELETE | IN_MOVED_FROM)))
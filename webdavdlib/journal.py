@@ -0,0 +1,114 @@
+import logging, random, sqlite3, threading, time
+
+
+class InvalidSyncToken(Exception):
+    pass
+
+
+class ChangeJournal(object):
+    """
+    Append-only journal of changed resources (paths as seen by clients). Every entry gets a sequence number,
+    sync tokens handed out to clients encode the last sequence number they have seen. Changes with an owner
+    (see Filesystem.get_owner) are only reported to that user.
+    """
+    log = logging.getLogger("ChangeJournal")
+
+    TOKEN_PREFIX = "http://orbit-webdavd/sync/"
+
+    def __init__(self, filename, max_entries=1000000):
+        self.max_entries = max_entries
+        self.mutex = threading.Lock()
+        self.records = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, deleted INTEGER NOT NULL, time REAL NOT NULL, owner TEXT)")
+        if "owner" not in [row[1] for row in self.db.execute("PRAGMA table_info(changes)")]:
+            self.db.execute("ALTER TABLE changes ADD COLUMN owner TEXT")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        # The epoch changes whenever the journal can no longer be trusted (e.g. lost inotify events), which
+        # invalidates all tokens handed out before
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()
+        if row is None:
+            self.reset()
+        else:
+            self.epoch = row[0]
+
+    def reset(self):
+        with self.mutex:
+            self.epoch = "%032x" % random.getrandbits(128)
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('epoch', ?)", (self.epoch,))
+        self.log.info("Journal reset, all sync tokens are invalid now")
+
+    def record(self, path, deleted=False, owner=None):
+        with self.mutex:
+            self.db.execute("INSERT INTO changes (path, deleted, time, owner) VALUES (?, ?, ?, ?)", (path, int(deleted), time.time(), owner))
+
+            self.records += 1
+            if self.records >= 10000:
+                self.records = 0
+                self.prune()
+
+    def prune(self):
+        # Tokens older than the oldest retained entry are rejected, clients fall back to a full sync
+        self.db.execute("DELETE FROM changes WHERE seq <= (SELECT max(seq) FROM changes) - ?", (self.max_entries,))
+
+    def get_seq(self):
+        row = self.db.execute("SELECT max(seq) FROM changes").fetchone()
+        return row[0] or 0
+
+    def current_token(self):
+        with self.mutex:
+            return "%s%s/%d" % (self.TOKEN_PREFIX, self.epoch, self.get_seq())
+
+    def parse_token(self, token):
+        """
+        Returns the sequence number encoded in token. Raises InvalidSyncToken for foreign, outdated or malformed tokens.
+        """
+        if not token.startswith(self.TOKEN_PREFIX):
+            raise InvalidSyncToken()
+
+        epoch, _, seq = token[len(self.TOKEN_PREFIX):].partition("/")
+        try:
+            seq = int(seq)
+        except ValueError:
+            raise InvalidSyncToken()
+
+        with self.mutex:
+            if epoch != self.epoch or seq > self.get_seq():
+                raise InvalidSyncToken()
+
+            oldest = self.db.execute("SELECT min(seq) FROM changes").fetchone()[0]
+            if oldest is not None and seq < oldest - 1:
+                raise InvalidSyncToken()
+
+        return seq
+
+    def get_changes(self, collection, token, infinite=True, user=None):
+        """
+        Get the members of collection changed since token.
+
+        :param collection: path of the collection
+        :param token: sync token handed out before
+        :param infinite: report all descendants instead of the direct members only
+        :param user: user asking, changes owned by other users are left out
+        :return: tuple (list of (path, deleted), new sync token)
+        """
+        seq = self.parse_token(token)
+        prefix = collection.rstrip("/") + "/"
+
+        with self.mutex:
+            newtoken = "%s%s/%d" % (self.TOKEN_PREFIX, self.epoch, self.get_seq())
+            rows = self.db.execute("SELECT path, deleted FROM changes WHERE seq IN "
+                                   "(SELECT max(seq) FROM changes WHERE seq > ? AND substr(path, 1, ?) = ? AND (owner IS NULL OR owner = ?) GROUP BY path) ORDER BY seq",
+                                   (seq, len(prefix), prefix, user)).fetchall()
+
+        changes = []
+        for path, deleted in rows:
+            member = path[len(prefix):].strip("/")
+            if not member or (not infinite and "/" in member):
+                continue
+            changes.append((path.rstrip("/"), bool(deleted)))
+
+        return changes, newtoken
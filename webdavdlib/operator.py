@@ -1,55 +1,131 @@
-import os, functools
+import os, threading
+from webdavdlib.cache import LRUCache
+
+
+class ProcessLock(object):
+    """
+    Reentrant lock that knows whether the current thread holds it
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def acquire(self):
+        self.lock.acquire()
+        self.local.depth = getattr(self.local, "depth", 0) + 1
+
+    def release(self):
+        self.local.depth -= 1
+        self.lock.release()
+
+    def held(self):
+        return getattr(self.local, "depth", 0) > 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+# Global filesystem lock, reentrant so that operations within a session can take it again
+lock = ProcessLock()
 
 class BaseOperator(object):
+    # Operators changing process wide state (effective ids, umask) are serialized by the global filesystem lock
+    process_wide = True
+
     def begin(self, user):
         raise NotImplementedError()
 
     def end(self, user):
         raise NotImplementedError()
 
+    def invalidate(self):
+        pass
+
 
 class NoneOperator(object):
+    process_wide = False
+
     def begin(self, user):
         pass
 
     def end(self, user):
         pass
 
+    def invalidate(self):
+        pass
+
 
 class UnixOperator(BaseOperator):
-    def __init__(self, umask):
+    # Effective credentials are process wide, so the identity stack is shared by all UnixOperators. Nested
+    # operations (e.g. inside a filesystem session) push the same credentials again and skip the switch.
+    stack = []
+    current = None
+
+    def __init__(self, umask, cache_ttl=300, cache_size=512):
         import pwd
         self.pwd = pwd
-        self.counter = 0
         self.umask = umask
 
-    @functools.lru_cache(maxsize=512)
+        # (uid, gid, groups) per user, built from os.getgrouplist without touching the process groups
+        self.credentials = LRUCache(cache_size, cache_ttl)
+        self.passwd = LRUCache(cache_size, cache_ttl)
+        self.root = (0, 0, tuple(os.getgrouplist("root", 0)))
+
+    def get_pwnam(self, username):
+        pw = self.passwd.get(username)
+        if pw is None:
+            pw = self.pwd.getpwnam(username)
+            self.passwd.set(username, pw)
+        return pw
+
+    def get_credentials(self, username):
+        credentials = self.credentials.get(username)
+        if credentials is None:
+            pw = self.get_pwnam(username)
+            credentials = (pw[2], pw[3], tuple(os.getgrouplist(username, pw[3])))
+            self.credentials.set(username, credentials)
+        return credentials
+
     def get_groups(self, username):
-        os.initgroups(username, self.pwd.getpwnam(username)[3])
-        g = os.getgroups()
-        os.initgroups("root", 0)
+        return list(self.get_credentials(username)[2])
 
-        return g
+    def invalidate(self):
+        self.credentials.clear()
+        self.passwd.clear()
 
-    @functools.lru_cache(maxsize=512)
-    def get_pwnam(self, username):
-        return self.pwd.getpwnam(username)
+    def switch(self, credentials, umask):
+        current = UnixOperator.current
+        if current != credentials:
+            uid, gid, groups = credentials
+            # Groups can only be changed with root privileges
+            if os.geteuid() != 0:
+                os.seteuid(0)
+            if current is None or current[2] != groups:
+                os.setgroups(groups)
+            if current is None or current[1] != gid:
+                os.setegid(gid)
+            if uid != 0:
+                os.seteuid(uid)
+            UnixOperator.current = credentials
+        os.umask(umask)
 
     def begin(self, user):
-        if self.counter > 1024:
-            self.get_groups.cache_clear()
-            self.counter = 0
-
-        os.setgroups(self.get_groups(user))
-        os.setegid(self.get_pwnam(user)[3])
-        os.seteuid(self.get_pwnam(user)[2])
-        os.umask(self.umask)
+        credentials = self.get_credentials(user)
+        # Pushed once switched, a failed switch leaves nothing for end() to pop
+        self.switch(credentials, self.umask)
+        UnixOperator.stack.append((credentials, self.umask))
 
     def end(self, user):
-        os.umask(0o022)
-        os.seteuid(0)
-        os.setegid(0)
-        os.setgroups(self.get_groups("root"))
+        UnixOperator.stack.pop()
+        if UnixOperator.stack:
+            self.switch(*UnixOperator.stack[-1])
+        else:
+            # Code outside the lock needs the effective ids of the daemon back right away. The supplementary groups
+            # do not restrict root and are kept, so the next operation of the same user skips setgroups().
+            self.switch(self.root[:2] + UnixOperator.current[2:], 0o022)
 
     def get_home(self, user):
-        return self.get_pwnam(user)[5]
\ No newline at end of file
+        return self.get_pwnam(user)[5]
@@ -0,0 +1,150 @@
+import errno, os, sqlite3, threading
+
+# Namespace for dead properties stored in extended attributes
+XATTR_PREFIX = "user.webdav."
+
+# errnos signalling that extended attributes can not be used for a file (unsupported or value too large)
+XATTR_UNSUPPORTED = (errno.ENOTSUP, errno.EOPNOTSUPP, errno.E2BIG, errno.ENOSPC, errno.EPERM)
+
+
+class PropertiesNotSupported(Exception):
+    pass
+
+
+def xattr_get(path):
+    """
+    Reads all dead properties stored in extended attributes of path.
+
+    :return: dict of property name -> value (XML string)
+    """
+    try:
+        props = {}
+        for attr in os.listxattr(path):
+            if attr.startswith(XATTR_PREFIX):
+                props[attr[len(XATTR_PREFIX):]] = os.getxattr(path, attr).decode("utf-8")
+        return props
+    except OSError as e:
+        if e.errno in XATTR_UNSUPPORTED:
+            raise PropertiesNotSupported()
+        raise
+
+
+def xattr_set(path, setprops, removeprops):
+    """
+    Sets and removes dead properties stored in extended attributes of path.
+    """
+    try:
+        for name, value in setprops.items():
+            os.setxattr(path, XATTR_PREFIX + name, value.encode("utf-8"))
+        for name in removeprops:
+            try:
+                os.removexattr(path, XATTR_PREFIX + name)
+            except OSError as e:
+                if e.errno != errno.ENODATA:
+                    raise
+    except OSError as e:
+        if e.errno in XATTR_UNSUPPORTED:
+            raise PropertiesNotSupported()
+        raise
+
+
+class PropertyStore(object):
+    def get(self, uids):
+        """
+        Get dead properties of several resources at once.
+
+        :param uids: list of resource identifiers (see Filesystem.get_uid)
+        :return: dict of uid -> dict of property name -> value
+        """
+        raise NotImplementedError()
+
+    def set(self, uid, setprops, removeprops):
+        """
+        Sets and removes dead properties of a resource.
+
+        :param setprops: dict of property name -> value
+        :param removeprops: list of property names
+        """
+        raise NotImplementedError()
+
+    def copy(self, source, dest):
+        """
+        Copies the dead properties of source and all resources below it to dest.
+        """
+        raise NotImplementedError()
+
+    def move(self, source, dest):
+        """
+        Moves the dead properties of source and all resources below it to dest.
+        """
+        raise NotImplementedError()
+
+    def delete(self, uid):
+        """
+        Deletes the dead properties of uid and all resources below it.
+        """
+        raise NotImplementedError()
+
+
+class SQLitePropertyStore(PropertyStore):
+    # SQLite limits the number of host parameters per statement
+    BATCH = 500
+
+    def __init__(self, filename):
+        # The connection is opened once while the daemon still runs as root. In WAL mode writes only go
+        # through the already open files, so they also work while an operator switched the identity.
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS props (uid TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (uid, name))")
+        self.mutex = threading.Lock()
+
+    def get(self, uids):
+        props = dict((uid, {}) for uid in uids)
+        uids = list(props.keys())
+        with self.mutex:
+            for i in range(0, len(uids), self.BATCH):
+                batch = uids[i:i + self.BATCH]
+                rows = self.db.execute("SELECT uid, name, value FROM props WHERE uid IN (%s)" % ",".join("?" * len(batch)), batch)
+                for uid, name, value in rows:
+                    props[uid][name] = value
+        return props
+
+    def set(self, uid, setprops, removeprops):
+        with self.mutex:
+            with self.transaction():
+                self.db.executemany("INSERT OR REPLACE INTO props (uid, name, value) VALUES (?, ?, ?)", [(uid, name, value) for name, value in setprops.items()])
+                self.db.executemany("DELETE FROM props WHERE uid = ? AND name = ?", [(uid, name) for name in removeprops])
+
+    def copy(self, source, dest):
+        with self.mutex:
+            with self.transaction():
+                self.db.execute("INSERT OR REPLACE INTO props (uid, name, value) SELECT ? || substr(uid, ?), name, value FROM props WHERE uid = ? OR substr(uid, 1, ?) = ?",
+                                (dest, len(source) + 1, source, len(source) + 1, source + "/"))
+
+    def move(self, source, dest):
+        with self.mutex:
+            with self.transaction():
+                self.db.execute("DELETE FROM props WHERE uid = ? OR substr(uid, 1, ?) = ?", (dest, len(dest) + 1, dest + "/"))
+                self.db.execute("UPDATE props SET uid = ? || substr(uid, ?) WHERE uid = ? OR substr(uid, 1, ?) = ?",
+                                (dest, len(source) + 1, source, len(source) + 1, source + "/"))
+
+    def delete(self, uid):
+        with self.mutex:
+            self.db.execute("DELETE FROM props WHERE uid = ? OR substr(uid, 1, ?) = ?", (uid, len(uid) + 1, uid + "/"))
+
+    def transaction(self):
+        return Transaction(self.db)
+
+
+class Transaction(object):
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN")
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.db.execute("COMMIT")
+        else:
+            self.db.execute("ROLLBACK")
@@ -0,0 +1,264 @@
+"""
+Replays requests recorded by a TrafficRecorder (see config_capture()) and reports latencies per method.
+
+Usage: python3 -m webdavdlib.replay capture.jsonl [--speed 1] [--concurrency 64] [--url http://localhost:8080]
+                                                   [--configuration configuration.py]
+
+Without --url the requests are sent to a WebDAVServer started in this process. It serves a synthetic tree in a
+temporary directory holding every resource the recorded requests found, and accepts every user. Other settings
+(config_reject(), config_journal(), ...) are taken from --configuration.
+"""
+import argparse, base64, http.client, importlib.util, logging, os, sys, tempfile, threading, time, types
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlsplit
+from webdavdlib.capture import load
+
+# Methods that need the resource to exist already
+READING = ("GET", "HEAD", "PROPFIND", "PROPPATCH", "DELETE", "MOVE", "COPY", "LOCK", "UNLOCK", "REPORT", "SEARCH")
+
+# Bodies are not recorded, requests with a body get a typical one for their method
+BODIES = {
+    "PROPFIND": b'<?xml version="1.0" encoding="utf-8"?><D:propfind xmlns:D="DAV:"><D:prop><D:resourcetype/><D:getcontentlength/>'
+                b'<D:getlastmodified/><D:getetag/></D:prop></D:propfind>',
+    "PROPPATCH": b'<?xml version="1.0" encoding="utf-8"?><D:propertyupdate xmlns:D="DAV:" xmlns:R="urn:orbit-webdavd:replay">'
+                 b'<D:set><D:prop><R:replayed>1</R:replayed></D:prop></D:set></D:propertyupdate>',
+    "LOCK": b'<?xml version="1.0" encoding="utf-8"?><D:lockinfo xmlns:D="DAV:"><D:lockscope><D:exclusive/></D:lockscope>'
+            b'<D:locktype><D:write/></D:locktype><D:owner><D:href>replay</D:href></D:owner></D:lockinfo>',
+    "REPORT": b'<?xml version="1.0" encoding="utf-8"?><D:sync-collection xmlns:D="DAV:"><D:sync-token/><D:sync-level>1</D:sync-level>'
+              b'<D:prop><D:getetag/></D:prop></D:sync-collection>',
+    "SEARCH": b'<?xml version="1.0" encoding="utf-8"?><D:searchrequest xmlns:D="DAV:"><D:basicsearch><D:select><D:prop>'
+              b'<D:getcontentlength/></D:prop></D:select><D:from><D:scope><D:href>%s</D:href><D:depth>infinity</D:depth></D:scope>'
+              b'</D:from></D:basicsearch></D:searchrequest>'
+}
+
+ZEROS = bytes(65536)
+
+
+def get_header(entry, name):
+    # Header names are recorded as the client sent them
+    for key, value in entry["headers"].items():
+        if key.lower() == name:
+            return key, value
+    return None, None
+
+
+def parents(path):
+    parts = path.strip("/").split("/")
+    return ["/" + "/".join(parts[:i]) for i in range(1, len(parts))]
+
+
+def plan_tree(entries):
+    """
+    Works out the resources that existed before the capture started: every resource found by the first request
+    touching it and the parents of all resources found or created. Returns (set of collections, dict of files and sizes).
+    """
+    first = {}
+    collections = set()
+    sizes = {}
+
+    for entry in entries:
+        path = entry["path"].rstrip("/") or "/"
+        success = isinstance(entry["status"], int) and 200 <= entry["status"] < 300
+        if entry["path"].endswith("/"):
+            collections.add(path)
+
+        if path not in first:
+            if success:
+                first[path] = "found" if entry["method"] in READING else "created"
+            else:
+                first[path] = "missing"
+
+        destination = get_header(entry, "destination")[1]
+        if destination is not None:
+            first.setdefault(destination.rstrip("/") or "/", "created" if success else "missing")
+
+        if entry["method"] == "GET" and entry["status"] == 200 and entry["size"] is not None:
+            sizes[path] = max(sizes.get(path, 0), entry["size"])
+
+    existing = set()
+    for path, event in first.items():
+        collections.update(parents(path))
+        if event == "missing":
+            continue
+        # Everything below a collection created during the capture did not exist before either
+        for parent in parents(path):
+            if first.get(parent) == "created":
+                break
+            existing.add(parent)
+        else:
+            if event == "found":
+                existing.add(path)
+
+    existing.discard("/")
+    files = dict((path, sizes.get(path, 0)) for path in existing if path not in collections)
+    return existing & collections, files
+
+
+def build_tree(root, collections, files):
+    for path in sorted(collections):
+        os.makedirs(root + path, exist_ok=True)
+    for path, size in files.items():
+        os.makedirs(os.path.dirname(root + path), exist_ok=True)
+        # Sparse files, the content is never looked at
+        with open(root + path, "wb") as f:
+            f.truncate(size)
+
+
+def start_server(root, settings=None):
+    """
+    Starts a WebDAVServer serving root on a free port and returns its address.
+    """
+    # orbit-webdavd.py takes its settings from the configuration module, a synthetic one is put in place
+    configuration = types.ModuleType("configuration")
+    exec("from webdavdlib.filesystems import *\nfrom webdavdlib.authenticator import *\nfrom webdavdlib.operator import *", configuration.__dict__)
+    if settings is not None:
+        with open(settings) as f:
+            exec(compile(f.read(), settings, "exec"), configuration.__dict__)
+    configuration.config_filesystems = lambda: configuration.DirectoryFilesystem(root, [], configuration.NoneOperator())
+    configuration.config_authenticator = lambda: configuration.DebugAuthenticator()
+    configuration.config_port = lambda: 0
+    configuration.config_loglevel = lambda: "WARNING"
+    sys.modules["configuration"] = configuration
+
+    # Templates are loaded relative to the installation
+    base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(base)
+    spec = importlib.util.spec_from_file_location("orbit_webdavd", os.path.join(base, "orbit-webdavd.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    server = module.WebDAVServer(("127.0.0.1", 0), module.WebDAVRequestHandler)
+    threading.Thread(target=server.serve_forever, name="WebDAVServer", daemon=True).start()
+    return server.server_address
+
+
+def zeros(length):
+    while length > 0:
+        chunk = ZEROS[:min(length, len(ZEROS))]
+        length -= len(chunk)
+        yield chunk
+
+
+def build_request(entry, prefix=""):
+    """
+    Returns (target, headers, body) re-issuing the recorded request.
+    """
+    headers = {}
+    for name, value in entry["headers"].items():
+        if value is not None and name.lower() not in ("content-length", "connection"):
+            headers[name] = value
+
+    # Credentials are not recorded, recorded users log in with their name as password
+    if get_header(entry, "authorization")[0] is not None and entry["user"] is not None:
+        headers["Authorization"] = "Basic " + base64.b64encode(("%s:%s" % (entry["user"], entry["user"])).encode()).decode()
+
+    destination = get_header(entry, "destination")[1]
+    if destination is not None:
+        headers["Destination"] = quote(prefix + destination)
+
+    target = quote(prefix + entry["path"])
+    if entry["query"]:
+        target += "?" + urlencode(entry["query"])
+
+    length = int(get_header(entry, "content-length")[1] or 0)
+    body = None
+    if entry["method"] in BODIES and length:
+        body = BODIES[entry["method"]].replace(b"%s", quote(prefix + entry["path"]).encode())
+        length = len(body)
+    elif length:
+        body = zeros(length)
+    headers["Content-Length"] = str(length)
+    return target, headers, body
+
+
+def send(address, entry, prefix=""):
+    """
+    Sends the recorded request and returns (status, seconds until the response was read completely).
+    """
+    target, headers, body = build_request(entry, prefix)
+    start = time.perf_counter()
+    try:
+        connection = http.client.HTTPConnection(address[0], address[1], timeout=300)
+        try:
+            connection.request(entry["method"], target, body=body, headers=headers)
+            response = connection.getresponse()
+            while response.read(65536):
+                pass
+            status = response.status
+        finally:
+            connection.close()
+    except (OSError, http.client.HTTPException):
+        status = None
+    return status, time.perf_counter() - start
+
+
+def replay(entries, address, speed=1, concurrency=64, prefix=""):
+    """
+    Re-issues entries with their recorded spacing divided by speed (0 sends them as fast as possible).
+    Returns a list of (entry, status, latency) and the seconds the replay took.
+    """
+    results = []
+    mutex = threading.Lock()
+
+    def run(entry):
+        status, latency = send(address, entry, prefix)
+        with mutex:
+            results.append((entry, status, latency))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as pool:
+        first = entries[0]["time"]
+        for entry in entries:
+            if speed > 0:
+                delay = (entry["time"] - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, entry)
+    return results, time.monotonic() - start
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def report(results, elapsed):
+    methods = {}
+    for entry, status, latency in results:
+        methods.setdefault(entry["method"], []).append((entry, status, latency))
+
+    print("%-10s %7s %9s %9s %9s %9s %12s %9s" % ("method", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "captured p50", "differs"))
+    for method in sorted(methods):
+        latencies = sorted(latency * 1000 for entry, status, latency in methods[method])
+        captured = sorted(entry["duration"] * 1000 for entry, status, latency in methods[method])
+        differs = sum(1 for entry, status, latency in methods[method] if status != entry["status"])
+        print("%-10s %7d %9.1f %9.1f %9.1f %9.1f %12.1f %9d" % (method, len(latencies), percentile(latencies, 0.5), percentile(latencies, 0.9),
+                                                               percentile(latencies, 0.99), latencies[-1], percentile(captured, 0.5), differs))
+    print("%d requests in %.1f s (%.0f requests/s)" % (len(results), elapsed, len(results) / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays requests recorded by orbit-webdavd")
+    parser.add_argument("capture", help="file written by a TrafficRecorder")
+    parser.add_argument("--speed", type=float, default=1, help="speed-up of the recorded timing, 0 sends requests as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum number of requests in flight")
+    parser.add_argument("--url", help="server to replay against instead of a WebDAVServer with a synthetic tree")
+    parser.add_argument("--configuration", help="configuration of the WebDAVServer, its filesystems and authenticator are replaced")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    entries = load(args.capture)
+    if not entries:
+        sys.exit("No requests recorded in %s" % args.capture)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.url is None:
+            collections, files = plan_tree(entries)
+            build_tree(tmp, collections, files)
+            print("Synthetic tree with %d collections and %d files" % (len(collections), len(files)))
+            address, prefix = start_server(tmp, args.configuration and os.path.abspath(args.configuration)), ""
+        else:
+            url = urlsplit(args.url)
+            address, prefix = (url.hostname, url.port or 80), url.path.rstrip("/")
+
+        results, elapsed = replay(entries, address, args.speed, args.concurrency, prefix)
+    report(results, elapsed)
@@ -1,26 +1,74 @@
-import base64, re
-from urllib.parse import urlparse, unquote
+import base64, binascii, re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from urllib.parse import urlsplit, unquote, parse_qs
+
+LOCKTOKEN = re.compile(r"<opaquelocktoken:([^>]*)>")
+CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
 
 
 class BaseRequest(object):
+    """
+    Only the path is parsed when a request is created. All other fields are parsed when they are first accessed,
+    PARSERS maps them to the method setting them. The body is only read when a handler accesses it.
+    """
+    __slots__ = ("path", "querystring", "headers", "length", "rfile", "query", "data", "upload", "depth", "destination",
+                 "username", "password", "locktoken", "overwrite")
+
+    # Requests with possibly large bodies (PUT) leave reading the body to the handler
+    readbody = True
+
+    PARSERS = {
+        "query": "parseQuery",
+        "data": "parseData",
+        "upload": "parseUpload",
+        "depth": "parseDepth",
+        "destination": "parseDestination",
+        "username": "parseAuthorization",
+        "password": "parseAuthorization",
+        "locktoken": "parseLocktoken",
+        "overwrite": "parseOverwrite"
+    }
+
     def __init__(self, httprequest):
-        self.path = unquote(urlparse(httprequest.path).path)
+        # urlsplit, unlike urlparse, keeps ";" as part of the path
+        url = urlsplit(httprequest.path)
+        self.path = unquote(url.path)
+        self.querystring = url.query
         self.headers = httprequest.headers
+        self.length = int(httprequest.headers.get("Content-Length") or 0)
+        self.rfile = httprequest.rfile
+
+    def __getattr__(self, name):
+        # Only called for fields that are not set yet
+        parser = self.PARSERS.get(name)
+        if parser is None:
+            raise AttributeError(name)
+
+        getattr(self, parser)()
+        return object.__getattribute__(self, name)
+
+    def parseQuery(self):
+        self.query = parse_qs(self.querystring, keep_blank_values=True) if self.querystring else {}
+
+    def parseData(self):
         self.data = ""
-        if httprequest.headers.get("Content-Length"):
-            self.data = httprequest.rfile.read(int(httprequest.headers.get("Content-Length")))
 
-        self.parseDepth()
-        self.parseDestination()
-        self.parseAuthorization()
-        self.parseLocktoken()
-        self.parseOverwrite()
+        if self.readbody and self.length:
+            self.data = self.rfile.read(self.length)
+
+    def parseUpload(self):
+        # Resumable upload session: None without session, "" to create one, the session id otherwise
+        self.upload = None
+
+        if "upload" in self.query:
+            self.upload = self.query["upload"][0]
 
     def parseDestination(self):
         self.destination = None
 
         if self.headers.get("Destination"):
-            self.destination = unquote(urlparse(self.headers.get("Destination")).path)
+            self.destination = unquote(urlsplit(self.headers.get("Destination")).path)
 
     def parseDepth(self):
         self.depth = 32
@@ -32,34 +80,32 @@ class BaseRequest(object):
             else:
                 self.depth = int(raw)
 
-
     def parseAuthorization(self):
         self.username = None
         self.password = None
 
-        if self.headers.get("Authorization"):
-            stripped = self.headers.get('Authorization')[6:]
-            try:
-                username, password = base64.b64decode(stripped).decode().split(":")
-                self.username = username
-                self.password = password
-            except:
-                pass
+        scheme, _, credentials = (self.headers.get("Authorization") or "").partition(" ")
+        if scheme.lower() != "basic":
+            return
+
+        try:
+            # The password may contain colons, the user name may not (RFC 7617)
+            username, colon, password = base64.b64decode(credentials.strip(), validate=True).decode("utf-8").partition(":")
+        except (binascii.Error, UnicodeDecodeError):
+            return
+
+        if colon:
+            self.username = username
+            self.password = password
 
     def parseLocktoken(self):
         self.locktoken = None
 
-        if self.headers.get("Lock-Token"):
-            try:
-                self.locktoken = re.search("<opaquelocktoken:(.*)>", str(self.headers["Lock-Token"])).group(1)
-            except:
-                pass
-
-        if self.headers.get("If"):
-            try:
-                self.locktoken = re.search("<opaquelocktoken:(.*)>", str(self.headers["If"])).group(1)
-            except:
-                pass
+        # A token in the If header takes precedence over Lock-Token
+        for header in ("Lock-Token", "If"):
+            match = LOCKTOKEN.search(self.headers.get(header) or "")
+            if match is not None:
+                self.locktoken = match.group(1)
 
     def parseOverwrite(self):
         self.overwrite = False
@@ -71,31 +117,121 @@ class BaseRequest(object):
         return "%s: [Path: %s, Depth: %s, Destination: %s, Locktoken: %s, Overwrite: %s]" % (self.__class__.__name__, self.path, self.depth, self.destination, self.locktoken, self.overwrite)
 
 
+# Namespace prefixes declared in the Multi-Status responses, properties in other namespaces keep their Clark notation
+NAMESPACES = {
+    "DAV:": "D",
+    "urn:schemas-microsoft-com:": "Z",
+    "urn:schemas-microsoft-com:office:office": "Office"
+}
+
+
+def prop_name(tag):
+    """
+    Converts an ElementTree tag like {DAV:}getetag into the property name used throughout the daemon (D:getetag).
+    """
+    if tag.startswith("{"):
+        namespace, _, name = tag[1:].partition("}")
+        if namespace in NAMESPACES:
+            return "%s:%s" % (NAMESPACES[namespace], name)
+    return tag
+
+
+def inner_xml(element):
+    """
+    Serializes the content of an element (text and child elements) so it can be stored and embedded again later.
+    """
+    return escape(element.text or "") + "".join(ET.tostring(child, encoding="unicode") for child in element)
+
+
 class HEADRequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class GETRequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class PUTRequest(BaseRequest):
-    pass
+    __slots__ = ("range", "valid")
+    readbody = False
+    PARSERS = dict(BaseRequest.PARSERS, range="parseContentRange", valid="parseContentRange")
+
+    def parseContentRange(self):
+        # Content-Range: bytes first-last/total, total may be * when unknown
+        self.range = None
+        self.valid = True
+
+        if self.headers.get("Content-Range"):
+            match = CONTENT_RANGE.fullmatch(self.headers.get("Content-Range").strip())
+            if match is None:
+                self.valid = False
+                return
+
+            first, last = int(match.group(1)), int(match.group(2))
+            total = None if match.group(3) == "*" else int(match.group(3))
+            if last < first or last - first + 1 != self.length or (total is not None and last >= total):
+                self.valid = False
+                return
+
+            self.range = (first, last, total)
+
+    def __str__(self):
+        return "%s: [Path: %s, Length: %s, Range: %s, Upload: %s]" % (self.__class__.__name__, self.path, self.length, self.range, self.upload)
+
+
+class POSTRequest(BaseRequest):
+    __slots__ = ("extract",)
+    readbody = False
+    PARSERS = dict(BaseRequest.PARSERS, extract="parseExtract")
+
+    def parseExtract(self):
+        self.extract = None
+
+        if "extract" in self.query:
+            self.extract = self.query["extract"][0]
+
+    def __str__(self):
+        return "%s: [Path: %s, Length: %s, Upload: %s, Extract: %s]" % (self.__class__.__name__, self.path, self.length, self.upload, self.extract)
 
 
 class MKCOLRequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class MOVERequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class PROPFINDRequest(BaseRequest):
-    def __init__(self, httprequest):
-        BaseRequest.__init__(self, httprequest)
-
-        self.parseIsExcel()
+    __slots__ = ("propmode", "props", "include", "valid", "isexcel")
+    PARSERS = dict(BaseRequest.PARSERS, propmode="parseBody", props="parseBody", include="parseBody", valid="parseBody", isexcel="parseIsExcel")
+
+    def parseBody(self):
+        # An empty body is equivalent to allprop (RFC 4918 9.1)
+        self.propmode = "allprop"
+        self.props = []
+        self.include = []
+        self.valid = True
+
+        if not self.data:
+            return
+
+        try:
+            root = ET.fromstring(self.data)
+        except ET.ParseError:
+            self.valid = False
+            return
+
+        for child in root:
+            if child.tag == "{DAV:}prop":
+                self.propmode = "prop"
+                self.props = [prop_name(prop.tag) for prop in child]
+            elif child.tag == "{DAV:}allprop":
+                self.propmode = "allprop"
+            elif child.tag == "{DAV:}propname":
+                self.propmode = "propname"
+            elif child.tag == "{DAV:}include":
+                self.include = [prop_name(prop.tag) for prop in child]
 
     def parseIsExcel(self):
         self.isexcel = False
@@ -105,41 +241,181 @@ class PROPFINDRequest(BaseRequest):
                 self.isexcel = True
 
     def __str__(self):
-        return "%s: [Path: %s, Depth: %s, Destination: %s, Locktoken: %s, Overwrite: %s, isExcel: %s]" % (self.__class__.__name__, self.path, self.depth, self.destination, self.locktoken, self.overwrite, self.isexcel)
+        return "%s: [Path: %s, Depth: %s, Destination: %s, Locktoken: %s, Overwrite: %s, isExcel: %s, Mode: %s]" % (self.__class__.__name__, self.path, self.depth, self.destination, self.locktoken, self.overwrite, self.isexcel, self.propmode)
 
 
 class DELETERequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class PROPPATCHRequest(BaseRequest):
-    pass
+    __slots__ = ("operations", "valid")
+    PARSERS = dict(BaseRequest.PARSERS, operations="parseBody", valid="parseBody")
+
+    def parseBody(self):
+        # List of (action, property name, value) in document order, action is either set or remove
+        self.operations = []
+        self.valid = True
+
+        try:
+            root = ET.fromstring(self.data)
+        except ET.ParseError:
+            self.valid = False
+            return
+
+        if root.tag != "{DAV:}propertyupdate":
+            self.valid = False
+            return
+
+        for action in root:
+            if action.tag not in ("{DAV:}set", "{DAV:}remove"):
+                continue
+            for prop in action.findall("{DAV:}prop"):
+                for element in prop:
+                    if action.tag == "{DAV:}set":
+                        self.operations.append(("set", prop_name(element.tag), inner_xml(element)))
+                    else:
+                        self.operations.append(("remove", prop_name(element.tag), None))
+
+    def __str__(self):
+        return "%s: [Path: %s, Depth: %s, Destination: %s, Locktoken: %s, Overwrite: %s, Operations: %s]" % (self.__class__.__name__, self.path, self.depth, self.destination, self.locktoken, self.overwrite, len(self.operations))
+
+
+class REPORTRequest(BaseRequest):
+    __slots__ = ("report", "synctoken", "synclevel", "props", "valid")
+    PARSERS = dict(BaseRequest.PARSERS, report="parseBody", synctoken="parseBody", synclevel="parseBody", props="parseBody", valid="parseBody")
+
+    def parseBody(self):
+        # Only the sync-collection report (RFC 6578) is understood, other reports keep their name for the error
+        self.report = None
+        self.synctoken = None
+        self.synclevel = "1"
+        self.props = []
+        self.valid = True
+
+        try:
+            root = ET.fromstring(self.data)
+        except ET.ParseError:
+            self.valid = False
+            return
+
+        self.report = root.tag[len("{DAV:}"):] if root.tag.startswith("{DAV:}") else root.tag
+        if root.tag != "{DAV:}sync-collection":
+            return
+
+        for child in root:
+            if child.tag == "{DAV:}sync-token":
+                self.synctoken = (child.text or "").strip() or None
+            elif child.tag == "{DAV:}sync-level":
+                self.synclevel = (child.text or "").strip().lower()
+            elif child.tag == "{DAV:}prop":
+                self.props = [prop_name(prop.tag) for prop in child]
+
+        if self.synclevel not in ("1", "infinite"):
+            self.valid = False
+
+    def __str__(self):
+        return "%s: [Path: %s, Report: %s, Sync-Token: %s, Sync-Level: %s]" % (self.__class__.__name__, self.path, self.report, self.synctoken, self.synclevel)
+
+
+class SEARCHRequest(BaseRequest):
+    __slots__ = ("propmode", "props", "scope", "scopedepth", "where", "orderby", "limit", "valid")
+    PARSERS = dict(BaseRequest.PARSERS, **dict((name, "parseBody") for name in __slots__))
+
+    def parseBody(self):
+        # DAV:basicsearch (RFC 5323), where is a tree of tuples: (and|or, [conditions]), (not, condition),
+        # (eq|lt|gt|lte|gte|like, property, literal), (is-collection,) and (is-defined, property)
+        self.propmode = "allprop"
+        self.props = []
+        self.scope = self.path
+        self.scopedepth = "infinity"
+        self.where = None
+        self.orderby = []
+        self.limit = None
+        self.valid = True
+
+        try:
+            root = ET.fromstring(self.data)
+            search = root.find("{DAV:}basicsearch")
+            if root.tag != "{DAV:}searchrequest" or search is None:
+                raise ValueError()
+
+            select = search.find("{DAV:}select/{DAV:}prop")
+            if select is not None:
+                self.propmode = "prop"
+                self.props = [prop_name(prop.tag) for prop in select]
+
+            scope = search.find("{DAV:}from/{DAV:}scope")
+            if scope is not None:
+                href = scope.findtext("{DAV:}href")
+                if href:
+                    self.scope = unquote(urlsplit(href.strip()).path)
+                self.scopedepth = (scope.findtext("{DAV:}depth") or "infinity").strip().lower()
+
+            where = search.find("{DAV:}where")
+            if where is not None and len(where):
+                self.where = self.parseCondition(where[0])
+
+            for order in search.findall("{DAV:}orderby/{DAV:}order"):
+                prop = order.find("{DAV:}prop")
+                self.orderby.append((prop_name(prop[0].tag), order.find("{DAV:}descending") is None))
+
+            nresults = search.findtext("{DAV:}limit/{DAV:}nresults")
+            if nresults:
+                self.limit = int(nresults)
+        except (ET.ParseError, ValueError, TypeError, IndexError):
+            self.valid = False
+
+        if self.scopedepth not in ("0", "1", "infinity"):
+            self.valid = False
+
+    def parseCondition(self, element):
+        op = element.tag[len("{DAV:}"):] if element.tag.startswith("{DAV:}") else element.tag
+        if op in ("and", "or"):
+            return (op, [self.parseCondition(child) for child in element])
+        elif op == "not":
+            return (op, self.parseCondition(element[0]))
+        elif op == "is-collection":
+            return (op,)
+        elif op == "is-defined":
+            return (op, prop_name(element.find("{DAV:}prop")[0].tag))
+        elif op in ("eq", "lt", "gt", "lte", "gte", "like"):
+            return (op, prop_name(element.find("{DAV:}prop")[0].tag), element.findtext("{DAV:}literal") or "")
+        raise ValueError()
+
+    def __str__(self):
+        return "%s: [Path: %s, Scope: %s, Depth: %s, Where: %s, Limit: %s]" % (self.__class__.__name__, self.path, self.scope, self.scopedepth, self.where, self.limit)
 
 
 class COPYRequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 class LOCKRequest(BaseRequest):
-    def __init__(self, httprequest):
-        BaseRequest.__init__(self, httprequest)
-
-        self.parseLockowner()
+    __slots__ = ("lockowner",)
+    PARSERS = dict(BaseRequest.PARSERS, lockowner="parseLockowner")
 
     def parseLockowner(self):
         self.lockowner = None
-        if self.data:
-            try:
-                self.lockowner = re.search("<D:href>(.*)</D:href>", str(self.data)).group(1)
-            except:
-                pass
+        if not self.data:
+            return
+
+        try:
+            owner = ET.fromstring(self.data).find("{DAV:}owner")
+        except ET.ParseError:
+            return
+
+        if owner is not None:
+            href = owner.findtext("{DAV:}href")
+            # Kept escaped, it is embedded into the lock discovery as it is
+            self.lockowner = escape((href if href is not None else owner.text or "").strip())
 
     def __str__(self):
         return "%s: [Path: %s, Depth: %s, Destination: %s, Locktoken: %s, Overwrite: %s, Lockowner: %s]" % (self.__class__.__name__, self.path, self.depth, self.destination, self.locktoken, self.overwrite, self.lockowner)
 
 
 class UNLOCKRequest(BaseRequest):
-    pass
+    __slots__ = ()
 
 
 
@@ -0,0 +1,307 @@
+import calendar, datetime, email.utils, logging, queue, sqlite3, threading
+
+# Properties needed to maintain an index entry
+INDEXPROP = ["D:iscollection", "D:getcontentlength", "D:getlastmodified", "D:getcontenttype"]
+
+# Searchable properties and the index columns holding them
+COLUMNS = {
+    "D:displayname": "name",
+    "D:name": "name",
+    "D:getcontentlength": "size",
+    "D:getlastmodified": "mtime",
+    "D:lastmodified": "mtime",
+    "D:getcontenttype": "contenttype",
+    "D:iscollection": "iscollection"
+}
+
+OPERATORS = {"eq": "=", "lt": "<", "gt": ">", "lte": "<=", "gte": ">="}
+
+
+class InvalidQuery(Exception):
+    pass
+
+
+def parse_date(value):
+    """
+    Converts an HTTP date (RFC 1123) or an ISO 8601 date to a unix timestamp.
+    """
+    try:
+        return calendar.timegm(email.utils.parsedate_to_datetime(value).utctimetuple())
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        date = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise InvalidQuery("Invalid date literal %s" % value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def convert_literal(column, value):
+    if column == "size":
+        try:
+            return int(value)
+        except ValueError:
+            raise InvalidQuery("Invalid size literal %s" % value)
+    elif column == "mtime":
+        return parse_date(value)
+    elif column == "iscollection":
+        return int(value.lower() in ("1", "true", "yes"))
+    return value
+
+
+def compile_where(where, params):
+    """
+    Translates a parsed DAV:where condition (see SEARCHRequest) into an SQL expression, literals are appended to params.
+    """
+    op = where[0]
+    if op in ("and", "or"):
+        if not where[1]:
+            raise InvalidQuery("Empty %s" % op)
+        return "(%s)" % (" %s " % op.upper()).join(compile_where(child, params) for child in where[1])
+    elif op == "not":
+        return "(NOT %s)" % compile_where(where[1], params)
+    elif op == "is-collection":
+        return "iscollection = 1"
+    elif op == "is-defined":
+        return "%s IS NOT NULL" % get_column(where[1])
+    elif op in OPERATORS:
+        column = get_column(where[1])
+        params.append(convert_literal(column, where[2]))
+        return "%s %s ?" % (column, OPERATORS[op])
+    elif op == "like":
+        column = get_column(where[1])
+        if column != "name" and column != "contenttype":
+            raise InvalidQuery("like is only supported for string properties")
+        params.append(where[2])
+        return "%s LIKE ? ESCAPE '\\'" % column
+    raise InvalidQuery("Unsupported operator %s" % op)
+
+
+def get_column(prop):
+    if prop not in COLUMNS:
+        raise InvalidQuery("Property %s is not searchable" % prop)
+    return COLUMNS[prop]
+
+
+def split_parent(path):
+    parent, name = path.rsplit("/", 1)
+    return parent or "/", name
+
+
+class SearchIndex(object):
+    """
+    Index of names and metadata of all resources for DASL SEARCH requests. The index is built in the background
+    as user and kept current through notify() with the changes done by the daemon and seen by inotify.
+
+    Mounts showing every user a tree of its own (see Filesystem.get_owner, e.g. HomeFilesystem) are indexed per
+    owner: the tree of a user is crawled as that user once the user searches, and its entries are only returned to
+    that user. The owner column is empty for entries seen by everyone.
+    """
+    log = logging.getLogger("SearchIndex")
+
+    # Rows written per transaction while crawling
+    BATCH = 1000
+
+    def __init__(self, filename, user="root"):
+        self.user = user
+        self.fs = None
+        self.mutex = threading.Lock()
+        self.queue = queue.Queue()
+        self.ready = threading.Event()
+
+        self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Indexes built before entries had an owner are built again from scratch
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(entries)")]
+        if columns and "owner" not in columns:
+            self.db.execute("DROP TABLE entries")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (path TEXT NOT NULL, owner TEXT NOT NULL, parent TEXT NOT NULL, name TEXT NOT NULL COLLATE NOCASE, "
+                        "iscollection INTEGER NOT NULL, size INTEGER, mtime REAL, contenttype TEXT, generation INTEGER NOT NULL, PRIMARY KEY (path, owner))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_name ON entries (name)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_size ON entries (size)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_mtime ON entries (mtime)")
+
+        row = self.db.execute("SELECT max(generation) FROM entries").fetchone()
+        self.generation = (row[0] or 0) + 1
+
+        # Roots of the trees of a single user found by the last build, and the users whose trees are indexed
+        self.personal = []
+        self.owners = set()
+
+    def start(self, fs):
+        self.fs = fs
+        self.rebuild()
+        threading.Thread(target=self.run, name="SearchIndex", daemon=True).start()
+
+    def rebuild(self):
+        self.queue.put(("rebuild", None, False, None))
+
+    def notify(self, path, deleted=False, owner=None):
+        self.queue.put(("update", path, deleted, owner))
+
+    def run(self):
+        while True:
+            action, path, deleted, owner = self.queue.get()
+            try:
+                if action == "rebuild":
+                    self.build()
+                elif action == "owner":
+                    if owner not in self.owners:
+                        self.index_owner(owner)
+                elif deleted:
+                    self.delete(path, owner)
+                else:
+                    self.update(path, owner)
+            except Exception:
+                self.log.exception("Failed to update the index (%s %s)" % (action, path))
+
+    def build(self):
+        self.log.info("Building search index")
+        with self.mutex:
+            self.generation += 1
+            owners = [row[0] for row in self.db.execute("SELECT DISTINCT owner FROM entries WHERE owner != ''")]
+        self.personal = []
+        self.owners = set()
+        if self.fs.get_owner(self.user, "/") is None:
+            self.index_tree("/")
+        else:
+            self.personal.append("/")
+
+        # Users who had their trees indexed before get them indexed again right away
+        for owner in owners:
+            self.index_owner(owner)
+        with self.mutex:
+            self.db.execute("DELETE FROM entries WHERE generation < ?", (self.generation,))
+        self.ready.set()
+        self.log.info("Search index complete")
+
+    def index_owner(self, owner):
+        for root in self.personal:
+            self.index_tree(root, owner)
+        self.owners.add(owner)
+
+    def index_tree(self, root, owner=None):
+        pending = [root]
+        rows = []
+        while pending:
+            path = pending.pop()
+            try:
+                children = self.fs.get_children_props(owner or self.user, path, INDEXPROP)
+            except (FileNotFoundError, PermissionError, NotADirectoryError):
+                continue
+
+            for child, props in children.items():
+                if props["D:iscollection"] and owner is None and self.fs.get_owner(self.user, child) is not None:
+                    # A mount with a tree per user, indexed for each user searching it
+                    self.personal.append(child)
+                    continue
+                rows.append(self.make_row(child, props, owner))
+                if props["D:iscollection"]:
+                    pending.append(child)
+
+            if len(rows) >= self.BATCH:
+                self.store(rows)
+                rows = []
+        self.store(rows)
+
+    def is_personal(self, path):
+        return any(root == "/" or path == root or path.startswith(root + "/") for root in self.personal)
+
+    def update(self, path, owner=None):
+        path = path.rstrip("/")
+        if not path:
+            return
+
+        # Changes in trees of a single user are indexed for that user once the user searched. Changes there without
+        # an owner (seen by inotify) can not be told apart and are left to the next build.
+        if owner is not None and owner not in self.owners or owner is None and self.is_personal(path):
+            return
+
+        try:
+            props = self.fs.get_props(owner or self.user, path, INDEXPROP)
+        except FileNotFoundError:
+            self.delete(path, owner)
+            return
+        except PermissionError:
+            return
+
+        with self.mutex:
+            known = self.db.execute("SELECT 1 FROM entries WHERE path = ? AND owner = ?", (path, owner or "")).fetchone() is not None
+        self.store([self.make_row(path, props, owner)])
+
+        # Collections moved or copied in arrive as a single change
+        if props["D:iscollection"] and not known:
+            self.index_tree(path, owner)
+
+    def delete(self, path, owner=None):
+        path = path.rstrip("/")
+        with self.mutex:
+            self.db.execute("DELETE FROM entries WHERE (path = ? OR substr(path, 1, ?) = ?) AND owner = ?", (path, len(path) + 1, path + "/", owner or ""))
+
+    def make_row(self, path, props, owner=None):
+        parent, name = split_parent(path.rstrip("/"))
+        mtime = None
+        if props.get("D:getlastmodified"):
+            mtime = parse_date(props["D:getlastmodified"])
+        return (path.rstrip("/"), owner or "", parent, name, int(bool(props["D:iscollection"])),
+                None if props["D:iscollection"] else props.get("D:getcontentlength"),
+                mtime, props.get("D:getcontenttype") or None, self.generation)
+
+    def store(self, rows):
+        if not rows:
+            return
+        with self.mutex:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany("INSERT OR REPLACE INTO entries (path, owner, parent, name, iscollection, size, mtime, contenttype, generation) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def search(self, scope, depth, where=None, orderby=[], limit=None, user=None, offset=0):
+        """
+        Search the index.
+
+        :param scope: path of the collection searched
+        :param depth: "0", "1" or "infinity"
+        :param where: parsed condition (see SEARCHRequest) or None to match everything
+        :param orderby: list of (property name, ascending)
+        :param limit: maximum number of results
+        :param user: user searching, entries of trees of other users are left out
+        :param offset: number of results skipped, for fetching further pages
+        :return: list of matching paths
+        """
+        # The trees of the user are indexed in the background, the first searches may miss entries there
+        if user is not None and user not in self.owners and self.personal:
+            self.queue.put(("owner", None, False, user))
+
+        scope = scope.rstrip("/")
+        params = [user or ""]
+        conditions = ["owner IN ('', ?)"]
+        if depth == "0":
+            conditions.append("path = ?")
+            params.append(scope or "/")
+        elif depth == "1":
+            conditions.append("parent = ?")
+            params.append(scope or "/")
+        else:
+            conditions.append("substr(path, 1, ?) = ?")
+            params += [len(scope) + 1, scope + "/"]
+
+        if where is not None:
+            conditions.append(compile_where(where, params))
+
+        # The path comes last in the order so pages of the same search do not overlap
+        order = ["%s %s" % (get_column(prop), "ASC" if ascending else "DESC") for prop, ascending in orderby]
+        sql = "SELECT path FROM entries WHERE %s ORDER BY %s" % (" AND ".join(conditions), ", ".join(order + ["path"]))
+        if limit is not None:
+            sql += " LIMIT %d OFFSET %d" % (int(limit), int(offset))
+
+        with self.mutex:
+            return [row[0] for row in self.db.execute(sql, params)]
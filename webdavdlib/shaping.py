@@ -0,0 +1,143 @@
+import grp, os, pwd, threading, time
+from webdavdlib.cache import LRUCache
+
+
+class UserPolicy(object):
+    """
+    Maps users to a setting. Keys are user names or group names prefixed with @, a user in several of the groups
+    gets the largest of their values. Users without an entry get default.
+    """
+    def __init__(self, mapping, default=None, cache_size=1024, cache_ttl=300):
+        self.users = dict((key, value) for key, value in mapping.items() if not key.startswith("@"))
+        self.groups = dict((key[1:], value) for key, value in mapping.items() if key.startswith("@"))
+        self.default = default
+        self.cache = LRUCache(cache_size, cache_ttl)
+
+    def get_groups(self, user):
+        try:
+            gids = os.getgrouplist(user, pwd.getpwnam(user).pw_gid)
+        except KeyError:
+            return []
+
+        groups = []
+        for gid in gids:
+            try:
+                groups.append(grp.getgrgid(gid).gr_name)
+            except KeyError:
+                pass
+        return groups
+
+    def get(self, user):
+        if user in self.users:
+            return self.users[user]
+        if user is None or not self.groups:
+            return self.default
+
+        # Wrapped, so users resolving to None are cached as well
+        cached = self.cache.get(user)
+        if cached is None:
+            values = [self.groups[group] for group in self.get_groups(user) if group in self.groups]
+            cached = (max(values) if values else self.default,)
+            self.cache.set(user, cached)
+        return cached[0]
+
+
+class TokenBucket(object):
+    """
+    Limits a stream to rate bytes per second on average, bursts of up to burst bytes pass without delay. Streams
+    sharing a bucket share its rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.mutex = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Takes amount tokens and returns the seconds the caller has to wait until they are covered.
+        """
+        with self.mutex:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Tokens may go negative, later callers then wait for the debt of earlier ones as well
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def consume(self, amount):
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BandwidthLimiter(object):
+    """
+    Limits the streamed bodies of every user to the rate (bytes per second) configured for the user or one of its
+    groups (see UserPolicy), None is unlimited. All transfers of a user share one bucket holding burst seconds of
+    its rate.
+    """
+    def __init__(self, limits, default=None, burst=1.0):
+        self.policy = UserPolicy(limits, default)
+        self.burst = burst
+        self.buckets = {}
+        self.mutex = threading.Lock()
+
+    def get_bucket(self, user):
+        rate = self.policy.get(user)
+        if rate is None:
+            return None
+
+        with self.mutex:
+            bucket = self.buckets.get(user)
+            if bucket is None or bucket.rate != rate:
+                bucket = TokenBucket(rate, rate * self.burst)
+                self.buckets[user] = bucket
+        return bucket
+
+
+class ThrottledWriter(object):
+    """
+    Passes writes to w at the rate of bucket. Large writes are split, so the stream does not stall for long.
+    """
+    def __init__(self, w, bucket, slice=65536):
+        self.w = w
+        self.bucket = bucket
+        self.slice = slice
+
+    def write(self, data):
+        data = memoryview(data)
+        for offset in range(0, len(data), self.slice):
+            part = data[offset:offset + self.slice]
+            self.bucket.consume(len(part))
+            self.w.write(part)
+        return len(data)
+
+    def flush(self):
+        self.w.flush()
+
+
+class ThrottledReader(object):
+    """
+    Reads from r at the rate of bucket. Reads are paced in slices, like the writes of ThrottledWriter.
+    """
+    def __init__(self, r, bucket, slice=65536):
+        self.r = r
+        self.bucket = bucket
+        self.slice = slice
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            data = self.r.read(self.slice if size < 0 else min(size, self.slice))
+            if not data:
+                break
+            self.bucket.consume(len(data))
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return b"".join(parts)
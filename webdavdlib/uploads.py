@@ -0,0 +1,95 @@
+import contextlib, json, logging, os, re, secrets, tempfile, threading, time
+
+
+class UploadBusy(Exception):
+    pass
+
+
+class UploadStore(object):
+    """
+    Keeps the data of resumable uploads (POST /path?upload) in a local directory outside of the served namespace, so
+    sessions are not listed, journaled, indexed or accounted by a quota before they are complete. A session belongs
+    to the user and target path it was created for. Sessions not written to for expiry seconds are removed.
+
+    The directory is accessed with the identity of the daemon and should only be accessible by it.
+    """
+    log = logging.getLogger("UploadStore")
+
+    def __init__(self, directory=None, expiry=86400):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "orbit-webdavd-uploads")
+        self.expiry = expiry
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+        # Sessions a request is writing to, and when expired sessions were last looked for
+        self.mutex = threading.Lock()
+        self.active = set()
+        self.swept = 0
+
+    def data_path(self, upload):
+        return os.path.join(self.directory, upload)
+
+    def create(self, user, path):
+        """
+        Starts a session for uploading to path as user and returns its id.
+        """
+        self.expire()
+        upload = secrets.token_hex(16)
+        with open(self.data_path(upload) + ".json", "x") as f:
+            json.dump({"user": user, "path": path}, f)
+        open(self.data_path(upload), "xb").close()
+        return upload
+
+    def get_offset(self, upload, user, path):
+        """
+        Returns the number of bytes received by the session. Raises FileNotFoundError for unknown sessions and for
+        sessions of other users or targets.
+        """
+        if not re.fullmatch("[0-9a-f]{32}", upload or ""):
+            raise FileNotFoundError()
+        with open(self.data_path(upload) + ".json") as f:
+            if json.load(f) != {"user": user, "path": path}:
+                raise FileNotFoundError()
+        return os.path.getsize(self.data_path(upload))
+
+    @contextlib.contextmanager
+    def open(self, upload, mode="ab"):
+        # Only one request at a time writes to or completes a session, others get UploadBusy
+        with self.mutex:
+            if upload in self.active:
+                raise UploadBusy()
+            self.active.add(upload)
+        try:
+            with open(self.data_path(upload), mode) as f:
+                yield f
+        finally:
+            with self.mutex:
+                self.active.discard(upload)
+
+    def remove(self, upload):
+        for path in (self.data_path(upload), self.data_path(upload) + ".json"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self):
+        # Looked for at most once a minute, when a session is created
+        now = time.time()
+        with self.mutex:
+            if self.swept + 60 > now:
+                return
+            self.swept = now
+            active = set(self.active)
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json") or name[:-5] in active:
+                continue
+            upload = name[:-5]
+            # Writes update the modification time of the data
+            try:
+                written = os.stat(self.data_path(upload)).st_mtime
+            except FileNotFoundError:
+                written = 0
+            if written + self.expiry < now:
+                self.log.info("Upload session %s expired" % upload)
+                self.remove(upload)